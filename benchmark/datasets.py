@@ -0,0 +1,147 @@
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.backends import default_backend
+import base64
+import bz2
+import gzip
+import json
+import os
+import random
+
+BENCHMARK_SYMMETRIC_KEY = 'cibeQ6J5GwJ8hLrrAdAbb09HjObumZGC/LuzM1RBKRA='
+# Schema of the rows of make_rows as MANIFEST VERBOSE describes it
+ROW_SCHEMA = {'elements': [{'name': 'id', 'type': {'base': 'bigint'}},
+                           {'name': 'n', 'type': {'base': 'integer'}},
+                           {'name': 'name', 'type': {'base': 'character varying', 'max_length': 64}},
+                           {'name': 'f', 'type': {'base': 'numeric', 'precision': 9, 'scale': 3}}]}
+KB = 1024
+MB = 1024 * KB
+
+
+def pkcs7_pad(data):
+    padder = padding.PKCS7(algorithms.AES.block_size).padder()
+    return padder.update(data) + padder.finalize()
+
+
+def envelope_encrypt(plaintext, symmetric_base64_key):
+    """
+    Encrypt data the way S3 client-side envelope encryption (as used by UNLOAD ENCRYPTED) does it.
+
+    Args:
+        plaintext(bytes):
+        symmetric_base64_key(str): base64 encoded master key
+
+    Returns:
+        tuple: crypto text, base64 encoded iv (x-amz-iv), base64 encoded encrypted data key (x-amz-key)
+    """
+    data_key = os.urandom(32)
+    iv = os.urandom(16)
+    encryptor = Cipher(algorithms.AES(data_key), modes.CBC(iv), backend=default_backend()).encryptor()
+    crypto_text = encryptor.update(pkcs7_pad(plaintext)) + encryptor.finalize()
+    key_encryptor = Cipher(algorithms.AES(base64.b64decode(symmetric_base64_key)), modes.ECB(),
+                           backend=default_backend()).encryptor()
+    encrypted_data_key = key_encryptor.update(pkcs7_pad(data_key)) + key_encryptor.finalize()
+    return crypto_text, base64.b64encode(iv).decode('utf-8'), base64.b64encode(encrypted_data_key).decode('utf-8')
+
+
+def make_rows(size, seed):
+    """
+    Generate pipe delimited rows like an UNLOAD without options produces.
+
+    Args:
+        size(int): approximate number of bytes, the data always ends with a complete row
+        seed(int):
+
+    Returns:
+        bytes:
+    """
+    generator = random.Random(seed)
+    block = ''.join('{i}|{n}|name {r}|{f:.3f}\n'.format(i=i, n=generator.randint(0, 10 ** 9), r=generator.random(),
+                                                          f=generator.random() * 1000)
+                    for i in range(2000)).encode('utf-8')
+    repeats = size // len(block) + 1
+    data = block * repeats
+    return data[:data.rfind(b'\n', 0, max(size, 1)) + 1]
+
+
+class Dataset:
+    def __init__(self, name, manifest_url, symmetric_key=None):
+        self.name = name
+        self.manifest_url = manifest_url
+        self.symmetric_key = symmetric_key
+        self.s3_bytes = 0
+        self.plaintext_bytes = 0
+        self.parts = 0
+
+
+def create_dataset(server, name, part_sizes, codec=None, encrypted=False, verbose=True, buckets=None):
+    """
+    Store the parts of a synthetic UNLOAD and its manifest in the fake S3 server.
+
+    Args:
+        server(FakeS3Server):
+        name(str): used as key prefix
+        part_sizes(list): plaintext size of every part
+        codec(str): None, 'gzip' or 'bzip2'
+        encrypted(bool): use client-side envelope encryption
+        verbose(bool): include content_length and record_count like MANIFEST VERBOSE does
+        buckets(list): parts are spread round robin over these buckets
+
+    Returns:
+        Dataset:
+    """
+    buckets = buckets or ['benchmark']
+    dataset = Dataset(name, 's3://{b}/{n}/{n}.manifest'.format(b=buckets[0], n=name),
+                      symmetric_key=BENCHMARK_SYMMETRIC_KEY if encrypted else None)
+    entries = []
+    for index, part_size in enumerate(part_sizes):
+        bucket = buckets[index % len(buckets)]
+        key = '{n}/{n}{i:04d}_part_00'.format(n=name, i=index)
+        data = make_rows(part_size, seed=index)
+        dataset.plaintext_bytes += len(data)
+        record_count = data.count(b'\n')
+        metadata = {}
+        if codec == 'gzip':
+            data, key = gzip.compress(data, compresslevel=1), key + '.gz'
+        elif codec == 'bzip2':
+            data, key = bz2.compress(data, compresslevel=1), key + '.bz2'
+        if encrypted:
+            data, iv, data_key = envelope_encrypt(data, BENCHMARK_SYMMETRIC_KEY)
+            metadata = {'x-amz-iv': iv, 'x-amz-key': data_key, 'x-amz-matdesc': '{}'}
+        server.put_object(bucket, key, data, metadata)
+        dataset.s3_bytes += len(data)
+        dataset.parts += 1
+        entry = {'url': 's3://{b}/{k}'.format(b=bucket, k=key), 'mandatory': True}
+        if verbose:
+            entry['meta'] = {'content_length': len(data), 'record_count': record_count}
+        entries.append(entry)
+    manifest_json = {'entries': entries}
+    if verbose:
+        manifest_json['schema'] = ROW_SCHEMA
+    manifest = json.dumps(manifest_json).encode('utf-8')
+    server.put_object(buckets[0], '{n}/{n}.manifest'.format(n=name), manifest)
+    return dataset
+
+
+def create_datasets(server, scale=1.0):
+    """
+
+    Args:
+        server(FakeS3Server):
+        scale(float): multiplies the size of the parts
+
+    Returns:
+        dict: Dataset objects by name
+    """
+    def sizes(count, size):
+        return [max(1, int(size * scale))] * count
+
+    datasets = [
+        create_dataset(server, 'many-small', sizes(256, 16 * KB), verbose=False),
+        create_dataset(server, 'few-huge', sizes(2, 32 * MB)),
+        create_dataset(server, 'gzip', sizes(16, 4 * MB), codec='gzip'),
+        create_dataset(server, 'encrypted', sizes(8, 8 * MB), encrypted=True),
+        create_dataset(server, 'mixed', sizes(32, 64 * KB) + sizes(4, 8 * MB), codec='gzip',
+                       buckets=['benchmark', 'benchmark-2'])
+    ]
+    return dict((dataset.name, dataset) for dataset in datasets)
@@ -0,0 +1,163 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import formatdate
+from urllib.parse import urlparse, parse_qs, unquote
+from xml.sax.saxutils import escape
+import datetime
+import hashlib
+import re
+import threading
+
+RANGE_PATTERN = re.compile(r'bytes=(?P<start>\d+)-(?P<end>\d*)')
+MAX_KEYS = 1000
+
+
+class FakeS3Object:
+    def __init__(self, data, metadata=None):
+        self.data = data
+        self.metadata = metadata or {}
+        self.etag = '"{md5}"'.format(md5=hashlib.md5(data).hexdigest())
+        self.last_modified = datetime.datetime.now(datetime.timezone.utc)
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    """
+    Implements the subset of the S3 REST API (path style) that is used by this tool: HEAD object, (ranged) GET object,
+    ListObjectsV2 and GetBucketLocation.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def get_bucket_and_key(self):
+        parsed = urlparse(self.path)
+        parts = parsed.path.lstrip('/').split('/', 1)
+        bucket = unquote(parts[0])
+        key = unquote(parts[1]) if len(parts) > 1 else ''
+        return bucket, key, parse_qs(parsed.query, keep_blank_values=True)
+
+    def send_body(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_error_code(self, status, code):
+        body = '<?xml version="1.0" encoding="UTF-8"?><Error><Code>{c}</Code></Error>'.format(c=code).encode('utf-8')
+        self.send_body(status, body, {'Content-Type': 'application/xml'})
+
+    def get_object_headers(self, s3_object):
+        headers = {
+            'ETag': s3_object.etag,
+            'Last-Modified': formatdate(s3_object.last_modified.timestamp(), usegmt=True),
+            'Accept-Ranges': 'bytes'
+        }
+        for name, value in s3_object.metadata.items():
+            headers['x-amz-meta-{n}'.format(n=name)] = value
+        return headers
+
+    def do_HEAD(self):
+        self.server.count_request()
+        bucket, key, _ = self.get_bucket_and_key()
+        s3_object = self.server.objects.get((bucket, key), None)
+        if s3_object is None:
+            self.send_error_code(404, 'NoSuchKey')
+            return
+        self.send_response(200)
+        for name, value in self.get_object_headers(s3_object).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(s3_object.data)))
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.count_request()
+        bucket, key, query = self.get_bucket_and_key()
+        if key == '' and 'location' in query:
+            body = '<?xml version="1.0" encoding="UTF-8"?><LocationConstraint>{r}</LocationConstraint>'
+            self.send_body(200, body.format(r=self.server.region).encode('utf-8'), {'Content-Type': 'application/xml'})
+        elif key == '' and query.get('list-type', [''])[0] == '2':
+            self.list_objects(bucket, query)
+        else:
+            self.get_object(bucket, key)
+
+    def get_object(self, bucket, key):
+        s3_object = self.server.objects.get((bucket, key), None)
+        if s3_object is None:
+            self.send_error_code(404, 'NoSuchKey')
+            return
+        headers = self.get_object_headers(s3_object)
+        size = len(s3_object.data)
+        match = RANGE_PATTERN.match(self.headers.get('Range', ''))
+        if match is None:
+            self.send_body(200, s3_object.data, headers)
+            return
+        start = int(match.group('start'))
+        end = min(int(match.group('end')) if match.group('end') else size - 1, size - 1)
+        if start >= size:
+            self.send_error_code(416, 'InvalidRange')
+            return
+        headers['Content-Range'] = 'bytes {s}-{e}/{t}'.format(s=start, e=end, t=size)
+        self.send_body(206, s3_object.data[start:end + 1], headers)
+
+    def list_objects(self, bucket, query):
+        prefix = query.get('prefix', [''])[0]
+        start_after = query.get('continuation-token', query.get('start-after', ['']))[0]
+        keys = sorted(key for object_bucket, key in self.server.objects.keys()
+                      if object_bucket == bucket and key.startswith(prefix) and key > start_after)
+        page, truncated = keys[:MAX_KEYS], len(keys) > MAX_KEYS
+        contents = []
+        for key in page:
+            s3_object = self.server.objects[(bucket, key)]
+            contents.append('<Contents><Key>{k}</Key><LastModified>{m}</LastModified><ETag>{e}</ETag>'
+                            '<Size>{s}</Size><StorageClass>STANDARD</StorageClass></Contents>'
+                            .format(k=escape(key), m=s3_object.last_modified.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                                    e=escape(s3_object.etag), s=len(s3_object.data)))
+        continuation = ''
+        if truncated:
+            continuation = '<NextContinuationToken>{t}</NextContinuationToken>'.format(t=escape(page[-1]))
+        body = ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/"><Name>{b}</Name>'
+                '<Prefix>{p}</Prefix><KeyCount>{n}</KeyCount><MaxKeys>{mk}</MaxKeys><IsTruncated>{t}</IsTruncated>'
+                '{c}{contents}</ListBucketResult>').format(b=escape(bucket), p=escape(prefix), n=len(page),
+                                                           mk=MAX_KEYS, t=str(truncated).lower(), c=continuation,
+                                                           contents=''.join(contents))
+        self.send_body(200, body.encode('utf-8'), {'Content-Type': 'application/xml'})
+
+
+class FakeS3Server(ThreadingHTTPServer):
+    """
+    In-process S3 stand-in that serves objects from memory on a local port.  Use it by pointing the
+    S3ClientRegistry to get_endpoint_url().
+    """
+    daemon_threads = True
+
+    def __init__(self, region='us-west-2', port=0):
+        super(FakeS3Server, self).__init__(('127.0.0.1', port), FakeS3Handler)
+        self.region = region
+        self.objects = {}
+        self.request_count = 0
+        self.request_count_lock = threading.Lock()
+        self.thread = None
+
+    def count_request(self):
+        with self.request_count_lock:
+            self.request_count += 1
+
+    def put_object(self, bucket, key, data, metadata=None):
+        self.objects[(bucket, key)] = FakeS3Object(data, metadata)
+
+    def get_endpoint_url(self):
+        return 'http://127.0.0.1:{port}'.format(port=self.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,94 @@
+"""
+Startup benchmark: the tool is called from shell pipelines many times, so importing the CLI must stay cheap.
+
+Usage (from the repository root):
+
+    python -m benchmark.import_time --budget-ms 150
+"""
+import click
+import os
+import subprocess
+import sys
+import time
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BUDGET_MS = 150
+# Modules that must only be loaded by the actions that need them
+HEAVY_MODULES = ['asyncio', 'boto3', 'botocore', 's3transfer', 'cryptography', 'util.s3_helper']
+
+
+def run_python(code, *options):
+    return subprocess.run([sys.executable] + list(options) + ['-c', code], cwd=REPOSITORY_ROOT, check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def measure_import_time(module='cli.cli', runs=5):
+    """
+    Import the module in fresh interpreters with -X importtime.
+
+    Args:
+        module(str):
+        runs(int): number of interpreters, the fastest one counts to filter out noise of a busy machine
+
+    Returns:
+        float: cumulative import time of the module in milliseconds
+    """
+    timings = []
+    for _ in range(runs):
+        stderr = run_python('import {m}'.format(m=module), '-X', 'importtime').stderr
+        for line in stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == module:
+                timings.append(int(fields[1]) / 1000)
+    return min(timings)
+
+
+def measure_wall_time(code, runs=5):
+    """
+    Run the code in fresh interpreters.
+
+    Args:
+        code(str):
+        runs(int): number of interpreters, the fastest one counts to filter out noise of a busy machine
+
+    Returns:
+        float: wall time of the fastest interpreter in milliseconds, including the interpreter startup
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run_python(code)
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def get_loaded_heavy_modules(module='cli.cli'):
+    """
+
+    Returns:
+        list: the HEAVY_MODULES that are loaded by importing the module
+    """
+    code = 'import sys, {m}; print(" ".join(m for m in {h} if m in sys.modules))'.format(m=module, h=HEAVY_MODULES)
+    return run_python(code).stdout.split()
+
+
+@click.command()
+@click.option('--budget-ms', type=float, default=DEFAULT_BUDGET_MS, help='Fail if importing the CLI takes longer.')
+@click.option('--runs', type=click.IntRange(min=1), default=5, help='Number of fresh interpreters to measure.')
+def main(budget_ms, runs):
+    import_ms = measure_import_time(runs=runs)
+    heavy_modules = get_loaded_heavy_modules()
+    click.echo('Importing cli.cli takes {t:.1f} ms (budget {b:.1f} ms)'.format(t=import_ms, b=budget_ms))
+    failed = False
+    if len(heavy_modules) > 0:
+        click.echo('Loaded at startup: {m}'.format(m=', '.join(heavy_modules)))
+        failed = True
+    if import_ms > budget_ms:
+        click.echo('Import time is over budget')
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
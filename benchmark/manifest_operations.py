@@ -0,0 +1,80 @@
+"""
+Micro-benchmark of the manifest operations that run over every entry: parsing, membership, the common prefix and the
+duplicate check of local paths.  They must stay linear, so a 1M entry manifest takes seconds and not hours.
+
+Usage (from the repository root):
+
+    python -m benchmark.manifest_operations --entries 1000000
+"""
+from util.manifest import Manifest
+from util.s3_file import S3File
+from util.s3_helper import S3Helper
+import click
+import io
+import json
+import os
+import time
+
+
+def create_manifest_json(entry_count, bucket='benchmark-bucket', prefix='unload/2024/01/01/table'):
+    entries = [{'url': 's3://{b}/{p}/slice_{i:07d}_part_00.gz'.format(b=bucket, p=prefix, i=index), 'mandatory': True,
+                'meta': {'content_length': 1000 + index, 'record_count': 10}} for index in range(entry_count)]
+    return json.dumps({'entries': entries})
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def run_manifest_operations(entry_count, lookup_count=100000):
+    """
+
+    Args:
+        entry_count(int): number of entries of the generated manifest
+        lookup_count(int): number of membership lookups, half of them for files that are not in the manifest
+
+    Returns:
+        dict: seconds per operation and the results that show the operations did their work
+    """
+    manifest_bytes = create_manifest_json(entry_count).encode('utf-8')
+    manifest, parse_seconds = timed(lambda: Manifest(manifest_stream=io.BytesIO(manifest_bytes)))
+    del manifest_bytes
+
+    step = max(1, entry_count // lookup_count)
+    lookups = []
+    for index in range(0, entry_count, step)[:lookup_count // 2]:
+        entry = manifest.entries[index]
+        lookups.append(S3File(entry.get_bucket(), entry.get_key()))
+        lookups.append(S3File(entry.get_bucket(), entry.get_key() + '.missing'))
+    found, contains_seconds = timed(lambda: sum(1 for s3file in lookups if s3file in manifest))
+
+    prefix, prefix_seconds = timed(manifest.get_common_path_prefix)
+    local_files = [os.path.join('/data', entry.get_s3_file_name(prefix=prefix)) for entry in manifest.entries]
+    duplicates, duplicates_seconds = timed(lambda: S3Helper.get_duplicates(local_files))
+    unique_files, dedup_seconds = timed(lambda: len(set(lookups + lookups)))
+    return {
+        'entries': entry_count,
+        'parse_seconds': parse_seconds,
+        'contains_seconds': contains_seconds,
+        'lookups': len(lookups),
+        'found': found,
+        'common_prefix_seconds': prefix_seconds,
+        'common_prefix': prefix,
+        'duplicate_check_seconds': duplicates_seconds,
+        'duplicates': len(duplicates),
+        's3file_dedup_seconds': dedup_seconds,
+        'unique_s3files': unique_files
+    }
+
+
+@click.command()
+@click.option('--entries', type=click.IntRange(min=1), default=1000000, help='Number of manifest entries.')
+@click.option('--lookups', type=click.IntRange(min=2), default=100000, help='Number of membership lookups.')
+def main(entries, lookups):
+    click.echo(json.dumps(run_manifest_operations(entries, lookup_count=lookups), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+"""
+Throughput benchmarks that run against a local S3 stand-in, so they can run offline and be compared over time.  The
+stand-in and every measured scenario run in separate processes.
+
+Usage (from the repository root):
+
+    python -m benchmark.run_benchmarks --output results.json
+    python -m benchmark.run_benchmarks --output new.json --baseline results.json --max-regression 0.2
+"""
+from benchmark.fake_s3 import FakeS3Server
+from benchmark.datasets import create_datasets
+import click
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+SCENARIOS = ['retrieve-files', 'cat-files', 'decrypt']
+
+
+def get_symmetric_key(dataset):
+    from util.symmetric_key import SymmetricKey
+    if dataset.symmetric_key is None:
+        return None
+    return SymmetricKey(dataset.symmetric_key)
+
+
+def retrieve_files(dataset, parallelism, work_dir):
+    from util.s3_helper import S3Helper
+    from util.s3_file import S3File
+    S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), work_dir,
+                                               symmetric_key=get_symmetric_key(dataset), parallelism=parallelism,
+                                               overwrite=True)
+
+
+def cat_files(dataset, parallelism, work_dir):
+    from util.s3_helper import S3Helper
+    from util.s3_file import S3File
+    with open(os.devnull, 'wb') as devnull:
+        S3Helper.set_stdout(devnull)
+        S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), None,
+                                                   symmetric_key=get_symmetric_key(dataset), parallelism=parallelism)
+        S3Helper.set_stdout(None)
+
+
+def prepare_decrypt(dataset, parallelism, work_dir):
+    """
+    Download the encrypted parts as is, only their decryption is measured.
+    """
+    from util.s3_helper import S3Helper
+    from util.s3_file import S3File
+    S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), work_dir, parallelism=parallelism,
+                                               overwrite=True)
+
+
+def decrypt(dataset, parallelism, work_dir):
+    from util.file_cryptor import EnvelopeFileCryptor
+    from util.s3_file import S3File
+    for file_name in sorted(os.listdir(work_dir)):
+        s3_file = S3File('{p}/{f}'.format(p=dataset.manifest_url.rpartition('/')[0], f=file_name))
+        s3_file.get_encryption_metadata()
+        cryptor = EnvelopeFileCryptor(get_symmetric_key(dataset), s3_file.get_x_amz_iv(), s3_file.get_x_amz_key())
+        input_file = os.path.join(work_dir, file_name)
+        output_file = input_file + '.decrypted'
+        if parallelism > 1:
+            cryptor.decrypt_file_parallel(input_file, output_file, workers=parallelism)
+        else:
+            cryptor.decrypt_file(input_file, output_file)
+
+
+def get_scenario_functions(scenario):
+    """
+
+    Returns:
+        tuple: function that prepares the work directory (not measured) and function that is measured
+    """
+    if scenario == 'retrieve-files':
+        return None, retrieve_files
+    elif scenario == 'cat-files':
+        return None, cat_files
+    elif scenario == 'decrypt':
+        return prepare_decrypt, decrypt
+    raise(ValueError('Unknown scenario {s}'.format(s=scenario)))
+
+
+def serve_datasets(scale, connection):
+    """
+    Runs in its own process such that the memory and CPU time of the S3 stand-in and its datasets are not measured
+    with the tool.  Answers the request count until it is asked to stop.
+    """
+    server = FakeS3Server().start()
+    connection.send((server.get_endpoint_url(), create_datasets(server, scale=scale)))
+    while connection.recv() != 'stop':
+        connection.send(server.request_count)
+    server.stop()
+    connection.close()
+
+
+class FakeS3Process:
+    """
+    A FakeS3Server with the benchmark datasets, in a separate process.
+    """
+    def __init__(self, scale):
+        context = multiprocessing.get_context('spawn')
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=serve_datasets, args=(scale, child_connection), daemon=True)
+        self.process.start()
+        self.endpoint_url, self.datasets = self.connection.recv()
+
+    def get_endpoint_url(self):
+        return self.endpoint_url
+
+    def get_request_count(self):
+        self.connection.send('request_count')
+        return self.connection.recv()
+
+    def stop(self):
+        self.connection.send('stop')
+        self.process.join()
+
+
+def run_in_child(endpoint_url, scenario, dataset, parallelism, connection):
+    """
+    Runs in a freshly spawned process such that peak RSS and CPU time only cover the tool running a single scenario.
+    """
+    from util.s3_client_registry import S3ClientRegistry
+    S3ClientRegistry.configure(endpoint_url=endpoint_url, max_pool_connections=max(10, parallelism))
+    work_dir = tempfile.mkdtemp(prefix='redshift-manifest-tools-benchmark')
+    try:
+        prepare, measure = get_scenario_functions(scenario)
+        if prepare is not None:
+            prepare(dataset, parallelism, work_dir)
+        connection.send({'prepared': True})
+        times_before = os.times()
+        start = time.perf_counter()
+        measure(dataset, parallelism, work_dir)
+        seconds = time.perf_counter() - start
+        times_after = os.times()
+        cpu_seconds = sum(times_after[index] - times_before[index] for index in range(4))
+        peak_rss_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        connection.send({'seconds': seconds, 'cpu_seconds': cpu_seconds, 'peak_rss_kb': peak_rss_kb})
+    except Exception as e:
+        connection.send({'error': '{t}: {e}'.format(t=type(e).__name__, e=str(e))})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        connection.close()
+
+
+def run_scenario(server, scenario, dataset, parallelism):
+    """
+    Args:
+        server(FakeS3Process):
+        scenario(str):
+        dataset(Dataset):
+        parallelism(int):
+
+    Returns:
+        dict: the measurements or an error
+    """
+    # A spawned process does not inherit the memory of this process, so its peak RSS is the one of the tool
+    context = multiprocessing.get_context('spawn')
+    parent_connection, child_connection = context.Pipe(duplex=False)
+    process = context.Process(target=run_in_child,
+                              args=(server.get_endpoint_url(), scenario, dataset, parallelism, child_connection))
+    process.start()
+    child_connection.close()
+    result = parent_connection.recv()
+    requests_before = server.get_request_count()
+    if 'prepared' in result:
+        result = parent_connection.recv()
+    process.join()
+    if 'error' in result:
+        return result
+    result['requests'] = server.get_request_count() - requests_before
+    result['bytes'] = dataset.s3_bytes
+    result['mb_per_s'] = dataset.s3_bytes / (1024 * 1024) / result['seconds']
+    result['requests_per_s'] = result['requests'] / result['seconds']
+    return result
+
+
+def compare_to_baseline(results, baseline, max_regression):
+    """
+    Print the throughput compared to the baseline.
+
+    Returns:
+        list: names of the benchmarks whose throughput dropped more than max_regression
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        baseline_result = baseline.get('results', {}).get(name, None)
+        if baseline_result is None or 'mb_per_s' not in baseline_result or 'mb_per_s' not in result:
+            continue
+        ratio = result['mb_per_s'] / baseline_result['mb_per_s']
+        click.echo('{n:40s} {b:10.1f} -> {c:10.1f} MB/s ({r:+.1%})'.format(n=name, b=baseline_result['mb_per_s'],
+                                                                          c=result['mb_per_s'], r=ratio - 1))
+        if max_regression is not None and ratio < 1 - max_regression:
+            regressions.append(name)
+    return regressions
+
+
+@click.command()
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), help='JSON file to write the results to.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='JSON results of a previous run.')
+@click.option('--max-regression', type=float, default=None,
+              help='Fail if throughput drops more than this fraction (e.g. 0.2) compared to the baseline.')
+@click.option('--scale', type=float, default=1.0, help='Multiplies the size of the generated parts.')
+@click.option('--parallelism', type=click.IntRange(min=1), default=8, help='Parallelism passed to the tool.')
+@click.option('--scenario', 'scenarios', type=click.Choice(SCENARIOS), multiple=True,
+              help='Scenarios to run, all by default.')
+def main(output, baseline, max_regression, scale, parallelism, scenarios):
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+    server = FakeS3Process(scale)
+    datasets = server.datasets
+
+    results = {}
+    for scenario in scenarios or SCENARIOS:
+        for dataset in datasets.values():
+            if scenario == 'decrypt' and dataset.symmetric_key is None:
+                continue
+            name = '{s}/{d}'.format(s=scenario, d=dataset.name)
+            results[name] = run_scenario(server, scenario, dataset, parallelism)
+            click.echo('{n:40s} {r}'.format(n=name, r=json.dumps(results[name], sort_keys=True)))
+    server.stop()
+
+    report = {
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'scale': scale,
+        'parallelism': parallelism,
+        'results': results
+    }
+    if output is not None:
+        with open(output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+
+    failed = [name for name, result in results.items() if 'error' in result]
+    if baseline is not None:
+        with open(baseline, 'r') as baseline_file:
+            failed += compare_to_baseline(results, json.load(baseline_file), max_regression)
+    if len(failed) > 0:
+        click.echo('Failed or regressed: {f}'.format(f=', '.join(failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,13 @@
+import atexit
 import click
 import logging
 import sys
 from cli.cli_action import CliAction
 from cli.cli_option import CliOption
-from util.s3_helper import S3Helper
-from util.s3_file import S3PathParamType
-from util.symmetric_key import SymmetricKeyParamType
+from cli.param_types import S3PathParamType, SymmetricKeyParamType
+from util.s3_client_registry import S3ClientRegistry
+from util.retry_policy import RetryPolicy
+from util.instrumentation import Instrumentation
 
 str_missing_mandatory_parameter = "Parameter {param} is mandatory when using action '{action}'"
 
@@ -15,17 +17,56 @@ SYMMETRIC_KEY_OPTION = CliOption('symmetric-key', 'Base 64 encoded symmetric key
 RETRIEVE_DEST_OPTION = CliOption('dest', 'Target directory where to store files', mandatory=True)
 MANIFEST_S3URL_OPTION = CliOption('manifest-s3url', 'S3 path to manifest file', mandatory=True)
 OVERWRITE_OPTION = CliOption('overwrite', 'Flag to indicate whether local files should be overwritten')
+PARALLELISM_OPTION = CliOption('parallelism', 'Number of files that are processed concurrently or number of ranged '
+                                              'GETs in flight for cat-files (default 1)')
+DECRYPT_WORKERS_OPTION = CliOption('decrypt-workers', 'Number of worker processes that decrypt segments of a single '
+                                                      'big encrypted file (default 1)')
+RESUME_OPTION = CliOption('resume', 'Keep a journal in the destination directory and only retrieve the files and byte '
+                                    'ranges that are not finished yet')
+SHARD_OUTPUT_OPTION = CliOption('shard-output', 'Spread whole files over several outputs instead of stdout, give a '
+                                                'path of a file or FIFO or fd:<n> for each output (repeatable)')
+DELETE_OPTION = CliOption('delete', 'Delete local files of a previous sync that are no longer in the manifest')
+MAX_POOL_CONNECTIONS_OPTION = CliOption('max-pool-connections', 'Maximum number of connections kept open per S3 client '
+                                                                '(one client per region is shared by all files, '
+                                                                'default 10)')
+TCP_KEEPALIVE_OPTION = CliOption('tcp-keepalive', 'Enable TCP keep-alive on S3 connections')
+REGION_CACHE_FILE_OPTION = CliOption('region-cache-file', 'JSON file in which bucket regions are cached between runs')
+CACHE_DIR_OPTION = CliOption('cache-dir', 'Directory of a part cache that is shared by the jobs on this host')
+CACHE_MAX_BYTES_OPTION = CliOption('cache-max-bytes', 'Size limit of the part cache, least recently used parts are '
+                                                      'evicted')
+SHARD_COUNT_OPTION = CliOption('shard-count', 'Number of nodes that share the retrieval, every node only retrieves its '
+                                              'shard of the files (default 1)')
+SHARD_INDEX_OPTION = CliOption('shard-index', 'Shard of this node, from 0 up to shard-count - 1 (default 0)')
+METRICS_FILE_OPTION = CliOption('metrics-file', 'Record timings, bytes and retries per stage and write them to this '
+                                                'file at the end of the run, in the Prometheus text format if it ends '
+                                                'with .prom and as JSON otherwise')
+TRANSFER_ENGINE_OPTION = CliOption('transfer-engine', 'How the requests are run: a pool of threads or a single asyncio '
+                                                      'event loop for all files, asyncio requires aiobotocore '
+                                                      '(threads or asyncio, default threads)')
+REQUESTS_IN_FLIGHT_OPTION = CliOption('requests-in-flight', 'Maximum number of ranged GETs in flight over all files '
+                                                            'with the asyncio transfer engine (default 128)')
+CPU_WORKERS_OPTION = CliOption('cpu-workers', 'Number of worker processes that decrypt and decompress, 0 uses one per '
+                                              'CPU but the one that does the network I/O (default 1: all work in the '
+                                              'main process)')
+# Options of every action that retrieves parts
+TRANSFER_OPTIONS = [MAX_POOL_CONNECTIONS_OPTION, TCP_KEEPALIVE_OPTION, REGION_CACHE_FILE_OPTION, CACHE_DIR_OPTION,
+                    CACHE_MAX_BYTES_OPTION, SHARD_COUNT_OPTION, SHARD_INDEX_OPTION, METRICS_FILE_OPTION]
 
 A_LIST_ACTIONS = CliAction('list-actions', 'Returns the list of supported actions')
 A_LIST_FILES = CliAction('list-files', 'List the files mentioned in the manifest')
-A_RETRIEVE_FILES = CliAction('retrieve-files', 'Retrieve files and store locally', [SYMMETRIC_KEY_OPTION,
-                                                                                    RETRIEVE_DEST_OPTION,
-                                                                                    MANIFEST_S3URL_OPTION,
-                                                                                    OVERWRITE_OPTION])
-A_CAT_FILES = CliAction('cat-files', 'Concatenate the files in manifest and print on stdout', [SYMMETRIC_KEY_OPTION,
-                                                                                               MANIFEST_S3URL_OPTION])
+A_RETRIEVE_FILES = CliAction('retrieve-files', 'Retrieve files and store locally',
+                             [SYMMETRIC_KEY_OPTION, RETRIEVE_DEST_OPTION, MANIFEST_S3URL_OPTION, OVERWRITE_OPTION,
+                              PARALLELISM_OPTION, DECRYPT_WORKERS_OPTION, RESUME_OPTION, TRANSFER_ENGINE_OPTION,
+                              REQUESTS_IN_FLIGHT_OPTION] + TRANSFER_OPTIONS)
+A_SYNC_FILES = CliAction('sync-files', 'Retrieve only the files that are new or changed since the previous sync',
+                         [SYMMETRIC_KEY_OPTION, RETRIEVE_DEST_OPTION, MANIFEST_S3URL_OPTION, PARALLELISM_OPTION,
+                          DECRYPT_WORKERS_OPTION, DELETE_OPTION, TRANSFER_ENGINE_OPTION, REQUESTS_IN_FLIGHT_OPTION]
+                         + TRANSFER_OPTIONS)
+A_CAT_FILES = CliAction('cat-files', 'Concatenate the files in manifest and print on stdout',
+                        [SYMMETRIC_KEY_OPTION, MANIFEST_S3URL_OPTION, PARALLELISM_OPTION, SHARD_OUTPUT_OPTION,
+                         CPU_WORKERS_OPTION] + TRANSFER_OPTIONS)
 
-supported_actions_full = [ A_LIST_ACTIONS, A_LIST_FILES, A_RETRIEVE_FILES, A_CAT_FILES ]
+supported_actions_full = [ A_LIST_ACTIONS, A_LIST_FILES, A_RETRIEVE_FILES, A_SYNC_FILES, A_CAT_FILES ]
 supported_actions_names = [action.name for action in supported_actions_full]
 
 
@@ -33,13 +74,44 @@ supported_actions_names = [action.name for action in supported_actions_full]
 @click.option('--debug', is_flag=True, help='Will print debug messages.')
 @click.option('--region', help='Force the region to be used. (should not be used as bucket region is ' +
                                'detected automatically).')
+@click.option('--' + MAX_POOL_CONNECTIONS_OPTION.name, type=click.IntRange(min=1), default=10,
+              help=MAX_POOL_CONNECTIONS_OPTION.description)
+@click.option('--' + TCP_KEEPALIVE_OPTION.name, is_flag=True, help=TCP_KEEPALIVE_OPTION.description)
+@click.option('--' + REGION_CACHE_FILE_OPTION.name, type=click.Path(dir_okay=False, writable=True),
+              help=REGION_CACHE_FILE_OPTION.description)
+@click.option('--' + CACHE_DIR_OPTION.name, type=click.Path(file_okay=False, writable=True),
+              help=CACHE_DIR_OPTION.description)
+@click.option('--' + CACHE_MAX_BYTES_OPTION.name, type=click.IntRange(min=0), default=None,
+              help=CACHE_MAX_BYTES_OPTION.description)
+@click.option('--' + SHARD_COUNT_OPTION.name, type=click.IntRange(min=1), default=1,
+              help=SHARD_COUNT_OPTION.description)
+@click.option('--' + SHARD_INDEX_OPTION.name, type=click.IntRange(min=0), default=0,
+              help=SHARD_INDEX_OPTION.description)
+@click.option('--' + METRICS_FILE_OPTION.name, type=click.Path(dir_okay=False, writable=True),
+              help=METRICS_FILE_OPTION.description)
+@click.option('--' + TRANSFER_ENGINE_OPTION.name, type=click.Choice(['threads', 'asyncio']), default='threads',
+              help=TRANSFER_ENGINE_OPTION.description)
+@click.option('--' + REQUESTS_IN_FLIGHT_OPTION.name, type=click.IntRange(min=1), default=128,
+              help=REQUESTS_IN_FLIGHT_OPTION.description)
+@click.option('--' + CPU_WORKERS_OPTION.name, type=click.IntRange(min=0), default=1,
+              help=CPU_WORKERS_OPTION.description)
 @click.option('--action', type=click.Choice(supported_actions_names), help='The action performed by the tool')
 @click.option('--' + RETRIEVE_DEST_OPTION.name, type=click.Path(True, False, True, True, True),
               help=RETRIEVE_DEST_OPTION.description)
 @click.option('--'+SYMMETRIC_KEY_OPTION.name, type=SymmetricKeyParamType(), help=SYMMETRIC_KEY_OPTION.description)
 @click.option('--' + MANIFEST_S3URL_OPTION.name, type=S3PathParamType(), help=MANIFEST_S3URL_OPTION.description)
 @click.option('--' + OVERWRITE_OPTION.name, is_flag=True, help=OVERWRITE_OPTION.description)
-def cli_main(debug, region, action, symmetric_key, dest, manifest_s3url, overwrite):
+@click.option('--' + PARALLELISM_OPTION.name, type=click.IntRange(min=1), default=1,
+              help=PARALLELISM_OPTION.description)
+@click.option('--' + DECRYPT_WORKERS_OPTION.name, type=click.IntRange(min=1), default=1,
+              help=DECRYPT_WORKERS_OPTION.description)
+@click.option('--' + RESUME_OPTION.name, is_flag=True, help=RESUME_OPTION.description)
+@click.option('--' + DELETE_OPTION.name, is_flag=True, help=DELETE_OPTION.description)
+@click.option('--' + SHARD_OUTPUT_OPTION.name, 'shard_outputs', multiple=True, help=SHARD_OUTPUT_OPTION.description)
+def cli_main(debug, region, max_pool_connections, tcp_keepalive, region_cache_file, cache_dir, cache_max_bytes,
+             shard_count, shard_index, metrics_file, transfer_engine, requests_in_flight, cpu_workers, action,
+             symmetric_key, dest, manifest_s3url, overwrite, parallelism, decrypt_workers, resume, delete,
+             shard_outputs):
     """This is a CLI tool to interact with Redshift manifest files.
 
     For supported actions use '--action list-actions'
@@ -54,6 +126,18 @@ def cli_main(debug, region, action, symmetric_key, dest, manifest_s3url, overwri
         logger.setLevel(logging.WARN)
 
     logging.debug('Region {r}'.format(r=region))
+    # Every worker shares the client of the bucket region so the pool must be at least as big as the parallelism
+    S3ClientRegistry.configure(max_pool_connections=max(max_pool_connections, parallelism), tcp_keepalive=tcp_keepalive)
+    # Every connection can have an attempt and its hedge in flight
+    RetryPolicy.configure(max_workers=max(RetryPolicy.max_workers, 2 * S3ClientRegistry.max_pool_connections))
+
+    if metrics_file is not None:
+        # With --debug every measurement is logged as well
+        Instrumentation.enable(trace=debug)
+        atexit.register(Instrumentation.write, metrics_file)
+
+    if shard_index >= shard_count:
+        raise(click.BadParameter('--shard-index must be smaller than --shard-count ({n})'.format(n=shard_count)))
 
     if action is None:
         click.echo('NO ACTION SPECIFIED!')
@@ -66,26 +150,54 @@ def cli_main(debug, region, action, symmetric_key, dest, manifest_s3url, overwri
             click.echo(action)
         sys.exit(0)
     else:
+        # S3Helper pulls in the whole retrieval machinery, only actions that access S3 need it
+        from util.s3_helper import S3Helper
         # Possible S3 access needed, initialize helper to make sure Region info is used
         if manifest_s3url is None:
             raise (click.BadParameter(str_missing_mandatory_parameter.format(action=action,
                                                                              param=MANIFEST_S3URL_OPTION.name)))
 
-        if action == A_RETRIEVE_FILES.name:
+        if action in [A_RETRIEVE_FILES.name, A_SYNC_FILES.name]:
             ## Make sure destination parameter was given
             if dest is None:
                 raise(click.BadParameter(str_missing_mandatory_parameter.format(action=action,
                                                                                 param=RETRIEVE_DEST_OPTION.name)))
 
-            msg = 'Call S3Helper.retrieve_files_from_manifest_file({m},{d},symmetric_key={s},region={r},overwrite={o}'
-            logging.debug(msg.format(m=manifest_s3url, d=dest, s=symmetric_key, r=region, o=overwrite))
-            S3Helper.retrieve_files_from_manifest_file(manifest_s3url, dest, symmetric_key=symmetric_key, region=region,
-                                                       overwrite=overwrite)
+            msg = 'Call S3Helper.retrieve_files_from_manifest_file({m},{d},symmetric_key={s},region={r},' \
+                  'overwrite={o},parallelism={p},decrypt_workers={dw},resume={rs},sync={sy},delete={de}'
+            logging.debug(msg.format(m=manifest_s3url, d=dest, s=symmetric_key, r=region, o=overwrite, p=parallelism,
+                                     dw=decrypt_workers, rs=resume, sy=action == A_SYNC_FILES.name, de=delete))
+            retrieve_kwargs = {
+                'symmetric_key': symmetric_key,
+                'region': region,
+                'overwrite': overwrite,
+                'parallelism': parallelism,
+                'decrypt_workers': decrypt_workers,
+                'region_cache_file': region_cache_file,
+                'resume': resume,
+                'sync': action == A_SYNC_FILES.name,
+                'delete': delete,
+                'cache_dir': cache_dir,
+                'cache_max_bytes': cache_max_bytes,
+                'shard_count': shard_count,
+                'shard_index': shard_index
+            }
+            if transfer_engine == 'asyncio':
+                import asyncio
+                asyncio.run(S3Helper.retrieve_files_from_manifest_file_async(manifest_s3url, dest,
+                                                                             requests_in_flight=requests_in_flight,
+                                                                             **retrieve_kwargs))
+            else:
+                S3Helper.retrieve_files_from_manifest_file(manifest_s3url, dest, **retrieve_kwargs)
             logging.debug('File retrieve action completed.')
             sys.exit(0)
 
         elif action == A_CAT_FILES.name:
-            S3Helper.retrieve_files_from_manifest_file(manifest_s3url, None, symmetric_key=symmetric_key, region=region)
+            S3Helper.retrieve_files_from_manifest_file(manifest_s3url, None, symmetric_key=symmetric_key, region=region,
+                                                       parallelism=parallelism, region_cache_file=region_cache_file,
+                                                       cache_dir=cache_dir, cache_max_bytes=cache_max_bytes,
+                                                       shard_outputs=list(shard_outputs), shard_count=shard_count,
+                                                       shard_index=shard_index, cpu_workers=cpu_workers or None)
             logging.debug('File cat action completed.')
             sys.exit(0)
     click.echo('Unsupported action: {a}'.format(a=action))
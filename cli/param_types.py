@@ -0,0 +1,25 @@
+from util.s3_file import S3File, InvalidS3PathException
+from util.symmetric_key import SymmetricKey
+import click
+
+
+class S3PathParamType(click.ParamType):
+    name = 's3-path'
+
+    def convert(self, value, param, ctx):
+        try:
+            return S3File(value)
+        except InvalidS3PathException as e:
+            self.fail('{val} is not a valid S3 path: {err}'.format(val=value, err=str(e)), param, ctx)
+
+
+class SymmetricKeyParamType(click.ParamType):
+    name = 'symmetric-key'
+
+    def convert(self, value, param, ctx):
+        try:
+            return SymmetricKey(value)
+        except Exception as e:
+            self.fail('{val} is not a valid base 64 encoded symmetric key: {err}'.format(val=value, err=str(e)),
+                      param,
+                      ctx)
@@ -12,6 +12,11 @@ setup(
         'boto3',
         'cryptography'
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'numpy': ['numpy'],
+        'asyncio': ['aiobotocore']
+    },
     packages=find_packages(),
     entry_points='''
         [console_scripts]
@@ -0,0 +1,21 @@
+from benchmark.fake_s3 import FakeS3Server
+from util.s3_client_registry import S3ClientRegistry
+from util.retry_policy import RetryPolicy
+import os
+import pytest
+
+
+@pytest.fixture(scope='module')
+def fake_s3():
+    environment_before = dict(os.environ)
+    os.environ.update({'AWS_ACCESS_KEY_ID': 'test', 'AWS_SECRET_ACCESS_KEY': 'test', 'AWS_DEFAULT_REGION': 'us-west-2'})
+    server = FakeS3Server().start()
+    S3ClientRegistry.configure(endpoint_url=server.get_endpoint_url())
+    # Hedged requests would change the request counts that tests assert on a busy machine
+    RetryPolicy.configure(min_hedge_delay=10.0)
+    yield server
+    server.stop()
+    S3ClientRegistry.reset()
+    RetryPolicy.reset()
+    os.environ.clear()
+    os.environ.update(environment_before)
@@ -0,0 +1,166 @@
+from benchmark.datasets import create_dataset, make_rows, BENCHMARK_SYMMETRIC_KEY
+from util.async_transfer_engine import AsyncTransferEngine, import_aiobotocore
+from util.s3_client_registry import S3ClientRegistry
+from util.s3_helper import S3Helper
+from util.s3_file import S3File
+from util.symmetric_key import SymmetricKey
+from util.sync_state import SYNC_STATE_FILE_NAME
+import asyncio
+import contextlib
+import importlib.util
+import os
+import pytest
+import tempfile
+
+PART_SIZES = [5000, 100, 20000, 1, 0]
+
+
+class ThreadedAsyncBody:
+    def __init__(self, body, truncated=False):
+        self.body = body
+        self.truncated = truncated
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.body.close()
+        return False
+
+    async def read(self):
+        data = await asyncio.to_thread(self.body.read)
+        if self.truncated:
+            return data[:-1]
+        return data
+
+
+class ThreadedAsyncClient:
+    """
+    The subset of the aiobotocore S3 client used by the engine, on top of a boto3 client.  It counts the ranged GETs
+    and can fail some of them or return them truncated.
+    """
+    def __init__(self, client, failures=0, truncated=False):
+        self.client = client
+        self.failures = failures
+        self.truncated = truncated
+        self.get_count = 0
+        self.requested_keys = []
+
+    async def head_object(self, **kwargs):
+        return await asyncio.to_thread(self.client.head_object, **kwargs)
+
+    async def get_object(self, **kwargs):
+        self.get_count += 1
+        self.requested_keys.append(kwargs['Key'])
+        if self.get_count <= self.failures:
+            raise(IOError('failure {n}'.format(n=self.get_count)))
+        response = await asyncio.to_thread(self.client.get_object, **kwargs)
+        response['Body'] = ThreadedAsyncBody(response['Body'], truncated=self.truncated)
+        return response
+
+
+def get_threaded_client_factory(clients, failures=0, truncated=False):
+    @contextlib.asynccontextmanager
+    async def create_client(region):
+        client = ThreadedAsyncClient(S3ClientRegistry.get_client(region), failures=failures, truncated=truncated)
+        clients.append(client)
+        yield client
+    return create_client
+
+
+def retrieve_manifest(manifest_url, target_path, async_engine, **kwargs):
+    asyncio.run(S3Helper.retrieve_files_from_manifest_file_async(S3File(manifest_url), target_path,
+                                                                 async_engine=async_engine, **kwargs))
+    contents = []
+    for file_name in sorted(os.listdir(target_path)):
+        if file_name != SYNC_STATE_FILE_NAME:
+            with open(os.path.join(target_path, file_name), 'rb') as local_file:
+                contents.append(local_file.read())
+    return contents
+
+
+def test_files_are_retrieved_with_ranges_on_one_event_loop(fake_s3):
+    dataset = create_dataset(fake_s3, 'async-plain', PART_SIZES, verbose=False)
+    clients = []
+    async_engine = AsyncTransferEngine(max_requests_in_flight=8, bytes_per_fetch=1000,
+                                       client_factory=get_threaded_client_factory(clients))
+    temp_dir = tempfile.TemporaryDirectory()
+    contents = retrieve_manifest(dataset.manifest_url, temp_dir.name, async_engine)
+    assert [make_rows(part_size, seed=index) for index, part_size in enumerate(PART_SIZES)] == contents
+    assert 1 == len(clients)
+    assert sum((len(content) + 999) // 1000 for content in contents) == clients[0].get_count
+
+
+def test_encrypted_files_are_decrypted_and_failed_ranges_retried(fake_s3):
+    dataset = create_dataset(fake_s3, 'async-encrypted', PART_SIZES, encrypted=True)
+    clients = []
+    async_engine = AsyncTransferEngine(bytes_per_fetch=512, client_factory=get_threaded_client_factory(clients,
+                                                                                                      failures=2))
+    temp_dir = tempfile.TemporaryDirectory()
+    contents = retrieve_manifest(dataset.manifest_url, temp_dir.name, async_engine,
+                                 symmetric_key=SymmetricKey(BENCHMARK_SYMMETRIC_KEY))
+    assert [make_rows(part_size, seed=index) for index, part_size in enumerate(PART_SIZES)] == contents
+    assert len(os.listdir(temp_dir.name)) == len(PART_SIZES)
+
+
+def test_failed_decryption_is_raised_without_local_file(fake_s3):
+    dataset = create_dataset(fake_s3, 'async-wrong-key', PART_SIZES, encrypted=True)
+    async_engine = AsyncTransferEngine(client_factory=get_threaded_client_factory([]))
+    temp_dir = tempfile.TemporaryDirectory()
+    with pytest.raises(Exception):
+        retrieve_manifest(dataset.manifest_url, temp_dir.name, async_engine,
+                          symmetric_key=SymmetricKey(b'\x01' * 32, base_64_encoded=False))
+    # The encrypted object must not be stored as if it was the plaintext, nor a partial or temporary file
+    assert [] == os.listdir(temp_dir.name)
+
+
+def test_sync_with_the_asyncio_engine_only_retrieves_changed_files(fake_s3):
+    dataset = create_dataset(fake_s3, 'async-sync', PART_SIZES, verbose=False)
+    clients = []
+    async_engine = AsyncTransferEngine(client_factory=get_threaded_client_factory(clients))
+    temp_dir = tempfile.TemporaryDirectory()
+    contents = retrieve_manifest(dataset.manifest_url, temp_dir.name, async_engine, sync=True)
+    get_count = sum(client.get_count for client in clients)
+    assert get_count == len([content for content in contents if len(content) > 0])
+    assert os.path.isfile(os.path.join(temp_dir.name, SYNC_STATE_FILE_NAME))
+    retrieve_manifest(dataset.manifest_url, temp_dir.name, async_engine, sync=True)
+    assert get_count == sum(client.get_count for client in clients)
+
+
+def test_failed_sync_keeps_the_previous_local_file(fake_s3):
+    dataset = create_dataset(fake_s3, 'async-failed', PART_SIZES, verbose=False)
+    temp_dir = tempfile.TemporaryDirectory()
+    contents = retrieve_manifest(dataset.manifest_url, temp_dir.name,
+                                 AsyncTransferEngine(client_factory=get_threaded_client_factory([])), sync=True)
+    fake_s3.put_object('benchmark', 'async-failed/async-failed0000_part_00', b'changed\n' * 1000)
+    with pytest.raises(Exception, match='Expected'):
+        retrieve_manifest(dataset.manifest_url, temp_dir.name,
+                          AsyncTransferEngine(client_factory=get_threaded_client_factory([], truncated=True)),
+                          sync=True)
+    # Neither a partial local file nor a temporary file is left behind, and the next sync retrieves the file
+    assert len(PART_SIZES) + 1 == len(os.listdir(temp_dir.name))
+    with open(os.path.join(temp_dir.name, 'async-failed0000_part_00'), 'rb') as local_file:
+        assert contents[0] == local_file.read()
+    contents = retrieve_manifest(dataset.manifest_url, temp_dir.name,
+                                 AsyncTransferEngine(client_factory=get_threaded_client_factory([])), sync=True)
+    assert b'changed\n' * 1000 == contents[0]
+
+
+def test_files_are_taken_from_the_queue_biggest_first(fake_s3):
+    dataset = create_dataset(fake_s3, 'async-ordered', PART_SIZES, verbose=False)
+    clients = []
+    async_engine = AsyncTransferEngine(max_files_in_flight=1, client_factory=get_threaded_client_factory(clients))
+    temp_dir = tempfile.TemporaryDirectory()
+    retrieve_manifest(dataset.manifest_url, temp_dir.name, async_engine)
+    expected_keys = ['async-ordered/async-ordered{i:04d}_part_00'.format(i=index)
+                     for index in sorted(range(len(PART_SIZES)), key=lambda index: -PART_SIZES[index])
+                     if len(make_rows(PART_SIZES[index], seed=index)) > 0]
+    assert expected_keys == clients[0].requested_keys
+
+
+@pytest.mark.skipif(importlib.util.find_spec('aiobotocore') is not None, reason='aiobotocore is installed')
+def test_missing_aiobotocore_gives_a_clear_error():
+    with pytest.raises(Exception, match='pip install aiobotocore'):
+        import_aiobotocore()
+    with pytest.raises(Exception, match='pip install aiobotocore'):
+        AsyncTransferEngine()
@@ -0,0 +1,35 @@
+from util.bucket_region_cache import BucketRegionCache
+from util.s3_file import S3File
+import os
+import tempfile
+
+
+def test_region_is_looked_up_once_per_bucket():
+    lookups = []
+
+    def lookup_region():
+        lookups.append(1)
+        return 'eu-west-1'
+
+    region_cache = BucketRegionCache()
+    assert region_cache.get_cached_region('manifest-tools') is None
+    assert 'eu-west-1' == region_cache.get_region('manifest-tools', lookup_region)
+    assert 'eu-west-1' == region_cache.get_region('manifest-tools', lookup_region)
+    assert 1 == len(lookups)
+
+
+def test_region_cache_is_persisted():
+    temp_dir = tempfile.TemporaryDirectory()
+    cache_file = os.path.join(temp_dir.name, 'regions.json')
+    region_cache = BucketRegionCache(cache_file)
+    region_cache.set_region('manifest-tools-euw1', 'eu-west-1')
+    region_cache.save()
+    assert 'eu-west-1' == BucketRegionCache(cache_file).get_cached_region('manifest-tools-euw1')
+
+
+def test_s3_file_uses_cached_region():
+    region_cache = BucketRegionCache()
+    region_cache.set_region('manifest-tools-euw1', 'eu-west-1')
+    s3_file = S3File('s3://manifest-tools-euw1/test_manifest/file1', region_cache=region_cache)
+    assert 'eu-west-1' == s3_file.get_s3_connection().meta.region_name
+    assert 'eu-west-1' == s3_file.get_region()
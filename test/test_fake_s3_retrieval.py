@@ -0,0 +1,343 @@
+from benchmark.datasets import create_dataset, make_rows, BENCHMARK_SYMMETRIC_KEY
+from util.s3_helper import S3Helper
+from util.s3_file import S3File
+from util.symmetric_key import SymmetricKey
+from util.file_cryptor import EnvelopeFileCryptor
+from util.s3_file_transfer import S3FileTransfer
+from util.transfer_journal import TransferJournal, JOURNAL_FILE_NAME
+from util.instrumentation import Instrumentation
+import json
+import os
+import pytest
+import sys
+import tempfile
+
+PART_SIZES = [5000, 100, 20000, 1]
+
+
+def get_expected_plaintext():
+    return [make_rows(part_size, seed=index) for index, part_size in enumerate(PART_SIZES)]
+
+
+def cat_manifest(manifest_url, **kwargs):
+    temp_dir = tempfile.TemporaryDirectory()
+    temp_file = os.path.join(temp_dir.name, 'cat_output')
+    with open(temp_file, 'wb') as temp_file_handle:
+        S3Helper.set_stdout(temp_file_handle)
+        try:
+            S3Helper.retrieve_files_from_manifest_file(S3File(manifest_url), None, **kwargs)
+        finally:
+            S3Helper.set_stdout(sys.stdout)
+    with open(temp_file, 'rb') as temp_file_handle:
+        return temp_file_handle.read()
+
+
+def retrieve_manifest(manifest_url, **kwargs):
+    temp_dir = tempfile.TemporaryDirectory()
+    S3Helper.retrieve_files_from_manifest_file(S3File(manifest_url), temp_dir.name, **kwargs)
+    contents = []
+    for file_name in sorted(os.listdir(temp_dir.name)):
+        with open(os.path.join(temp_dir.name, file_name), 'rb') as local_file:
+            contents.append(local_file.read())
+    return contents
+
+
+class FlakyClient:
+    """
+    S3 client of which the first failures GETs fail.
+    """
+    def __init__(self, client, failures):
+        self.client = client
+        self.failures = failures
+        self.get_count = 0
+
+    def get_object(self, **kwargs):
+        self.get_count += 1
+        if self.get_count <= self.failures:
+            raise(IOError('failure {n}'.format(n=self.get_count)))
+        return self.client.get_object(**kwargs)
+
+
+def test_single_get_of_small_file_is_retried(fake_s3):
+    create_dataset(fake_s3, 'single-get', PART_SIZES, verbose=False)
+    content = make_rows(PART_SIZES[0], seed=0)
+    s3_file = S3File('s3://benchmark/single-get/single-get0000_part_00', content_length=len(content))
+    flaky_client = FlakyClient(s3_file.get_s3_connection(), failures=2)
+    s3_file.s3 = flaky_client
+    temp_dir = tempfile.TemporaryDirectory()
+    local_file = os.path.join(temp_dir.name, 'part')
+    s3_file.download_file(local_file)
+    assert 3 == flaky_client.get_count
+    with open(local_file, 'rb') as local_file_handle:
+        assert content == local_file_handle.read()
+
+
+def test_retrieve_files_concurrently(fake_s3):
+    dataset = create_dataset(fake_s3, 'plain', PART_SIZES, verbose=False)
+    assert get_expected_plaintext() == retrieve_manifest(dataset.manifest_url, parallelism=3)
+
+
+def test_cat_gzip_files_bigger_than_fetch_size_with_read_ahead(fake_s3):
+    dataset = create_dataset(fake_s3, 'gzipped', PART_SIZES, codec='gzip')
+    for parallelism in [1, 4]:
+        output = cat_manifest(dataset.manifest_url, parallelism=parallelism, bytes_per_fetch=100)
+        assert b''.join(get_expected_plaintext()) == output
+
+
+def test_cat_schedules_big_files_over_all_requests_in_flight_by_default(fake_s3):
+    dataset = create_dataset(fake_s3, 'plain', PART_SIZES, verbose=False)
+    with S3Helper.prepare_manifest_retrieval(S3File(dataset.manifest_url), None, parallelism=8) as (_, retrieve_kwargs):
+        transfer_config = retrieve_kwargs['transfer_scheduler'].get_transfer_config(1024 * 1024 * 1024)
+    assert transfer_config.concurrency == 8
+
+
+def test_cat_encrypted_files(fake_s3):
+    dataset = create_dataset(fake_s3, 'encrypted-cat', PART_SIZES, encrypted=True)
+    output = cat_manifest(dataset.manifest_url, symmetric_key=SymmetricKey(BENCHMARK_SYMMETRIC_KEY), parallelism=2,
+                          bytes_per_fetch=1000)
+    assert b''.join(get_expected_plaintext()) == output
+
+
+def test_cat_encrypted_gzip_files_in_worker_processes(fake_s3):
+    dataset = create_dataset(fake_s3, 'encrypted-gzip-workers', PART_SIZES, codec='gzip', encrypted=True)
+    output = cat_manifest(dataset.manifest_url, symmetric_key=SymmetricKey(BENCHMARK_SYMMETRIC_KEY), parallelism=2,
+                          bytes_per_fetch=1000, cpu_workers=2)
+    assert b''.join(get_expected_plaintext()) == output
+
+
+def test_retrieve_encrypted_files(fake_s3):
+    dataset = create_dataset(fake_s3, 'encrypted-retrieve', PART_SIZES, encrypted=True)
+    symmetric_key = SymmetricKey(BENCHMARK_SYMMETRIC_KEY)
+    assert get_expected_plaintext() == retrieve_manifest(dataset.manifest_url, symmetric_key=symmetric_key)
+    assert get_expected_plaintext() == retrieve_manifest(dataset.manifest_url, symmetric_key=symmetric_key,
+                                                         decrypt_workers=2, decrypt_segment_size=1024)
+
+
+def test_failed_retrieval_of_encrypted_file_is_raised_without_local_file(fake_s3, monkeypatch):
+    dataset = create_dataset(fake_s3, 'encrypted-failed', PART_SIZES, encrypted=True)
+    get_range = S3File.get_range
+
+    def get_range_failing_for_parts(s3_file, s3_byte_range):
+        if '_part_' in s3_file.get_key():
+            raise(IOError('Connection reset'))
+        return get_range(s3_file, s3_byte_range)
+
+    monkeypatch.setattr(S3File, 'get_range', get_range_failing_for_parts)
+    temp_dir = tempfile.TemporaryDirectory()
+    with pytest.raises(IOError, match='Connection reset'):
+        S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), temp_dir.name,
+                                                   symmetric_key=SymmetricKey(BENCHMARK_SYMMETRIC_KEY))
+    assert [] == os.listdir(temp_dir.name)
+
+
+def read_local_files(directory):
+    contents = []
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.startswith('.'):
+            with open(os.path.join(directory, file_name), 'rb') as local_file:
+                contents.append(local_file.read())
+    return contents
+
+
+def test_resume_only_fetches_missing_ranges(fake_s3):
+    dataset = create_dataset(fake_s3, 'resumed', PART_SIZES, verbose=False)
+    temp_dir = tempfile.TemporaryDirectory()
+    S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), temp_dir.name, resume=True,
+                                               bytes_per_fetch=1000)
+    assert get_expected_plaintext() == read_local_files(temp_dir.name)
+
+    # Simulate an interruption while the third part was being written: its last ranges are missing
+    journal_path = os.path.join(temp_dir.name, JOURNAL_FILE_NAME)
+    with open(journal_path, 'r') as journal_file:
+        records = [json.loads(line) for line in journal_file]
+    third_file = sorted(record['file'] for record in records if record['type'] == 'file')[2]
+    kept = [record for record in records
+            if record['file'] != third_file or (record['type'] == 'range' and record['lower_bound'] < 15000)]
+    with open(journal_path, 'w') as journal_file:
+        journal_file.writelines(json.dumps(record) + '\n' for record in kept)
+    third_file_path = os.path.join(temp_dir.name, third_file)
+    with open(third_file_path, 'r+b') as local_file:
+        local_file.seek(15000)
+        local_file.write(b'\0' * (os.path.getsize(third_file_path) - 15000))
+
+    requests_before = fake_s3.request_count
+    S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), temp_dir.name, resume=True,
+                                               bytes_per_fetch=1000)
+    assert get_expected_plaintext() == read_local_files(temp_dir.name)
+    # HEAD and GET of the manifest, the listing and the 5 missing ranges
+    assert 8 == fake_s3.request_count - requests_before
+
+
+def test_resume_takes_the_etags_from_the_listing(fake_s3):
+    dataset = create_dataset(fake_s3, 'resumed-verbose', PART_SIZES)
+    temp_dir = tempfile.TemporaryDirectory()
+    requests_before = fake_s3.request_count
+    S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), temp_dir.name, resume=True,
+                                               bytes_per_fetch=1000)
+    assert get_expected_plaintext() == read_local_files(temp_dir.name)
+    # HEAD and GET of the manifest, the listing and the ranges, no HEAD per part
+    assert 3 + sum((part_size + 999) // 1000 for part_size in map(len, get_expected_plaintext())) == \
+        fake_s3.request_count - requests_before
+
+
+def test_failed_resumable_download_keeps_the_ranges_it_wrote(fake_s3, monkeypatch):
+    create_dataset(fake_s3, 'resumed-failed', PART_SIZES, verbose=False)
+    temp_dir = tempfile.TemporaryDirectory()
+    journal = TransferJournal(temp_dir.name)
+    s3_transfer = S3FileTransfer(S3File('s3://benchmark/resumed-failed/resumed-failed0002_part_00'),
+                                 os.path.join(temp_dir.name, 'part'))
+    get_range = S3File.get_range
+
+    def get_range_failing_at_10000(s3_file, s3_byte_range):
+        if s3_byte_range.lower_bound == 10000:
+            raise(IOError('Connection reset'))
+        return get_range(s3_file, s3_byte_range)
+
+    monkeypatch.setattr(S3File, 'get_range', get_range_failing_at_10000)
+    with pytest.raises(IOError, match='Connection reset'):
+        s3_transfer.download_resumable(journal, bytes_per_fetch=1000, requests_in_flight=4)
+    s3_file = s3_transfer.get_s3_file()
+    completed_ranges = journal.get_completed_ranges(s3_transfer.get_local_file(), s3_file.get_etag(),
+                                                    s3_file.get_size())
+    assert {(lower_bound, lower_bound + 999) for lower_bound in range(0, 10000, 1000)} <= completed_ranges
+    assert (10000, 10999) not in completed_ranges
+
+    monkeypatch.undo()
+    requests_before = fake_s3.request_count
+    s3_transfer.download_resumable(journal, bytes_per_fetch=1000, requests_in_flight=4)
+    assert (s3_file.get_size() + 999) // 1000 - len(completed_ranges) == fake_s3.request_count - requests_before
+    assert [get_expected_plaintext()[2]] == read_local_files(temp_dir.name)
+
+
+def test_resume_encrypted_files_per_part(fake_s3):
+    dataset = create_dataset(fake_s3, 'resumed-encrypted', PART_SIZES, encrypted=True)
+    symmetric_key = SymmetricKey(BENCHMARK_SYMMETRIC_KEY)
+    temp_dir = tempfile.TemporaryDirectory()
+    for _ in range(2):
+        S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), temp_dir.name, resume=True,
+                                                   symmetric_key=symmetric_key)
+        assert get_expected_plaintext() == read_local_files(temp_dir.name)
+
+
+def test_sync_only_fetches_changed_parts(fake_s3):
+    dataset = create_dataset(fake_s3, 'synced', PART_SIZES)
+    temp_dir = tempfile.TemporaryDirectory()
+    S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), temp_dir.name, sync=True)
+    assert get_expected_plaintext() == read_local_files(temp_dir.name)
+
+    requests_before = fake_s3.request_count
+    S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), temp_dir.name, sync=True)
+    # HEAD and GET of the manifest and the listing for the ETags
+    assert 3 == fake_s3.request_count - requests_before
+
+    # The next UNLOAD has one part less and one changed part
+    dataset = create_dataset(fake_s3, 'synced', PART_SIZES[:3])
+    fake_s3.put_object('benchmark', 'synced/synced0001_part_00', b'changed\n')
+    requests_before = fake_s3.request_count
+    S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), temp_dir.name, sync=True, delete=True)
+    expected = get_expected_plaintext()[:3]
+    expected[1] = b'changed\n'
+    assert expected == read_local_files(temp_dir.name)
+    assert 4 == fake_s3.request_count - requests_before
+
+
+def test_sync_adopts_untracked_files_only_if_their_content_matches(fake_s3):
+    dataset = create_dataset(fake_s3, 'adopted', PART_SIZES, verbose=False)
+    temp_dir = tempfile.TemporaryDirectory()
+    S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), temp_dir.name)
+    # A file of an interrupted retrieval has the right size and is newer than the S3 object
+    zero_filled_file = os.path.join(temp_dir.name, 'adopted0002_part_00')
+    with open(zero_filled_file, 'wb') as local_file:
+        local_file.write(bytes(len(get_expected_plaintext()[2])))
+
+    requests_before = fake_s3.request_count
+    S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), temp_dir.name, sync=True)
+    assert get_expected_plaintext() == read_local_files(temp_dir.name)
+    # HEAD and GET of the manifest, the listing for the ETags and the GET of the zero-filled part
+    assert 4 == fake_s3.request_count - requests_before
+
+
+def test_retrieve_and_cat_through_part_cache(fake_s3):
+    dataset = create_dataset(fake_s3, 'cached', PART_SIZES, codec='gzip')
+    cache_dir = tempfile.TemporaryDirectory()
+    expected_objects = [fake_s3.objects[('benchmark', 'cached/cached{i:04d}_part_00.gz'.format(i=index))].data
+                        for index in range(len(PART_SIZES))]
+    assert expected_objects == retrieve_manifest(dataset.manifest_url, cache_dir=cache_dir.name, parallelism=2)
+
+    requests_before = fake_s3.request_count
+    assert expected_objects == retrieve_manifest(dataset.manifest_url, cache_dir=cache_dir.name)
+    output = cat_manifest(dataset.manifest_url, cache_dir=cache_dir.name, parallelism=2, bytes_per_fetch=1000)
+    assert b''.join(get_expected_plaintext()) == output
+    # Only HEAD, GET and listing of the manifest for both runs
+    assert 6 == fake_s3.request_count - requests_before
+
+
+def test_failed_decryption_from_part_cache_is_raised_without_local_file(fake_s3, monkeypatch):
+    dataset = create_dataset(fake_s3, 'cached-encrypted', PART_SIZES, encrypted=True)
+    symmetric_key = SymmetricKey(BENCHMARK_SYMMETRIC_KEY)
+    cache_dir = tempfile.TemporaryDirectory()
+    temp_dir = tempfile.TemporaryDirectory()
+
+    def decrypt_file_failing_halfway(cryptor, input_file, output_file):
+        with open(output_file, 'wb') as out_file:
+            out_file.write(b'partial')
+        raise(IOError('Decryption failed'))
+
+    monkeypatch.setattr(EnvelopeFileCryptor, 'decrypt_file', decrypt_file_failing_halfway)
+    with pytest.raises(IOError, match='Decryption failed'):
+        S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), temp_dir.name, sync=True,
+                                                   cache_dir=cache_dir.name, symmetric_key=symmetric_key)
+    assert [] == read_local_files(temp_dir.name)
+
+    monkeypatch.undo()
+    S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), temp_dir.name, sync=True,
+                                               cache_dir=cache_dir.name, symmetric_key=symmetric_key)
+    assert get_expected_plaintext() == read_local_files(temp_dir.name)
+
+
+def test_cat_sharded_over_files_and_file_descriptors(fake_s3):
+    dataset = create_dataset(fake_s3, 'sharded', PART_SIZES, codec='gzip')
+    temp_dir = tempfile.TemporaryDirectory()
+    shard_file = os.path.join(temp_dir.name, 'shard0')
+    read_fd, write_fd = os.pipe()
+    with open(read_fd, 'rb') as pipe:
+        S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), None, parallelism=2,
+                                                   shard_outputs=[shard_file, 'fd:{n}'.format(n=write_fd)])
+        pipe_content = pipe.read()
+    with open(shard_file, 'rb') as shard:
+        file_content = shard.read()
+    # The biggest part goes to the first output, the others to the second in manifest order
+    expected = get_expected_plaintext()
+    assert expected[2] == file_content
+    assert expected[0] + expected[1] + expected[3] == pipe_content
+
+
+def test_shards_of_nodes_cover_the_manifest_once(fake_s3):
+    dataset = create_dataset(fake_s3, 'multi-node', [5000, 100, 20000, 1, 7000, 6000], verbose=False)
+    temp_dir = tempfile.TemporaryDirectory()
+    node_files = []
+    for shard_index in range(3):
+        node_dir = os.path.join(temp_dir.name, 'node{i}'.format(i=shard_index))
+        S3Helper.retrieve_files_from_manifest_file(S3File(dataset.manifest_url), node_dir, shard_index=shard_index,
+                                                   shard_count=3)
+        node_files.append(sorted(os.listdir(node_dir)))
+    all_files = sorted(file_name for file_names in node_files for file_name in file_names)
+    assert ['multi-node{i:04d}_part_00'.format(i=index) for index in range(6)] == all_files
+    # The biggest part is a shard on its own
+    assert ['multi-node0002_part_00'] in node_files
+
+
+def test_instrumentation_records_the_stages_of_a_run(fake_s3):
+    dataset = create_dataset(fake_s3, 'instrumented', PART_SIZES, encrypted=True)
+    Instrumentation.enable()
+    try:
+        output = cat_manifest(dataset.manifest_url, symmetric_key=SymmetricKey(BENCHMARK_SYMMETRIC_KEY),
+                              bytes_per_fetch=1000)
+        stages = Instrumentation.get_summary()['stages']
+    finally:
+        Instrumentation.reset()
+    assert b''.join(get_expected_plaintext()) == output
+    assert {'manifest.get', 's3.get_range', 's3.fetch_range', 'crypto.decrypt', 'crypto.decrypt_data_key',
+            'stream.process', 'sink.write'} <= set(stages.keys())
+    assert len(output) == stages['sink.write']['bytes']
+    assert stages['s3.fetch_range']['bytes'] == stages['crypto.decrypt']['bytes']
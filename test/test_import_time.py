@@ -0,0 +1,24 @@
+from benchmark.import_time import measure_wall_time, get_loaded_heavy_modules, DEFAULT_BUDGET_MS, REPOSITORY_ROOT
+import subprocess
+import sys
+
+
+def test_cli_does_not_load_heavy_modules_at_startup():
+    assert [] == get_loaded_heavy_modules()
+
+
+def test_cli_import_time_is_within_budget():
+    # Relative to a bare interpreter so a slow or busy machine moves both timings; the budget is only exceeded when
+    # importing the CLI costs about as much as starting Python on top of DEFAULT_BUDGET_MS
+    startup_ms = measure_wall_time('pass')
+    assert measure_wall_time('import cli.cli') - startup_ms <= startup_ms + DEFAULT_BUDGET_MS
+
+
+def test_list_actions_runs_without_loading_boto3():
+    code = 'import sys; sys.argv = ["redshift-manifest-tools", "--action", "list-actions"]\n' \
+           'import atexit; atexit.register(lambda: print("boto3" in sys.modules))\n' \
+           'from cli.cli import cli_main; cli_main()'
+    output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, universal_newlines=True,
+                            cwd=REPOSITORY_ROOT).stdout
+    assert 'cat-files' in output
+    assert output.strip().endswith('False')
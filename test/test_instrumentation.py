@@ -0,0 +1,67 @@
+from util.instrumentation import Instrumentation, Histogram, NULL_MEASUREMENT
+import json
+import os
+import pytest
+import tempfile
+
+
+@pytest.fixture
+def instrumentation():
+    Instrumentation.reset()
+    Instrumentation.enable()
+    yield Instrumentation
+    Instrumentation.reset()
+
+
+def test_nothing_is_recorded_when_disabled():
+    Instrumentation.reset()
+    assert NULL_MEASUREMENT is Instrumentation.measure('s3.head')
+    with Instrumentation.measure('s3.head') as measurement:
+        measurement.add_bytes(10)
+    Instrumentation.count('s3.retry')
+    assert {'stages': {}, 'events': {}} == Instrumentation.get_summary()
+
+
+def test_stages_and_events_are_summarized(instrumentation):
+    for _ in range(3):
+        with instrumentation.measure('s3.get_range') as measurement:
+            measurement.add_bytes(100)
+    with pytest.raises(IOError):
+        with instrumentation.measure('s3.get_range'):
+            raise(IOError('connection reset'))
+    instrumentation.count('s3.retry')
+    instrumentation.count('s3.retry')
+    summary = instrumentation.get_summary()
+    stage = summary['stages']['s3.get_range']
+    assert (4, 1, 300) == (stage['count'], stage['errors'], stage['bytes'])
+    assert stage['seconds_min'] <= stage['seconds_p50'] <= stage['seconds_max']
+    assert {'s3.retry': 2} == summary['events']
+
+
+def test_histogram_percentiles():
+    histogram = Histogram()
+    for value in [0.0005] * 90 + [0.5] * 9 + [200.0]:
+        histogram.observe(value)
+    assert 0.001 == histogram.get_percentile(50)
+    assert 0.512 == histogram.get_percentile(99)
+    assert 200.0 == histogram.get_percentile(100)
+    assert (float('inf'), 100) == histogram.get_cumulative_counts()[-1]
+
+
+def test_write_json_and_prometheus(instrumentation):
+    instrumentation.record('crypto.decrypt', 0.003, byte_count=4096)
+    instrumentation.count('s3.hedge')
+    temp_dir = tempfile.TemporaryDirectory()
+    json_file = os.path.join(temp_dir.name, 'metrics.json')
+    instrumentation.write(json_file)
+    with open(json_file) as json_file_handle:
+        assert 4096 == json.load(json_file_handle)['stages']['crypto.decrypt']['bytes']
+    prometheus_file = os.path.join(temp_dir.name, 'metrics.prom')
+    instrumentation.write(prometheus_file)
+    with open(prometheus_file) as prometheus_file_handle:
+        lines = prometheus_file_handle.read().splitlines()
+    assert 'redshift_manifest_tools_stage_seconds_bucket{stage="crypto.decrypt",le="0.004"} 1' in lines
+    assert 'redshift_manifest_tools_stage_seconds_bucket{stage="crypto.decrypt",le="+Inf"} 1' in lines
+    assert 'redshift_manifest_tools_stage_bytes_total{stage="crypto.decrypt"} 4096' in lines
+    assert 'redshift_manifest_tools_events_total{event="s3.hedge"} 1' in lines
+    assert ['metrics.json', 'metrics.prom'] == sorted(os.listdir(temp_dir.name))
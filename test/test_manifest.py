@@ -1,6 +1,10 @@
-from util.manifest import Manifest
+from benchmark.manifest_operations import run_manifest_operations
+from util.manifest import Manifest, ManifestJsonParser
 from util.s3_file import S3File
+import io
+import json
 import os
+import pytest
 
 
 def test_manifest_in_logic_and_lengths():
@@ -56,3 +60,74 @@ def test_common_path_prefix_in_manifest():
     manifest.add_s3file(S3File('s3://manifest-tools2/path/to/another/file'))
     assert 's3://' == manifest.get_common_path_prefix(),\
         'Adding files with different bucket should only return common path prefix (s3://)'
+
+
+def test_manifest_verbose_meta_is_kept():
+    manifest_json_string = '''{
+      "entries": [
+        {"url": "s3://manifest-tools/verbose/unload0000_part_00", "meta": {"content_length": 502, "record_count": 3}},
+        {"url": "s3://manifest-tools/verbose/unload0001_part_00", "meta": {"content_length": 0, "record_count": 0}}
+      ],
+      "schema": {"elements": [{"name": "id", "type": {"base": "integer"}}]},
+      "meta": {"content_length": 502, "record_count": 3}
+    }'''
+    manifest = Manifest(manifest_json_string=manifest_json_string)
+    assert [502, 0] == [s3file.get_size() for s3file in manifest.s3_files], 'Sizes must be known without HEAD'
+    assert [3, 0] == [s3file.get_record_count() for s3file in manifest.s3_files]
+    manifest.prefetch_metadata()
+
+
+def test_streaming_parser_gives_the_same_result_for_any_chunk_size():
+    document = {
+        'author': {'name': 'unload'}, 'version': 12.5,
+        'entries': [{'url': 's3://manifest-tools/unload/part_{i:04d}'.format(i=index), 'mandatory': True,
+                     'meta': {'content_length': 10 ** index, 'record_count': index}} for index in range(12)],
+        'schema': {'elements': [{'name': 'id', 'type': {'base': 'integer'}}]},
+        'count': 12345
+    }
+    manifest_json_string = json.dumps(document, indent=1)
+    for chunk_size in [1, 2, 7, 64, len(manifest_json_string)]:
+        chunks = [manifest_json_string[offset:offset + chunk_size]
+                  for offset in range(0, len(manifest_json_string), chunk_size)]
+        items = list(ManifestJsonParser(chunks))
+        assert document['entries'] == [value for key, value in items if key == 'entries']
+        assert {'author': document['author'], 'version': 12.5, 'schema': document['schema'], 'count': 12345} == \
+            {key: value for key, value in items if key != 'entries'}
+    assert [] == list(ManifestJsonParser(['{"entries": [ ]}'])) + list(ManifestJsonParser(['{}']))
+    with pytest.raises(ValueError):
+        list(ManifestJsonParser(['{"entries": [{"url": "s3://a/b"}']))
+
+
+def test_s3_files_are_created_on_first_use():
+    manifest_json = {'entries': [{'url': 's3://manifest-tools/lazy/part_{i}'.format(i=index),
+                                  'meta': {'content_length': index, 'record_count': 1}} for index in range(1000)]}
+    manifest = Manifest(manifest_stream=io.BytesIO(json.dumps(manifest_json).encode('utf-8')))
+    manifest.prefetch_metadata()
+    assert 1000 == len(manifest)
+    assert 's3://manifest-tools/lazy/' == manifest.get_common_path_prefix()
+    assert S3File('s3://manifest-tools/lazy/part_999') in manifest
+    assert 999 == manifest.get_size(999)
+    assert all(entry.s3_file is None for entry in manifest.entries)
+
+    s3file = manifest.s3_files[3]
+    assert manifest.s3_files[3] is s3file
+    assert (3, 'part_3') == (s3file.get_size(), s3file.get_s3_file_name())
+    assert 1 == sum(1 for entry in manifest.entries if entry.s3_file is not None)
+
+
+def test_s3files_hash_by_bucket_and_key_and_membership_uses_an_index():
+    assert 2 == len({S3File('s3://manifest-tools/a'), S3File('manifest-tools', 'a'), S3File('s3://manifest-tools/b')})
+    manifest = Manifest(manifest_json_string=json.dumps({'entries': [{'url': 's3://manifest-tools/a'}]}))
+    assert S3File('s3://manifest-tools/a') in manifest
+    assert S3File('s3://manifest-tools/b') not in manifest
+    manifest.add_s3file(S3File('s3://manifest-tools/b'))
+    assert S3File('s3://manifest-tools/b') in manifest
+    assert S3File('s3://manifest-tools/b') in manifest.s3_files
+    assert 0 == manifest.get_entry_index(S3File('manifest-tools', 'a'))
+
+
+def test_manifest_operations_benchmark():
+    results = run_manifest_operations(20000, lookup_count=1000)
+    assert (1000, 500, 0, 1000) == (results['lookups'], results['found'], results['duplicates'],
+                                    results['unique_s3files'])
+    assert 's3://benchmark-bucket/unload/2024/01/01/table/' == results['common_prefix']
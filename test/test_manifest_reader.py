@@ -0,0 +1,43 @@
+from benchmark.datasets import create_dataset, make_rows, BENCHMARK_SYMMETRIC_KEY
+from util.manifest_reader import ManifestReader
+from util.s3_file import S3File
+from util.symmetric_key import SymmetricKey
+import io
+
+PART_SIZES = [5000, 0, 20000, 1]
+
+
+def get_expected_parts():
+    return [make_rows(part_size, seed=index) for index, part_size in enumerate(PART_SIZES)]
+
+
+def test_read_concatenated_decompressed_content(fake_s3):
+    dataset = create_dataset(fake_s3, 'reader-gzip', PART_SIZES, codec='gzip')
+    with ManifestReader(S3File(dataset.manifest_url), parallelism=3, bytes_per_fetch=700) as reader:
+        assert b''.join(get_expected_parts()) == reader.readall()
+
+
+def test_readinto_and_readline_of_encrypted_content(fake_s3):
+    dataset = create_dataset(fake_s3, 'reader-encrypted', PART_SIZES, encrypted=True)
+    reader = ManifestReader(S3File(dataset.manifest_url), symmetric_key=SymmetricKey(BENCHMARK_SYMMETRIC_KEY),
+                            bytes_per_fetch=1000)
+    buffer = bytearray(333)
+    assert 333 == reader.readinto(buffer)
+    assert b''.join(get_expected_parts())[:333] == bytes(buffer)
+    lines = io.BufferedReader(reader).readlines()
+    assert b''.join(get_expected_parts())[333:] == b''.join(lines)
+    reader.close()
+    assert reader.closed
+
+
+def test_iterate_parts(fake_s3):
+    dataset = create_dataset(fake_s3, 'reader-parts', PART_SIZES, codec='bzip2')
+    expected_parts = get_expected_parts()
+    with ManifestReader(S3File(dataset.manifest_url), parallelism=2, bytes_per_fetch=500) as reader:
+        for part_index, (s3_file, part_reader) in enumerate(reader.iter_parts()):
+            assert str(s3_file).endswith('{i:04d}_part_00.bz2'.format(i=part_index))
+            if part_index == 0:
+                # Unread content of a part is skipped when the next part is read
+                assert expected_parts[0][:10] == part_reader.read(10)
+            else:
+                assert expected_parts[part_index] == part_reader.readall()
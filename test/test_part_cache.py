@@ -0,0 +1,91 @@
+from util.part_cache import PartCache
+import os
+import tempfile
+import time
+
+
+class LocalS3File(object):
+    def __init__(self, key, content, etag='"1"'):
+        self.key = key
+        self.content = content
+        self.etag = etag
+        self.downloads = 0
+
+    def get_bucket(self):
+        return 'manifest-tools'
+
+    def get_key(self):
+        return self.key
+
+    def get_etag(self):
+        return self.etag
+
+    def download_file(self, destination_path):
+        self.downloads += 1
+        with open(destination_path, 'wb') as destination_file:
+            destination_file.write(self.content)
+
+    def __str__(self):
+        return 's3://manifest-tools/{k}'.format(k=self.key)
+
+
+def test_part_is_downloaded_once_and_keyed_by_etag():
+    temp_dir = tempfile.TemporaryDirectory()
+    part_cache = PartCache(temp_dir.name)
+    s3_file = LocalS3File('unload/part_00', b'0|The secret is 42\n')
+    for _ in range(3):
+        with part_cache.get_cached_file(s3_file) as cached_file:
+            with open(cached_file, 'rb') as cached_file_handle:
+                assert s3_file.content == cached_file_handle.read()
+    assert 1 == s3_file.downloads
+    assert {'hits': 2, 'misses': 1} == part_cache.get_stats()
+
+    changed_s3_file = LocalS3File('unload/part_00', b'changed\n', etag='"2"')
+    with part_cache.get_cached_file(changed_s3_file) as cached_file:
+        with open(cached_file, 'rb') as cached_file_handle:
+            assert changed_s3_file.content == cached_file_handle.read()
+    assert 1 == changed_s3_file.downloads
+
+
+def test_reflink_or_copy_replaces_destination_without_sharing_the_entry():
+    temp_dir = tempfile.TemporaryDirectory()
+    part_cache = PartCache(os.path.join(temp_dir.name, 'cache'))
+    s3_file = LocalS3File('unload/part_00', b'0|The secret is 42\n')
+    destination = os.path.join(temp_dir.name, 'part_00')
+    with open(destination, 'wb') as destination_file:
+        destination_file.write(b'old content')
+    with part_cache.get_cached_file(s3_file) as cached_file:
+        assert PartCache.reflink_or_copy(cached_file, destination) in ['reflink', 'copy']
+        cached_mtime_ns = os.stat(cached_file).st_mtime_ns
+    with open(destination, 'rb') as destination_file:
+        assert s3_file.content == destination_file.read()
+    destination_mtime_ns = os.stat(destination).st_mtime_ns
+
+    # A hit does not touch the entry nor the local file, and the local file can be written
+    with part_cache.get_cached_file(s3_file) as cached_file:
+        assert cached_mtime_ns == os.stat(cached_file).st_mtime_ns
+    assert destination_mtime_ns == os.stat(destination).st_mtime_ns
+    with open(destination, 'wb') as destination_file:
+        destination_file.write(b'local change')
+    with part_cache.get_cached_file(s3_file) as cached_file:
+        with open(cached_file, 'rb') as cached_file_handle:
+            assert s3_file.content == cached_file_handle.read()
+
+
+def test_least_recently_used_parts_are_evicted():
+    temp_dir = tempfile.TemporaryDirectory()
+    part_cache = PartCache(temp_dir.name)
+    s3_files = [LocalS3File('unload/part_{i:02d}'.format(i=index), b'x' * 1000) for index in range(3)]
+    for s3_file in s3_files:
+        with part_cache.get_cached_file(s3_file):
+            pass
+        time.sleep(0.01)
+    # Using the first part makes the second one the least recently used
+    with part_cache.get_cached_file(s3_files[0]):
+        pass
+    # Another process with a size limit shares the same cache directory
+    part_cache = PartCache(temp_dir.name, max_bytes=2500)
+    assert 1000 == part_cache.evict()
+    assert part_cache.get_cached_file_if_present(s3_files[0]) is not None
+    assert part_cache.get_cached_file_if_present(s3_files[1]) is None
+    assert part_cache.get_cached_file_if_present(s3_files[2]) is not None
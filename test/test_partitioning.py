@@ -0,0 +1,23 @@
+from util.partitioning import assign_longest_processing_time_first, get_bin_weights
+import pytest
+
+
+def test_every_item_is_assigned_once_and_bins_are_balanced():
+    weights = [10, 3, 7, 7, 1, 2, 9, 4]
+    bins = assign_longest_processing_time_first(weights, 3)
+    assert list(range(len(weights))) == sorted(index for indices in bins for index in indices)
+    assert all(indices == sorted(indices) for indices in bins)
+    bin_weights = get_bin_weights(weights, bins)
+    assert sum(weights) == sum(bin_weights)
+    assert max(bin_weights) - min(bin_weights) <= 1
+
+
+def test_assignment_is_deterministic():
+    weights = [5] * 10 + [0, 0]
+    assert assign_longest_processing_time_first(weights, 4) == assign_longest_processing_time_first(weights, 4)
+    assert [[0], [], []] == assign_longest_processing_time_first([3], 3)
+
+
+def test_at_least_one_bin():
+    with pytest.raises(ValueError):
+        assign_longest_processing_time_first([1], 0)
@@ -0,0 +1,87 @@
+from util.process_pipeline import ProcessPipeline, get_chunks
+import bz2
+import gzip
+import os
+import pytest
+
+
+class NamedTransfer:
+    def __init__(self, key):
+        self.key = key
+
+
+def get_fragments(files, fragment_size):
+    for key, content in files:
+        if len(content) == 0:
+            yield NamedTransfer(key), b'', True
+        for offset in range(0, len(content), fragment_size):
+            yield NamedTransfer(key), content[offset:offset + fragment_size], offset + fragment_size >= len(content)
+
+
+def get_processor_arguments(s3_transfer):
+    return s3_transfer.key, True, None, None
+
+
+def get_shared_memory_blocks():
+    return set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+
+def get_files():
+    rows = [''.join('{f}|{i}|row\n'.format(f=index, i=i) for i in range(2000 * (index + 1))).encode('utf-8')
+            for index in range(5)]
+    files = [('part_0.gz', gzip.compress(rows[0])), ('part_1.bz2', bz2.compress(rows[1])), ('part_2', rows[2]),
+             ('part_3.gz', gzip.compress(b'')), ('part_4.gz', gzip.compress(rows[4]))]
+    return files, [rows[0], rows[1], rows[2], b'', rows[4]]
+
+
+def test_output_keeps_the_order_of_the_fragments_with_several_workers():
+    blocks_before = get_shared_memory_blocks()
+    files, expected = get_files()
+    pipeline = ProcessPipeline(workers=3, chunk_size=1000, chunks_in_flight=4)
+    outputs = {}
+    order = []
+    last_flags = []
+    for s3_transfer, output, is_last in pipeline.process(get_fragments(files, 3000), get_processor_arguments):
+        if s3_transfer.key not in outputs:
+            order.append(s3_transfer.key)
+            outputs[s3_transfer.key] = b''
+        outputs[s3_transfer.key] += output
+        if is_last:
+            last_flags.append(s3_transfer.key)
+    assert [key for key, _ in files] == order == last_flags
+    assert expected == [outputs[key] for key, _ in files]
+    assert blocks_before == get_shared_memory_blocks()
+
+
+@pytest.mark.parametrize('chunks_in_flight,outputs_in_flight', [(1, None), (1, 1), (3, 1), (2, 7)])
+def test_few_slots_still_make_progress(chunks_in_flight, outputs_in_flight):
+    files, expected = get_files()
+    pipeline = ProcessPipeline(workers=2, chunk_size=512, chunks_in_flight=chunks_in_flight,
+                               outputs_in_flight=outputs_in_flight)
+    output = b''.join(output for _, output, _ in pipeline.process(get_fragments(files, 2000), get_processor_arguments))
+    assert b''.join(expected) == output
+
+
+def test_chunks_that_are_passed_on_as_is_are_copied_out_of_the_slots():
+    blocks_before = get_shared_memory_blocks()
+    files, _ = get_files()
+    pipeline = ProcessPipeline(workers=2, chunk_size=700, chunks_in_flight=2, outputs_in_flight=3)
+    outputs = [output for _, output, _ in pipeline.process(get_fragments(files, 2500),
+                                                           lambda s3_transfer: (s3_transfer.key, False, None, None))]
+    assert all(isinstance(output, bytes) for output in outputs)
+    assert b''.join(content for _, content in files) == b''.join(outputs)
+    assert blocks_before == get_shared_memory_blocks()
+
+
+def test_errors_of_workers_are_raised_and_shared_memory_is_removed():
+    blocks_before = get_shared_memory_blocks()
+    files = [('part_0.gz', gzip.compress(b'valid\n')), ('part_1.gz', b'not gzip at all' * 100)]
+    pipeline = ProcessPipeline(workers=2, chunk_size=100)
+    with pytest.raises(Exception):
+        list(pipeline.process(get_fragments(files, 300), get_processor_arguments))
+    assert blocks_before == get_shared_memory_blocks()
+
+
+def test_chunks_cover_fragments():
+    assert [(0, 0)] == get_chunks(0, 10)
+    assert [(0, 10), (10, 10), (20, 5)] == get_chunks(25, 10)
@@ -0,0 +1,74 @@
+from benchmark.datasets import create_dataset, make_rows
+from util.record_batch_reader import RecordBatchReader
+from util.s3_file import S3File
+import io
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+
+def read_columns(reader):
+    batches = list(reader)
+    names = batches[0].get_column_names()
+    return {name: numpy.concatenate([batch[name] for batch in batches]) for name in names}, \
+        {name: numpy.concatenate([batch.null_masks[name] for batch in batches]) for name in names}
+
+
+def test_parse_types_and_nulls():
+    data = b'1|2017-05-01|2017-05-01 10:11:12|t|3.5|caf\xc3\xa9\n' \
+           b'2||||| \n' \
+           b'3|2018-01-31|2018-01-31 00:00:00.250|f|-1|\n'
+    columns = [('id', 'integer'), ('day', 'date'), ('at', 'timestamp'), ('ok', 'boolean'), ('x', 'double precision'),
+               ('name', 'character varying')]
+    for batch_bytes in [10, 40, 1000]:
+        values, null_masks = read_columns(RecordBatchReader(io.BytesIO(data), columns, batch_bytes=batch_bytes))
+        assert numpy.int32 == values['id'].dtype
+        assert [1, 2, 3] == values['id'].tolist()
+        assert numpy.datetime64('2017-05-01') == values['day'][0]
+        assert numpy.isnat(values['day'][1])
+        assert numpy.datetime64('2018-01-31T00:00:00.250') == values['at'][2]
+        assert [True, False, False] == values['ok'].tolist()
+        assert numpy.isnan(values['x'][1])
+        assert ['café', ' ', ''] == values['name'].tolist()
+        assert [False, False, True] == null_masks['name'].tolist()
+
+
+def test_parse_escaped_fields():
+    data = b'1|pipe \\| in text\n2|new\\\nline\n3|back\\\\slash\\\\\n4|\\"quoted\\"\n5|\\N\n'
+    columns = [('id', 'int4'), ('text', 'varchar')]
+    for batch_bytes in [7, 1000]:
+        values, null_masks = read_columns(RecordBatchReader(io.BytesIO(data), columns, escape=True, null_as='\\N',
+                                                            batch_bytes=batch_bytes))
+        assert [1, 2, 3, 4, 5] == values['id'].tolist()
+        assert ['pipe | in text', 'new\nline', 'back\\slash\\', '"quoted"', ''] == values['text'].tolist()
+        assert [False, False, False, False, True] == null_masks['text'].tolist()
+
+
+def test_long_value_does_not_widen_its_column():
+    long_value = 'x' * 20000
+    data = ''.join('{i}|{v}\n'.format(i=i, v=long_value if i == 5 else 'short') for i in range(1000)).encode('utf-8')
+    batches = list(RecordBatchReader(io.BytesIO(data), [('id', 'int4'), ('text', 'varchar')], batch_bytes=len(data)))
+    assert 1 == len(batches)
+    assert len(long_value) == len(batches[0]['text'][5])
+    assert ['short'] * 999 == [value for value in batches[0]['text'].tolist() if value != long_value]
+    # Without the long value in every row: 1000 references instead of 1000 times 80 kB of UCS-4
+    assert batches[0]['text'].nbytes <= 1000 * 8
+    assert batches[0]['id'].nbytes == 1000 * 4
+
+
+def test_wrong_number_of_fields_is_reported():
+    with pytest.raises(ValueError):
+        list(RecordBatchReader(io.BytesIO(b'1|2|3\n'), [('id', 'int4'), ('text', 'varchar')]))
+
+
+def test_record_batches_from_verbose_manifest(fake_s3):
+    part_sizes = [5000, 20000]
+    dataset = create_dataset(fake_s3, 'batches', part_sizes, codec='gzip')
+    reader = RecordBatchReader.from_manifest(S3File(dataset.manifest_url), batch_bytes=4096, parallelism=2)
+    batches = list(reader)
+    assert ['id', 'n', 'name', 'f'] == batches[0].get_column_names()
+    expected_rows = [row.split(b'|') for index, size in enumerate(part_sizes)
+                     for row in make_rows(size, seed=index).splitlines()]
+    assert len(expected_rows) == sum(len(batch) for batch in batches)
+    assert [int(row[0]) for row in expected_rows] == numpy.concatenate([batch['id'] for batch in batches]).tolist()
+    assert [float(row[3]) for row in expected_rows] == numpy.concatenate([batch['f'] for batch in batches]).tolist()
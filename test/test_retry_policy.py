@@ -0,0 +1,135 @@
+from util.retry_policy import RetryPolicy, RetryBudget, LatencyTracker, get_backoff
+import asyncio
+import pytest
+import threading
+import time
+
+
+@pytest.fixture
+def retry_policy():
+    RetryPolicy.reset()
+    yield RetryPolicy
+    RetryPolicy.reset()
+
+
+class FlakyRequest:
+    """
+    Callable that fails the first failures calls and sleeps delays[n] seconds in call n.
+    """
+    def __init__(self, failures=0, delays=None):
+        self.failures = failures
+        self.delays = delays or []
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            call = self.calls
+            self.calls += 1
+        if call < len(self.delays):
+            time.sleep(self.delays[call])
+        if call < self.failures:
+            raise(IOError('failure {n}'.format(n=call)))
+        return call
+
+
+def test_failed_attempts_are_retried(retry_policy):
+    request = FlakyRequest(failures=3)
+    assert 3 == retry_policy.call(request)
+    assert 4 == request.calls
+
+
+def test_fatal_exceptions_are_not_retried(retry_policy):
+    request = FlakyRequest(failures=1)
+    with pytest.raises(IOError):
+        retry_policy.call(request, is_fatal=lambda e: True)
+    assert 1 == request.calls
+
+
+def test_retries_stop_when_the_shared_budget_is_exhausted(retry_policy):
+    retry_policy.configure(retry_budget=RetryBudget(ratio=0.5, initial_tokens=2, min_retries_per_second=0))
+    request = FlakyRequest(failures=100)
+    with pytest.raises(Exception):
+        retry_policy.call(request)
+    assert 3 == request.calls
+    with pytest.raises(Exception):
+        retry_policy.call(request)
+    assert 4 == request.calls
+
+
+def test_retries_wait_for_the_floor_of_an_empty_budget(retry_policy):
+    retry_policy.configure(retry_budget=RetryBudget(initial_tokens=0, min_retries_per_second=20))
+    request = FlakyRequest(failures=2)
+    start = time.monotonic()
+    assert 2 == retry_policy.call(request)
+    # Two retries at a floor of 20 per second
+    assert time.monotonic() - start >= 0.09
+
+
+def test_slow_request_is_hedged_and_the_loser_is_discarded(retry_policy):
+    for _ in range(100):
+        retry_policy.latency_tracker.record(0.01)
+    discarded = []
+    request = FlakyRequest(delays=[2.0])
+    start = time.monotonic()
+    assert 1 == retry_policy.call(request, discard=discarded.append)
+    assert time.monotonic() - start < 1.0
+    assert 2 == request.calls
+    time.sleep(2.0)
+    assert [0] == discarded
+
+
+def test_hedges_have_their_own_budget(retry_policy):
+    retry_policy.configure(hedge_budget=RetryBudget(initial_tokens=0, min_retries_per_second=0))
+    for _ in range(100):
+        retry_policy.latency_tracker.record(0.01)
+    # The retry budget has tokens but the hedge budget is empty
+    request = FlakyRequest(delays=[0.2])
+    assert 0 == retry_policy.call(request)
+    assert 1 == request.calls
+
+
+def test_queued_attempts_are_not_hedged(retry_policy):
+    retry_policy.configure(max_workers=1)
+    for _ in range(100):
+        retry_policy.latency_tracker.record(0.01)
+    retry_policy.get_executor().submit(time.sleep, 0.5)
+    request = FlakyRequest()
+    assert 0 == retry_policy.call(request)
+    assert 1 == request.calls
+
+
+def test_no_hedging_before_latencies_are_measured(retry_policy):
+    request = FlakyRequest(delays=[0.2])
+    assert 0 == retry_policy.call(request)
+    assert 1 == request.calls
+
+
+def test_async_requests_are_retried_and_hedged(retry_policy):
+    latency_tracker = LatencyTracker(min_samples=1)
+    latency_tracker.record(0.01)
+    calls = []
+
+    async def request():
+        calls.append(len(calls))
+        if calls[-1] == 0:
+            raise(IOError('failure'))
+        if calls[-1] == 1:
+            await asyncio.sleep(5)
+        return calls[-1]
+
+    start = time.monotonic()
+    assert 2 == asyncio.run(retry_policy.call_async(request, latency_tracker=latency_tracker))
+    assert time.monotonic() - start < 1.0
+    assert [0, 1, 2] == calls
+
+
+def test_percentile_and_backoff():
+    latency_tracker = LatencyTracker(window=100, min_samples=10)
+    for latency in range(5):
+        latency_tracker.record(latency)
+    assert latency_tracker.get_percentile(50) is None
+    for latency in range(5, 200):
+        latency_tracker.record(latency)
+    assert 100 <= latency_tracker.get_percentile(0) < latency_tracker.get_percentile(95) <= 199
+    assert all(0 <= get_backoff(attempt, base=0.1, cap=1.0) <= 1.0 for attempt in range(1, 30))
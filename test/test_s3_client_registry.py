@@ -0,0 +1,19 @@
+from util.s3_client_registry import S3ClientRegistry
+from util.s3_file import S3File
+
+
+def test_s3_files_of_same_region_share_client():
+    file1 = S3File('s3://manifest-tools/path/to/file1', region='eu-west-1')
+    file2 = S3File('s3://manifest-tools/path/to/file2', region='eu-west-1')
+    file3 = S3File('s3://manifest-tools/path/to/file3', region='eu-central-1')
+    assert file1.get_s3_connection() is file2.get_s3_connection()
+    assert file1.get_s3_connection() is not file3.get_s3_connection()
+    assert S3ClientRegistry.get_client('eu-central-1') is file3.get_s3_connection()
+
+
+def test_configure_applies_pool_size_to_new_clients():
+    S3ClientRegistry.configure(max_pool_connections=42)
+    client = S3ClientRegistry.get_client('eu-west-1')
+    assert client.meta.config.max_pool_connections == 42
+    S3ClientRegistry.configure(max_pool_connections=10)
+    assert S3ClientRegistry.get_client('eu-west-1') is not client
@@ -0,0 +1,103 @@
+from util.s3_file_fragment import S3FileFragment
+from util.s3_read_ahead import S3ReadAhead
+from util.transfer_scheduler import TransferScheduler
+import io
+import random
+import threading
+import time
+
+
+class InMemoryS3File(object):
+    def __init__(self, content):
+        self.content = content
+
+    def get_range(self, s3_byte_range):
+        time.sleep(random.random() / 1000)
+        data = self.content[s3_byte_range.lower_bound:s3_byte_range.upper_bound + 1]
+        return S3FileFragment(io.BytesIO(data), len(data), s3_byte_range)
+
+    def __str__(self):
+        return 'memory://{l}'.format(l=len(self.content))
+
+
+class ConcurrencyCountingS3File(object):
+    """Pretends to be a big file, returns no data and keeps the maximum number of concurrent GETs."""
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def get_range(self, s3_byte_range):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.01)
+        with self.lock:
+            self.in_flight -= 1
+        return S3FileFragment(io.BytesIO(b''), 0, s3_byte_range)
+
+
+class InMemoryS3FileTransfer(object):
+    def __init__(self, content):
+        self.s3_file = InMemoryS3File(content)
+        self.cached_file = None
+
+    def get_s3_file(self):
+        return self.s3_file
+
+    def get_size(self):
+        return len(self.s3_file.content)
+
+
+def get_test_transfers():
+    return [InMemoryS3FileTransfer(bytes(random.getrandbits(8) for _ in range(size))) for size in [502, 0, 100, 1, 77]]
+
+
+def assert_read_ahead_reassembles(read_ahead, transfers):
+    fragments = {}
+    last_seen = []
+    for transfer, data, is_last in read_ahead:
+        fragments.setdefault(id(transfer), []).append(data)
+        if is_last:
+            last_seen.append(transfer)
+    assert last_seen == transfers, 'Every file must be closed exactly once and in order'
+    for transfer in transfers:
+        assert b''.join(fragments[id(transfer)]) == transfer.get_s3_file().content
+
+
+def test_read_ahead_single_request_in_flight():
+    transfers = get_test_transfers()
+    assert_read_ahead_reassembles(S3ReadAhead(transfers, bytes_per_fetch=100), transfers)
+
+
+def test_read_ahead_many_requests_in_flight_keeps_order():
+    transfers = get_test_transfers()
+    assert_read_ahead_reassembles(S3ReadAhead(transfers, bytes_per_fetch=7, requests_in_flight=8), transfers)
+
+
+def test_read_ahead_with_buffer_cap_smaller_than_fetch_size():
+    transfers = get_test_transfers()
+    read_ahead = S3ReadAhead(transfers, bytes_per_fetch=50, requests_in_flight=4, max_buffered_bytes=10)
+    assert_read_ahead_reassembles(read_ahead, transfers)
+
+
+def test_read_ahead_with_scheduled_ranges_has_many_requests_in_flight_by_default():
+    s3_file = ConcurrencyCountingS3File(1024 * 1024 * 1024)
+    transfer = InMemoryS3FileTransfer(b'')
+    transfer.s3_file = s3_file
+    transfer.get_size = lambda: s3_file.size
+    scheduler = TransferScheduler(max_concurrency=8, initial_range_size=64 * 1024 * 1024)
+    # The scheduled 64 MiB ranges are bigger than bytes_per_fetch, that must not leave a single GET in flight
+    for _ in S3ReadAhead([transfer], requests_in_flight=8, transfer_scheduler=scheduler):
+        pass
+    assert s3_file.max_in_flight > 1
+
+
+def test_read_ahead_clamps_scheduled_ranges_to_the_buffer_cap():
+    transfer = InMemoryS3FileTransfer(b'')
+    transfer.get_size = lambda: 1024 * 1024 * 1024
+    scheduler = TransferScheduler(max_concurrency=8, initial_range_size=64 * 1024 * 1024)
+    read_ahead = S3ReadAhead([transfer], requests_in_flight=8, max_buffered_bytes=80 * 1000 * 1000,
+                             transfer_scheduler=scheduler)
+    assert max(length for _, _, length, _ in read_ahead.get_ranges()) == 10 * 1000 * 1000
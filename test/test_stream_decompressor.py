@@ -0,0 +1,60 @@
+from util.stream_decompressor import get_stream_decompressor, StreamDecompressor
+import bz2
+import gzip
+import pytest
+
+PLAINTEXT = ''.join('{i}|row number {i}\n'.format(i=i) for i in range(5000)).encode('utf-8')
+
+
+def decompress_in_fragments(key, data, fragment_size):
+    decompressor = get_stream_decompressor(key)
+    output = []
+    for index in range(0, len(data), fragment_size):
+        output.append(decompressor.decompress(data[index:index + fragment_size]))
+    output.append(decompressor.flush())
+    return b''.join(output)
+
+
+def test_gzip_is_decompressed_across_fragments():
+    compressed = gzip.compress(PLAINTEXT)
+    for fragment_size in [1, 7, 100, len(compressed)]:
+        assert PLAINTEXT == decompress_in_fragments('unload0000_part_00.gz', compressed, fragment_size)
+
+
+def test_multi_member_gzip():
+    compressed = gzip.compress(PLAINTEXT) + gzip.compress(PLAINTEXT)
+    assert PLAINTEXT + PLAINTEXT == decompress_in_fragments('unload0000_part_00.gz', compressed, 33)
+
+
+def test_bzip2_is_decompressed_across_fragments():
+    compressed = bz2.compress(PLAINTEXT)
+    assert PLAINTEXT == decompress_in_fragments('unload0000_part_00.bz2', compressed, 13)
+
+
+def test_zstd_is_decompressed_across_fragments():
+    zstandard = pytest.importorskip('zstandard')
+    compressed = zstandard.ZstdCompressor().compress(PLAINTEXT)
+    assert PLAINTEXT == decompress_in_fragments('unload0000_part_00.zst', compressed, 13)
+
+
+def test_codec_is_detected_from_magic_bytes():
+    zstandard = pytest.importorskip('zstandard')
+    compressors = [gzip.compress, bz2.compress, zstandard.ZstdCompressor().compress]
+    for compress in compressors:
+        assert PLAINTEXT == decompress_in_fragments('unload0000_part_00', compress(PLAINTEXT), 3)
+
+
+def test_plain_data_is_passed_as_is():
+    assert PLAINTEXT == decompress_in_fragments('unload0000_part_00', PLAINTEXT, 3)
+    assert b'BZh' == decompress_in_fragments('unload0000_part_00', b'BZh', 1)
+    assert b'' == decompress_in_fragments('unload0000_part_00', b'', 1)
+    assert b'x' == StreamDecompressor().decompress(b'x')
+
+
+def test_truncated_gzip_raises():
+    compressed = gzip.compress(PLAINTEXT)
+    try:
+        decompress_in_fragments('unload0000_part_00.gz', compressed[:-20], 100)
+        assert False
+    except EOFError:
+        assert True
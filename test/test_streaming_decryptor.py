@@ -0,0 +1,58 @@
+from test import symmetric_base64_aes256_key
+from benchmark.datasets import envelope_encrypt
+from test.test_decrypt_unittests import EncryptionTest
+from util.file_cryptor import EnvelopeFileCryptor, SegmentWorkers
+from util.symmetric_key import SymmetricKey
+import os
+import tempfile
+
+PLAINTEXT = ''.join('{i}|secret number {i}\n'.format(i=i) for i in range(2000)).encode('utf-8')
+
+
+def decrypt_in_fragments(cryptor, crypto_text, fragment_size):
+    decryptor = cryptor.get_streaming_decryptor()
+    output = []
+    for index in range(0, len(crypto_text), fragment_size):
+        output.append(decryptor.update(crypto_text[index:index + fragment_size]))
+    output.append(decryptor.finalize())
+    return b''.join(output)
+
+
+def test_streaming_decrypt_with_fragments_not_aligned_to_blocks():
+    for plaintext in [PLAINTEXT, PLAINTEXT[:16], PLAINTEXT[:17], b'']:
+        crypto_text, iv, data_key = envelope_encrypt(plaintext, symmetric_base64_aes256_key)
+        cryptor = EnvelopeFileCryptor(SymmetricKey(symmetric_base64_aes256_key), iv=iv, data_key=data_key)
+        for fragment_size in [1, 15, 16, 17, 1000, len(crypto_text)]:
+            assert plaintext == decrypt_in_fragments(cryptor, crypto_text, fragment_size)
+
+
+def test_streaming_decrypt_of_redshift_unloads():
+    for test_id in ['0000_part_00', '0001_part_00', '0002_part_00', '0003_part_00']:
+        encryption_test = EncryptionTest(test_id=test_id)
+        cryptor = EnvelopeFileCryptor(
+            symmetric_key=SymmetricKey(symmetric_base64_aes256_key),
+            iv=encryption_test.get_iv_text(),
+            data_key=encryption_test.get_key_text()
+        )
+        plaintext = decrypt_in_fragments(cryptor, encryption_test.get_cipher_text(), 5)
+        assert encryption_test.get_plain_text() == plaintext.decode('utf-8')
+
+
+def test_parallel_decrypt_of_local_file():
+    temp_dir = tempfile.TemporaryDirectory()
+    input_file = os.path.join(temp_dir.name, 'encrypted')
+    output_file = os.path.join(temp_dir.name, 'decrypted')
+    for plaintext in [PLAINTEXT, PLAINTEXT[:32], b'']:
+        crypto_text, iv, data_key = envelope_encrypt(plaintext, symmetric_base64_aes256_key)
+        with open(input_file, 'wb') as encrypted_file:
+            encrypted_file.write(crypto_text)
+        cryptor = EnvelopeFileCryptor(SymmetricKey(symmetric_base64_aes256_key), iv=iv, data_key=data_key)
+        for segment_size, use_processes in [(1000, False), (16, False), (4096, True)]:
+            cryptor.decrypt_file_parallel(input_file, output_file, workers=3, segment_size=segment_size,
+                                          use_processes=use_processes)
+            with open(output_file, 'rb') as decrypted_file:
+                assert plaintext == decrypted_file.read()
+    # Every file of the run used the same two pools
+    assert [(3, False), (3, True)] == sorted(SegmentWorkers.executors)
+    SegmentWorkers.shutdown()
+    assert {} == SegmentWorkers.executors
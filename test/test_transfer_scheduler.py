@@ -0,0 +1,48 @@
+from util.transfer_scheduler import TransferScheduler, SINGLE_REQUEST_SIZE, MIN_RANGE_SIZE, MAX_RANGE_SIZE
+
+
+class SizedTransfer:
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def get_size(self):
+        return self.size
+
+
+def test_small_files_are_fetched_with_a_single_request():
+    scheduler = TransferScheduler(max_concurrency=8)
+    transfer_config = scheduler.get_transfer_config(SINGLE_REQUEST_SIZE)
+    assert (SINGLE_REQUEST_SIZE, 1) == (transfer_config.range_size, transfer_config.concurrency)
+    assert 1 == scheduler.get_transfer_config(0).concurrency
+
+
+def test_huge_files_use_all_connections_and_middle_sized_files_are_not_over_split():
+    scheduler = TransferScheduler(max_concurrency=8)
+    huge = scheduler.get_transfer_config(10 * 1024 * 1024 * 1024)
+    assert 8 == huge.concurrency
+    assert huge.range_size == scheduler.get_range_size()
+    middle = scheduler.get_transfer_config(3 * SINGLE_REQUEST_SIZE)
+    assert middle.range_size >= MIN_RANGE_SIZE
+    assert middle.concurrency * middle.range_size >= 3 * SINGLE_REQUEST_SIZE
+    assert middle.concurrency <= 8
+
+
+def test_range_size_follows_the_measured_throughput():
+    scheduler = TransferScheduler(max_concurrency=4, target_request_seconds=1.0)
+    scheduler.record_request(100, 10.0)
+    assert scheduler.get_range_size() == scheduler.initial_range_size
+    for _ in range(50):
+        scheduler.record_request(32 * 1024 * 1024, 1.0)
+    assert abs(scheduler.get_range_size() - 32 * 1024 * 1024) < 1024 * 1024
+    for _ in range(50):
+        scheduler.record_request(1024 * 1024 * 1024, 1.0)
+    assert MAX_RANGE_SIZE == scheduler.get_range_size()
+    for _ in range(100):
+        scheduler.record_request(512 * 1024, 10.0)
+    assert MIN_RANGE_SIZE == scheduler.get_range_size()
+
+
+def test_largest_files_are_ordered_first_and_ties_keep_their_order():
+    transfers = [SizedTransfer('a', 5), SizedTransfer('b', 50), SizedTransfer('c', 5), SizedTransfer('d', 500)]
+    assert ['d', 'b', 'a', 'c'] == [t.name for t in TransferScheduler.order_largest_first(transfers)]
@@ -0,0 +1,340 @@
+from util.s3_client_registry import S3ClientRegistry
+from util.s3_byte_range import S3ByteRange
+from util.s3_file import S3File
+from util.s3_file_transfer import S3FileTransfer
+from util.retry_policy import RetryPolicy, LatencyTracker
+from util.transfer_scheduler import TransferScheduler
+from util.instrumentation import Instrumentation
+from util.file_cryptor import S3EnvelopeFileCryptor
+from collections import deque
+import asyncio
+import contextlib
+import logging
+import os
+
+DEFAULT_REQUESTS_IN_FLIGHT = 128
+# Every request in flight holds its range in memory until it is written, so ranges are smaller than for threads
+DEFAULT_ASYNC_BYTES_PER_FETCH = 4 * 1024 * 1024
+
+
+def import_aiobotocore():
+    try:
+        import aiobotocore.session
+        import aiobotocore.config
+    except ImportError as e:
+        raise(Exception('The aiobotocore package is required for the asyncio transfer engine '
+                        '(pip install aiobotocore)')) from e
+    return aiobotocore
+
+
+def get_aiobotocore_client_factory(max_pool_connections):
+    """
+
+    Args:
+        max_pool_connections(int): size of the connection pool of every client
+
+    Returns:
+        callable: creates an aiobotocore S3 client (an async context manager) for a region, the endpoint and the
+          connection settings are taken from the S3ClientRegistry
+    """
+    aiobotocore = import_aiobotocore()
+    session = aiobotocore.session.get_session()
+
+    def create_client(region):
+        endpoint_url = S3ClientRegistry.endpoint_url
+        config_kwargs = S3ClientRegistry.get_config_kwargs(endpoint_url, max_pool_connections=max_pool_connections)
+        client_kwargs = {'config': aiobotocore.config.AioConfig(**config_kwargs)}
+        if region is not None:
+            client_kwargs['region_name'] = region
+        if endpoint_url is not None:
+            client_kwargs['endpoint_url'] = endpoint_url
+        return session.create_client('s3', **client_kwargs)
+    return create_client
+
+
+def get_region(s3_file):
+    """
+
+    Returns:
+        str: the region of the bucket of the S3 file if it is known, None for the default region
+    """
+    region = s3_file.get_region()
+    if region is None and s3_file.region_cache is not None:
+        region = s3_file.region_cache.get_cached_region(s3_file.get_bucket())
+    if region == 'unknown':
+        return None
+    return region
+
+
+def write_at(file_path, data, offset):
+    """
+    The file is opened by every write, so a write that is still running after its download was cancelled never uses a
+    file descriptor that has been closed or reused.
+    """
+    file_descriptor = os.open(file_path, os.O_WRONLY)
+    try:
+        written = 0
+        while written < len(data):
+            written += os.pwrite(file_descriptor, data[written:], offset + written)
+    finally:
+        os.close(file_descriptor)
+
+
+def write_decrypted(destination_file, decryptor, crypto_text):
+    """
+    Decrypt the next range of a file and append the plaintext to the destination.
+
+    Args:
+        destination_file: file object opened for writing
+        decryptor(StreamingDecryptor):
+        crypto_text(bytes): the next range, None when all ranges were passed to write the end of the plaintext
+    """
+    if crypto_text is None:
+        plaintext = decryptor.finalize()
+    else:
+        plaintext = decryptor.update(crypto_text)
+    with Instrumentation.measure('disk.write') as measurement:
+        destination_file.write(plaintext)
+        measurement.add_bytes(len(plaintext))
+
+
+async def gather_or_cancel(coroutines):
+    """
+    Run coroutines concurrently, if one of them fails the others are cancelled before the exception is raised.
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class AsyncS3Clients:
+    """
+    The asyncio S3 clients of a retrieval, one per region.  They are bound to the event loop of the retrieval and are
+    closed together when it ends.
+    """
+    def __init__(self, client_factory):
+        self.client_factory = client_factory
+        self.clients = {}
+        self.lock = asyncio.Lock()
+        self.exit_stack = contextlib.AsyncExitStack()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.exit_stack.aclose()
+        return False
+
+    async def get_client(self, region):
+        async with self.lock:
+            if region not in self.clients:
+                logging.debug('Creating asyncio S3 client for region={r}'.format(r=region))
+                self.clients[region] = await self.exit_stack.enter_async_context(self.client_factory(region))
+            return self.clients[region]
+
+
+class AsyncTransferEngine:
+    """
+    Retrieves files with ranged GETs that all run on a single event loop, across every file of the retrieval.  Unlike
+    the threaded retrieval, the number of requests in flight is not tied to a number of threads so a few cores can
+    keep hundreds of requests busy.  Files are taken from a queue, biggest first, by a bounded number of file tasks.
+    Every file is written to a temporary file that only replaces the local file once it is complete.
+
+    Ranges of plain files are written to their offset as they arrive.  Ranges of encrypted files are decrypted in
+    order of their offset, a range that arrives early keeps its request slot until it is decrypted.
+    """
+    def __init__(self, max_requests_in_flight=DEFAULT_REQUESTS_IN_FLIGHT, bytes_per_fetch=DEFAULT_ASYNC_BYTES_PER_FETCH,
+                 client_factory=None, max_files_in_flight=None):
+        """
+
+        Args:
+            max_requests_in_flight(int): maximum number of requests in flight over all files
+            bytes_per_fetch(int): size of the ranged GETs
+            client_factory(callable): creates an asyncio S3 client (an async context manager) for a region, by
+              default an aiobotocore client
+            max_files_in_flight(int): maximum number of files that are retrieved at the same time, by default
+              max_requests_in_flight so small files can use every request slot
+        """
+        self.max_requests_in_flight = int(max_requests_in_flight)
+        self.bytes_per_fetch = int(bytes_per_fetch)
+        self.max_files_in_flight = int(max_files_in_flight or self.max_requests_in_flight)
+        if client_factory is None:
+            client_factory = get_aiobotocore_client_factory(self.max_requests_in_flight)
+        self.client_factory = client_factory
+        # Latencies of whole ranges, they are not comparable with the time to first byte of the threaded requests
+        self.latency_tracker = LatencyTracker()
+        self.requests_in_flight = None
+
+    @staticmethod
+    def can_retrieve(target_path, retrieve_kwargs):
+        """
+        Output to stdout, the part cache and resuming from a journal are only supported by the threaded retrieval.
+
+        Args:
+            target_path(str):
+            retrieve_kwargs(dict): see S3Helper.retrieve_file
+
+        Returns:
+            bool:
+        """
+        return target_path is not None and retrieve_kwargs.get('part_cache', None) is None \
+            and retrieve_kwargs.get('journal', None) is None
+
+    async def retrieve_files(self, s3_transfers, **kwargs):
+        """
+        Retrieve files concurrently, the biggest files are started first.  The first exception cancels the other
+        files.
+
+        Args:
+            s3_transfers(list): S3FileTransfer objects that all have a local file as destination
+            **kwargs:
+              - symmetric_key=None: if provided then client-side encryption is assumed to decrypt the files
+              - sync_state=None: SyncState in which the local files are recorded once they are retrieved
+
+        Returns:
+
+        """
+        logging.debug('Retrieving {n} files with up to {r} requests and {f} files in flight'
+                      .format(n=len(s3_transfers), r=self.max_requests_in_flight, f=self.max_files_in_flight))
+        self.requests_in_flight = asyncio.Semaphore(self.max_requests_in_flight)
+        queued_transfers = deque(TransferScheduler.order_largest_first(s3_transfers))
+
+        async def retrieve_queued_files(clients):
+            while len(queued_transfers) > 0:
+                await self.retrieve_file_measured(clients, queued_transfers.popleft(), **kwargs)
+
+        async with AsyncS3Clients(self.client_factory) as clients:
+            await gather_or_cancel([retrieve_queued_files(clients)
+                                    for _ in range(min(self.max_files_in_flight, len(queued_transfers)))])
+
+    async def retrieve_file_measured(self, clients, s3_transfer, **kwargs):
+        with Instrumentation.measure('file.retrieve') as measurement:
+            await self.retrieve_file(clients, s3_transfer, **kwargs)
+            measurement.add_bytes(s3_transfer.get_size())
+
+    async def retrieve_file(self, clients, s3_transfer, **kwargs):
+        symmetric_key = kwargs.get('symmetric_key', None)
+        sync_state = kwargs.get('sync_state', None)
+        s3_file = s3_transfer.get_s3_file()
+        local_file = s3_transfer.get_local_file()
+        client = await clients.get_client(get_region(s3_file))
+        if not s3_file.has_size() or symmetric_key is not None or (sync_state is not None and not s3_file.has_etag()):
+            async with self.requests_in_flight:
+                with Instrumentation.measure('s3.head'):
+                    s3_file.set_meta(await client.head_object(Bucket=s3_file.get_bucket(), Key=s3_file.get_key()))
+
+        s3_transfer.make_sure_local_parent_dir_exists()
+        if symmetric_key is None:
+            await self.download(client, s3_file, local_file)
+        else:
+            try:
+                cryptor = S3EnvelopeFileCryptor(symmetric_key=symmetric_key, s3_transfer=s3_transfer)
+                await self.download(client, s3_file, local_file, decryptor=cryptor.get_streaming_decryptor())
+            except Exception as e:
+                # Never fall back to storing the encrypted object, download leaves no partial local file
+                logging.error('Exception {e} encountered when decrypting transfer.'.format(e=str(e)))
+                raise e
+        s3_transfer.is_downloaded = True
+        logging.debug('Downloaded file {src} to {dest}'.format(src=str(s3_file), dest=local_file))
+
+        if sync_state is not None:
+            sync_state.record(s3_transfer)
+
+    async def download(self, client, s3_file, destination_path, decryptor=None):
+        """
+        Download to a temporary file that replaces the destination once it is complete, so a failed or cancelled
+        download never leaves a partial destination file behind.
+
+        Args:
+            client: asyncio S3 client
+            s3_file(S3File):
+            destination_path(str):
+            decryptor(StreamingDecryptor): decrypts the object, None to store the object as is
+        """
+        size = s3_file.get_size()
+        s3_byte_ranges = [S3ByteRange(size=min(self.bytes_per_fetch, size - lower_bound), lower_bound=lower_bound)
+                          for lower_bound in range(0, size, self.bytes_per_fetch)]
+        temp_file = S3FileTransfer.get_unique_temp_name(destination_path)
+        try:
+            with Instrumentation.measure('s3.download') as measurement:
+                open(temp_file, 'wb').close()
+                if decryptor is None:
+                    await gather_or_cancel([self.fetch_range(client, s3_file, s3_byte_range, temp_file)
+                                            for s3_byte_range in s3_byte_ranges])
+                else:
+                    await self.fetch_ranges_in_order(client, s3_file, s3_byte_ranges, temp_file, decryptor)
+                measurement.add_bytes(size)
+            os.replace(temp_file, destination_path)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    async def fetch_range(self, client, s3_file, s3_byte_range, destination_path):
+        # The slot is held until the range is written, so at most max_requests_in_flight ranges are in memory
+        async with self.requests_in_flight:
+            data = await self.request_checked_range(client, s3_file, s3_byte_range)
+            with Instrumentation.measure('disk.write') as measurement:
+                await asyncio.get_running_loop().run_in_executor(None, write_at, destination_path, data,
+                                                                 s3_byte_range.lower_bound)
+                measurement.add_bytes(len(data))
+
+    async def fetch_ranges_in_order(self, client, s3_file, s3_byte_ranges, destination_path, decryptor):
+        """
+        Fetch the ranges concurrently and feed them to the decryptor in order of their offset.  The decrypted data is
+        appended to the destination in the default executor of the loop.
+        """
+        loop = asyncio.get_running_loop()
+        # Ranges acquire their slot in order of their offset, so the next range to decrypt always has one
+        fetches = [asyncio.ensure_future(self.fetch_range_holding_slot(client, s3_file, s3_byte_range))
+                   for s3_byte_range in s3_byte_ranges]
+        consumed = 0
+        try:
+            with open(destination_path, 'wb') as destination_file:
+                for fetch in fetches:
+                    data = await fetch
+                    consumed += 1
+                    try:
+                        await loop.run_in_executor(None, write_decrypted, destination_file, decryptor, data)
+                    finally:
+                        self.requests_in_flight.release()
+                await loop.run_in_executor(None, write_decrypted, destination_file, decryptor, None)
+        finally:
+            for fetch in fetches[consumed:]:
+                fetch.cancel()
+            await asyncio.gather(*fetches[consumed:], return_exceptions=True)
+            for fetch in fetches[consumed:]:
+                if not fetch.cancelled() and fetch.exception() is None:
+                    self.requests_in_flight.release()
+
+    async def fetch_range_holding_slot(self, client, s3_file, s3_byte_range):
+        """
+        Fetch a range under a request slot that the caller releases once the range is consumed.
+        """
+        await self.requests_in_flight.acquire()
+        try:
+            return await self.request_checked_range(client, s3_file, s3_byte_range)
+        except BaseException:
+            self.requests_in_flight.release()
+            raise
+
+    async def request_checked_range(self, client, s3_file, s3_byte_range):
+        data = await RetryPolicy.call_async(lambda: self.request_range(client, s3_file, s3_byte_range),
+                                            is_fatal=S3File.is_invalid_range, latency_tracker=self.latency_tracker)
+        if len(data) != s3_byte_range.size:
+            raise(Exception('Expected {e} bytes for range {r} of {f} but got {g}'
+                            .format(e=s3_byte_range.size, r=str(s3_byte_range), f=str(s3_file), g=len(data))))
+        return data
+
+    @staticmethod
+    async def request_range(client, s3_file, s3_byte_range):
+        with Instrumentation.measure('s3.get_range') as measurement:
+            response = await client.get_object(Bucket=s3_file.get_bucket(), Key=s3_file.get_key(),
+                                               Range=str(s3_byte_range))
+            async with response['Body'] as body:
+                data = await body.read()
+            measurement.add_bytes(len(data))
+        return data
@@ -0,0 +1,82 @@
+import json
+import logging
+import os
+import threading
+
+
+class BucketRegionCache:
+    """
+    Maps bucket names to their region so the region of a bucket is looked up only once, even when many S3File objects
+    of the same bucket are used concurrently.  The cache can optionally be persisted to a JSON file between runs.
+    """
+    def __init__(self, cache_file=None):
+        """
+
+        Args:
+            cache_file(str): path of the JSON file to load the cache from and save it to
+        """
+        self.cache_file = cache_file
+        self.regions = {}
+        self.lock = threading.Lock()
+        if cache_file is not None and os.path.isfile(cache_file):
+            self.load(cache_file)
+
+    def load(self, cache_file):
+        try:
+            with open(cache_file, 'r') as input_file:
+                self.regions.update(json.load(input_file))
+            logging.debug('Loaded {n} bucket regions from {f}'.format(n=len(self.regions), f=cache_file))
+        except ValueError:
+            logging.warning('Ignoring invalid bucket region cache file {f}'.format(f=cache_file))
+
+    def save(self, cache_file=None):
+        """
+        Write the cache atomically to cache_file (or the file given at construction time).
+
+        Args:
+            cache_file(str):
+        """
+        cache_file = cache_file or self.cache_file
+        if cache_file is None:
+            return
+        temp_file = '{f}.{pid}.tmp'.format(f=cache_file, pid=os.getpid())
+        with self.lock:
+            with open(temp_file, 'w') as output_file:
+                json.dump(self.regions, output_file, sort_keys=True)
+        os.replace(temp_file, cache_file)
+
+    def get_cached_region(self, bucket_name):
+        """
+
+        Args:
+            bucket_name(str):
+
+        Returns:
+            str: the region of the bucket or None if it is not cached
+        """
+        return self.regions.get(bucket_name, None)
+
+    def set_region(self, bucket_name, region):
+        with self.lock:
+            self.regions[bucket_name] = region
+
+    def get_region(self, bucket_name, lookup_region):
+        """
+        Get the region of a bucket, looking it up if it is not cached yet.  Concurrent callers for the same bucket wait
+        for a single lookup.
+
+        Args:
+            bucket_name(str):
+            lookup_region(function): called without arguments to look up the region if it is not cached
+
+        Returns:
+            str: the region of the bucket
+        """
+        with self.lock:
+            if bucket_name not in self.regions:
+                logging.debug('Looking up region of bucket {b}'.format(b=bucket_name))
+                self.regions[bucket_name] = lookup_region()
+            return self.regions[bucket_name]
+
+    def __len__(self):
+        return len(self.regions)
@@ -1,11 +1,313 @@
 from util.symmetric_key import SymmetricKey
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
+from util.s3_read_ahead import S3ReadAhead
+from util.s3_byte_range import S3ByteRange
+from util.s3_file import S3File
+from util.instrumentation import Instrumentation
+from util.s3_client_registry import S3ClientRegistry
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import base64
+import concurrent.futures
 import logging
-import binascii
+import multiprocessing
+import multiprocessing.util
+import os
+import threading
 
-backend = default_backend()
+AES_BLOCK_SIZE_BYTES = 16
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+def get_aes_decryptor(key, iv=None):
+    """
+    cryptography is only imported here so that runs without client-side encryption do not pay for loading it.
+
+    Args:
+        key(bytes):
+        iv(bytes): initialization vector for CBC mode, None for ECB mode
+
+    Returns:
+        a cryptography decryption context with update() and finalize()
+    """
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.backends import default_backend
+    mode = modes.ECB() if iv is None else modes.CBC(iv)
+    return Cipher(algorithms.AES(key), mode, backend=default_backend()).decryptor()
+
+
+def decrypt_segment(key, iv, crypto_text):
+    """
+    CBC decryption can start at any block boundary by using the preceding cipher block as initialization vector.
+
+    Args:
+        key(bytes): the decrypted data key
+        iv(bytes): the cipher block preceding the segment, or the object its iv for the first segment
+        crypto_text(bytes): block aligned crypto text
+
+    Returns:
+        bytes: the plaintext of the segment, still padded if it is the last segment
+    """
+    decryptor = get_aes_decryptor(key, iv)
+    return decryptor.update(crypto_text) + decryptor.finalize()
+
+
+def decrypt_file_segment(key, iv, input_file, output_file, offset, length):
+    """
+    Decrypt a segment of a local encrypted file and write it to the same offset of the output file.
+
+    Args:
+        key(bytes): the decrypted data key
+        iv(bytes): the iv of the encrypted object
+        input_file(str): path to the encrypted file
+        output_file(str): path to the preallocated output file
+        offset(int): block aligned start of the segment
+        length(int): block aligned length of the segment
+
+    Returns:
+        int: the number of bytes written
+    """
+    in_fd = os.open(input_file, os.O_RDONLY)
+    try:
+        if offset > 0:
+            iv = os.pread(in_fd, AES_BLOCK_SIZE_BYTES, offset - AES_BLOCK_SIZE_BYTES)
+        crypto_text = os.pread(in_fd, length, offset)
+    finally:
+        os.close(in_fd)
+    return write_at_offset(output_file, decrypt_segment(key, iv, crypto_text), offset)
+
+
+def decrypt_s3_segment(key, iv, bucket, s3_key, region, output_file, offset, length):
+    """
+    Fetch a segment of an encrypted S3 object (together with the preceding cipher block), decrypt it and write it to the
+    same offset of the output file.  Only picklable arguments are used such that this can run in a worker process.
+
+    Args:
+        key(bytes): the decrypted data key
+        iv(bytes): the iv of the encrypted object
+        bucket(str):
+        s3_key(str):
+        region(str):
+        output_file(str): path to the preallocated output file
+        offset(int): block aligned start of the segment
+        length(int): block aligned length of the segment
+
+    Returns:
+        int: the number of bytes written
+    """
+    range_start = max(0, offset - AES_BLOCK_SIZE_BYTES)
+    s3_byte_range = S3ByteRange(offset + length - range_start, lower_bound=range_start)
+    crypto_text = S3File(bucket, s3_key, region=region).get_range(s3_byte_range).get_streaming_body().read()
+    if offset > 0:
+        iv, crypto_text = crypto_text[:AES_BLOCK_SIZE_BYTES], crypto_text[AES_BLOCK_SIZE_BYTES:]
+    return write_at_offset(output_file, decrypt_segment(key, iv, crypto_text), offset)
+
+
+def write_at_offset(output_file, data, offset):
+    out_fd = os.open(output_file, os.O_WRONLY)
+    try:
+        written = 0
+        while written < len(data):
+            written += os.pwrite(out_fd, data[written:], offset + written)
+    finally:
+        os.close(out_fd)
+    return written
+
+
+def get_segments(size, segment_size):
+    """
+
+    Args:
+        size(int): size of the crypto text, a multiple of the AES block size
+        segment_size(int): requested segment size, rounded down to a multiple of the AES block size
+
+    Returns:
+        list: tuples (offset, length)
+    """
+    if size % AES_BLOCK_SIZE_BYTES != 0:
+        raise(ValueError('Crypto text of {s} bytes is not a multiple of the AES block size'.format(s=size)))
+    segment_size = max(AES_BLOCK_SIZE_BYTES, segment_size - segment_size % AES_BLOCK_SIZE_BYTES)
+    return [(offset, min(segment_size, size - offset)) for offset in range(0, size, segment_size)]
+
+
+def preallocate_file(file_name, size):
+    with open(file_name, 'wb') as output_file:
+        output_file.truncate(size)
+        if hasattr(os, 'posix_fallocate') and size > 0:
+            try:
+                os.posix_fallocate(output_file.fileno(), 0, size)
+            except OSError:
+                logging.debug('posix_fallocate not supported for {f}'.format(f=file_name))
+
+
+def remove_padding_of_file(file_name):
+    """
+    Remove the PKCS7 padding at the end of a decrypted file.
+
+    Args:
+        file_name(str):
+    """
+    with open(file_name, 'r+b') as decrypted_file:
+        decrypted_file.seek(0, os.SEEK_END)
+        size = decrypted_file.tell()
+        if size == 0:
+            return
+        decrypted_file.seek(size - 1)
+        pad_value = decrypted_file.read(1)[0]
+        if pad_value < 1 or pad_value > AES_BLOCK_SIZE_BYTES:
+            raise(ValueError('Invalid padding value {p} at the end of {f}'.format(p=pad_value, f=file_name)))
+        decrypted_file.truncate(size - pad_value)
+
+
+def get_worker_process_context():
+    """
+    Worker processes are started by a forkserver (or spawned where that is not available) and never forked from the
+    calling process: that process runs boto3 and read-ahead threads and a fork can copy a lock that one of them holds.
+    The forkserver imports the modules of the workers once, so a new worker does not import boto3 again.
+
+    Returns:
+        a multiprocessing context for process pools
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        # Only has an effect before the forkserver is started
+        context.set_forkserver_preload(['util.file_cryptor', 'util.process_pipeline'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+def configure_worker_process(client_settings):
+    """
+    Initializer of a worker process, it does not inherit the configuration of the calling process.
+
+    Args:
+        client_settings(dict): see S3ClientRegistry.get_settings
+    """
+    S3ClientRegistry.configure(**client_settings)
+
+
+class SegmentWorkers:
+    """
+    Process-wide pools that decrypt segments, keyed by size and kind.  A pool is started by the first file that needs
+    it and is reused by every other file of the run, shutdown() ends the pools once the run is done.  Pools are not
+    shared across a fork so the registry starts over in a child process.
+    """
+    lock = threading.Lock()
+    executors = {}
+    pid = os.getpid()
+    finalizer = None
+
+    @staticmethod
+    def get_executor(workers, use_processes):
+        """
+
+        Args:
+            workers(int): the size of the pool
+            use_processes(bool): whether to use a process pool instead of a thread pool
+
+        Returns:
+            concurrent.futures.Executor:
+        """
+        with SegmentWorkers.lock:
+            if SegmentWorkers.pid != os.getpid():
+                SegmentWorkers.executors = {}
+                SegmentWorkers.pid = os.getpid()
+                SegmentWorkers.finalizer = None
+            pool_key = (int(workers), use_processes)
+            if pool_key not in SegmentWorkers.executors:
+                logging.debug('Starting a pool of {w} segment workers (processes={p})'.format(w=workers,
+                                                                                              p=use_processes))
+                if use_processes:
+                    executor = ProcessPoolExecutor(max_workers=workers, mp_context=get_worker_process_context(),
+                                                   initializer=configure_worker_process,
+                                                   initargs=(S3ClientRegistry.get_settings(),))
+                else:
+                    executor = ThreadPoolExecutor(max_workers=workers)
+                if SegmentWorkers.finalizer is None:
+                    # At the exit of a worker process multiprocessing joins its children, the workers of a pool that
+                    # is still running would make that wait forever.  The priority is above the one of the queues of
+                    # the pool so they are not closed yet when the pool is shut down.
+                    SegmentWorkers.finalizer = multiprocessing.util.Finalize(None, SegmentWorkers.shutdown,
+                                                                             exitpriority=100)
+                SegmentWorkers.executors[pool_key] = executor
+            return SegmentWorkers.executors[pool_key]
+
+    @staticmethod
+    def shutdown():
+        with SegmentWorkers.lock:
+            executors = SegmentWorkers.executors
+            SegmentWorkers.executors = {}
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+
+
+def run_segments(segment_function, segment_arguments, workers, use_processes):
+    """
+    Run the decryption of segments in the pool of workers of the run and raise the first exception if any.
+
+    Args:
+        segment_function: function that decrypts a single segment
+        segment_arguments(list): tuples of arguments for segment_function
+        workers(int): the size of the pool
+        use_processes(bool): whether to use a process pool instead of a thread pool
+    """
+    executor = SegmentWorkers.get_executor(workers, use_processes)
+    futures = [executor.submit(segment_function, *arguments) for arguments in segment_arguments]
+    try:
+        for future in futures:
+            future.result()
+    except Exception:
+        for future in futures:
+            future.cancel()
+        # Segments that are still running write to the output file, which the caller may remove
+        concurrent.futures.wait(futures)
+        raise
+
+
+class StreamingDecryptor(object):
+    """
+    AES-CBC decryption of data that arrives in fragments of arbitrary size.  The CBC chaining state (the last cipher
+    block) is carried by the cryptography decryptor from one fragment to the next.  The last plaintext block is held
+    back because only at the real end of the object it is known which block carries the padding.
+    """
+    def __init__(self, key, iv):
+        """
+
+        Args:
+            key(bytes): the decrypted data key
+            iv(bytes): the initialization vector
+        """
+        self.decryptor = get_aes_decryptor(key, iv)
+        self.last_block = b''
+
+    def update(self, crypto_text):
+        """
+
+        Args:
+            crypto_text(bytes): next fragment of the encrypted object
+
+        Returns:
+            bytes: plaintext that can be released, this excludes the last complete block decrypted so far
+        """
+        with Instrumentation.measure('crypto.decrypt') as measurement:
+            plaintext = self.decryptor.update(crypto_text)
+            measurement.add_bytes(len(crypto_text))
+        if len(plaintext) == 0:
+            return b''
+        plaintext = self.last_block + plaintext
+        self.last_block = plaintext[-AES_BLOCK_SIZE_BYTES:]
+        return plaintext[:-AES_BLOCK_SIZE_BYTES]
+
+    def finalize(self):
+        """
+        Called at the real end of the object.
+
+        Returns:
+            bytes: the unpadded remaining plaintext
+        """
+        padded_plaintext = self.last_block + self.decryptor.finalize()
+        self.last_block = b''
+        if len(padded_plaintext) == 0:
+            return b''
+        return EnvelopeFileCryptor.un_pad(padded_plaintext)
 
 
 class EnvelopeFileCryptor(object):
@@ -36,10 +338,10 @@ class EnvelopeFileCryptor(object):
         Returns:
             bytes: Decrypted data key bytes.
         """
-        cipher = Cipher(algorithms.AES(self.symmetric_key), modes.ECB(), backend=backend)
-        decryptor = cipher.decryptor()
-        padded_key = decryptor.update(self.data_key) + decryptor.finalize()
-        key = S3EnvelopeFileCryptor.un_pad(padded_key)
+        with Instrumentation.measure('crypto.decrypt_data_key'):
+            decryptor = get_aes_decryptor(self.symmetric_key)
+            padded_key = decryptor.update(self.data_key) + decryptor.finalize()
+            key = S3EnvelopeFileCryptor.un_pad(padded_key)
         return key
 
     @staticmethod
@@ -56,18 +358,11 @@ class EnvelopeFileCryptor(object):
         Returns:
 
         """
-        logging.debug('Unpadding padded bytes {b}'.format(b=binascii.hexlify(padded_bytes)))
-        logging.debug('Number of bytes: {bl}'.format(bl=len(padded_bytes)))
-        logging.debug('Type of padded bytes: {bt}'.format(bt=type(padded_bytes)))
-
+        # No hex dump of the bytes: it was built even with debug logging off and the padded bytes can be key material
         pad_value = padded_bytes[len(padded_bytes) - 1]
         if isinstance(pad_value, int):
-            logging.debug('Type of pad_value is int, value {v}'.format(v=str(pad_value)))
             return padded_bytes[:-pad_value]
         elif isinstance(pad_value, str):
-            logging.debug(
-                'Type of pad_value is str, length {len}, value {v}'.format(len=len(pad_value), v=ord(pad_value))
-            )
             return padded_bytes[:-ord(pad_value)]
         else:
             logging.fatal(
@@ -87,13 +382,21 @@ class EnvelopeFileCryptor(object):
         pad_value = self.block_size - len(input_str) % self.block_size
         return input_str + pad_value * chr(pad_value)
 
+    def get_streaming_decryptor(self):
+        """
+
+        Returns:
+            StreamingDecryptor: decryptor for fragments of the encrypted data
+        """
+        return StreamingDecryptor(self.get_decrypted_data_key(), self.iv)
+
     def decrypt_file(self, input_file, output_file):
         # aes_crypt_handle = AES.new(self.get_decrypted_data_key(), AES.MODE_CBC, self.iv)
-        cipher = Cipher(algorithms.AES(self.get_decrypted_data_key()), modes.CBC(self.iv), backend=backend)
-        decryptor = cipher.decryptor()
+        decryptor = get_aes_decryptor(self.get_decrypted_data_key(), self.iv)
 
         logging.debug('Starting decrypting loop')
-        with open(input_file, 'rb') as in_file:
+        with Instrumentation.measure('crypto.decrypt_file') as measurement, open(input_file, 'rb') as in_file:
+            measurement.add_bytes(os.fstat(in_file.fileno()).st_size)
             with open(output_file, 'wb') as out_file:
                 next_chunk = b''
                 finished = False
@@ -106,6 +409,47 @@ class EnvelopeFileCryptor(object):
                     out_file.write(chunk)
                 out_file.write(decryptor.finalize())
 
+    def decrypt_file_parallel(self, input_file, output_file, workers=None, segment_size=DEFAULT_SEGMENT_SIZE,
+                              use_processes=True):
+        """
+        Decrypt a local file by cutting it in block aligned segments that are decrypted by a pool of workers.  Every
+        segment is written to its offset in a preallocated output file.
+
+        Args:
+            input_file(str): path to the encrypted file
+            output_file(str): path to the decrypted file
+            workers(int): size of the pool, defaults to the number of CPUs
+            segment_size(int): number of bytes decrypted by a single task
+            use_processes(bool): use a process pool such that decryption runs on all cores
+        """
+        size = os.path.getsize(input_file)
+        segments = get_segments(size, segment_size)
+        preallocate_file(output_file, size)
+        key = self.get_decrypted_data_key()
+        logging.debug('Decrypting {f} in {n} segments'.format(f=input_file, n=len(segments)))
+        with Instrumentation.measure('crypto.decrypt_parallel') as measurement:
+            run_segments(decrypt_file_segment,
+                         [(key, self.iv, input_file, output_file, offset, length) for offset, length in segments],
+                         workers or os.cpu_count(), use_processes)
+            measurement.add_bytes(size)
+        remove_padding_of_file(output_file)
+
+    def decrypt_local_file(self, input_file, output_file, workers=1, segment_size=DEFAULT_SEGMENT_SIZE):
+        """
+        Decrypt a local file, in segments by a pool of workers if there are more workers and the file is bigger than a
+        single segment.
+
+        Args:
+            input_file(str): path to the encrypted file
+            output_file(str): path to the decrypted file
+            workers(int): size of the pool
+            segment_size(int): number of bytes decrypted by a single task
+        """
+        if workers > 1 and os.path.getsize(input_file) > segment_size:
+            self.decrypt_file_parallel(input_file, output_file, workers=workers, segment_size=segment_size)
+        else:
+            self.decrypt_file(input_file, output_file)
+
     def decrypt_bytes(self, crypto_text):
         """
         
@@ -115,8 +459,7 @@ class EnvelopeFileCryptor(object):
         Returns:
             bytes: plaintext
         """
-        cipher = Cipher(algorithms.AES(self.get_decrypted_data_key()), modes.CBC(self.iv), backend=backend)
-        decryptor = cipher.decryptor()
+        decryptor = get_aes_decryptor(self.get_decrypted_data_key(), self.iv)
         padded_plaintext = decryptor.update(crypto_text) + decryptor.finalize()
         return S3EnvelopeFileCryptor.un_pad(padded_plaintext)
 
@@ -138,21 +481,71 @@ class S3EnvelopeFileCryptor(EnvelopeFileCryptor):
             data_key=s3file.get_x_amz_key()
         )
 
-    def decrypt(self, s3_file_transfer):
+    def decrypt_parallel(self, s3_file_transfer, workers=None, segment_size=DEFAULT_SEGMENT_SIZE, use_processes=True):
         """
-        Decrypt an S3FileTransfer target file
+        Decrypt an S3FileTransfer target file by cutting the S3 object in block aligned segments that are fetched with
+        ranged GETs and decrypted by a pool of workers.  Every segment is written to its offset in a preallocated
+        target file.  If decryption fails the partial target file is removed.
 
         Args:
             s3_file_transfer(S3FileTransfer): Contains the S3File to be decrypted and the target location
+            workers(int): size of the pool, defaults to the number of CPUs
+            segment_size(int): number of bytes fetched and decrypted by a single task
+            use_processes(bool): use a process pool such that decryption runs on all cores
+        """
+        target_file = s3_file_transfer.get_local_file()
+        s3_file = s3_file_transfer.get_s3_file()
+        s3_file_transfer.make_sure_local_parent_dir_exists()
+        size = s3_file_transfer.get_size()
+        segments = get_segments(size, segment_size)
+        key = self.get_decrypted_data_key()
+        region = s3_file.get_region()
+        if region == 'unknown':
+            region = None
+        logging.debug('Decrypting {s3f} to {tf} in {n} segments'.format(s3f=str(s3_file), tf=target_file,
+                                                                        n=len(segments)))
+        try:
+            preallocate_file(target_file, size)
+            # The segments are fetched and decrypted in worker processes so this measures both
+            with Instrumentation.measure('crypto.fetch_and_decrypt_parallel') as measurement:
+                run_segments(decrypt_s3_segment,
+                             [(key, self.iv, s3_file.get_bucket(), s3_file.get_key(), region, target_file, offset,
+                               length) for offset, length in segments],
+                             workers or os.cpu_count(), use_processes)
+                measurement.add_bytes(size)
+            remove_padding_of_file(target_file)
+        except Exception:
+            if os.path.isfile(target_file):
+                os.remove(target_file)
+            raise
+
+    def decrypt(self, s3_file_transfer, bytes_per_fetch=10000000, requests_in_flight=1):
+        """
+        Decrypt an S3FileTransfer target file.  The S3 object is fetched in ranges that are decrypted as they arrive so
+        only plaintext is written to the target location.  If decryption fails the partial target file is removed.
+
+        Args:
+            s3_file_transfer(S3FileTransfer): Contains the S3File to be decrypted and the target location
+            bytes_per_fetch(int): size of the ranged GETs
+            requests_in_flight(int): number of ranged GETs that are fetched at the same time
 
         Returns:
 
         """
         target_file = s3_file_transfer.get_local_file()
         logging.debug('Will decrypt to {tf}'.format(tf=target_file))
+        s3_file_transfer.make_sure_local_parent_dir_exists()
 
-        input_file = s3_file_transfer.move_to_temp_location()
-        logging.debug('Will use temp location to {tl}'.format(tl=input_file))
-
-        self.decrypt_file(input_file, target_file)
-        s3_file_transfer.cleanup_temp_file()
+        decryptor = self.get_streaming_decryptor()
+        read_ahead = S3ReadAhead([s3_file_transfer], bytes_per_fetch=bytes_per_fetch,
+                                 requests_in_flight=requests_in_flight)
+        try:
+            with open(target_file, 'wb') as out_file:
+                for _, crypto_text, is_last in read_ahead:
+                    out_file.write(decryptor.update(crypto_text))
+                    if is_last:
+                        out_file.write(decryptor.finalize())
+        except Exception:
+            if os.path.isfile(target_file):
+                os.remove(target_file)
+            raise
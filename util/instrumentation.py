@@ -0,0 +1,276 @@
+import json
+import logging
+import os
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets: 1 ms doubling up to about 2 minutes
+HISTOGRAM_BOUNDS = [0.001 * 2 ** index for index in range(18)]
+PROMETHEUS_PREFIX = 'redshift_manifest_tools'
+
+
+class Histogram:
+    """
+    Latency histogram with fixed exponential buckets, cheap to update and mergeable into Prometheus histograms.
+    """
+    def __init__(self, bounds=HISTOGRAM_BOUNDS):
+        self.bounds = bounds
+        self.bucket_counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def get_percentile(self, percentile):
+        """
+
+        Args:
+            percentile(float): between 0 and 100
+
+        Returns:
+            float: upper bound of the bucket of the percentile (at most the maximum), None if nothing was observed
+        """
+        if self.count == 0:
+            return None
+        rank = self.count * percentile / 100
+        cumulative = 0
+        for index, bucket_count in enumerate(self.bucket_counts):
+            cumulative += bucket_count
+            if cumulative >= rank and bucket_count > 0:
+                if index == len(self.bounds):
+                    return self.max
+                return min(self.bounds[index], self.max)
+        return self.max
+
+    def get_cumulative_counts(self):
+        """
+
+        Returns:
+            list: tuples (upper bound, number of observations up to that bound), the last bound is infinity
+        """
+        cumulative_counts = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.bounds + [float('inf')], self.bucket_counts):
+            cumulative += bucket_count
+            cumulative_counts.append((bound, cumulative))
+        return cumulative_counts
+
+
+class StageStats:
+    """
+    Timings, bytes and errors of a stage, e.g. 's3.head' or 'crypto.decrypt'.
+    """
+    def __init__(self):
+        self.histogram = Histogram()
+        self.byte_count = 0
+        self.error_count = 0
+
+    def to_dict(self):
+        histogram = self.histogram
+        return {
+            'count': histogram.count,
+            'errors': self.error_count,
+            'bytes': self.byte_count,
+            'seconds_total': histogram.sum,
+            'seconds_min': histogram.min,
+            'seconds_max': histogram.max,
+            'seconds_p50': histogram.get_percentile(50),
+            'seconds_p90': histogram.get_percentile(90),
+            'seconds_p99': histogram.get_percentile(99)
+        }
+
+
+class NullMeasurement:
+    """
+    Returned by Instrumentation.measure when instrumentation is disabled, every method does nothing.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add_bytes(self, byte_count):
+        pass
+
+
+NULL_MEASUREMENT = NullMeasurement()
+
+
+class Measurement:
+    """
+    Times the block of a with statement and records it under its stage, exceptions count as errors.
+    """
+    def __init__(self, stage):
+        self.stage = stage
+        self.byte_count = 0
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        Instrumentation.record(self.stage, time.perf_counter() - self.start, byte_count=self.byte_count,
+                               error=exc_type is not None)
+        return False
+
+    def add_bytes(self, byte_count):
+        self.byte_count += byte_count
+
+
+class Instrumentation:
+    """
+    Process-wide collection of timings per stage and counts of events (retries, hedges, ...).  It is disabled by
+    default, then measure() returns a shared object that does nothing and count() returns right away, so instrumented
+    code pays about a function call.
+
+        with Instrumentation.measure('s3.get_range') as measurement:
+            ...
+            measurement.add_bytes(length)
+
+    With trace enabled every measurement is also logged at debug level.
+    """
+    lock = threading.Lock()
+    enabled = False
+    trace = False
+    stages = {}
+    events = {}
+    start_time = None
+
+    @staticmethod
+    def enable(trace=False):
+        with Instrumentation.lock:
+            Instrumentation.enabled = True
+            Instrumentation.trace = trace
+            Instrumentation.start_time = time.time()
+
+    @staticmethod
+    def reset():
+        """
+        Disable instrumentation and drop everything that was recorded.
+        """
+        with Instrumentation.lock:
+            Instrumentation.enabled = False
+            Instrumentation.trace = False
+            Instrumentation.stages = {}
+            Instrumentation.events = {}
+            Instrumentation.start_time = None
+
+    @staticmethod
+    def measure(stage):
+        """
+
+        Args:
+            stage(str): name of the stage, dot separated like 's3.head'
+
+        Returns:
+            a context manager that records the duration of its block
+        """
+        if not Instrumentation.enabled:
+            return NULL_MEASUREMENT
+        return Measurement(stage)
+
+    @staticmethod
+    def record(stage, seconds, byte_count=0, error=False):
+        if not Instrumentation.enabled:
+            return
+        with Instrumentation.lock:
+            if stage not in Instrumentation.stages:
+                Instrumentation.stages[stage] = StageStats()
+            stage_stats = Instrumentation.stages[stage]
+            stage_stats.histogram.observe(seconds)
+            stage_stats.byte_count += byte_count
+            if error:
+                stage_stats.error_count += 1
+        if Instrumentation.trace:
+            logging.debug('{s} took {t:.6f} seconds for {b} bytes{e}'.format(s=stage, t=seconds, b=byte_count,
+                                                                             e=' (failed)' if error else ''))
+
+    @staticmethod
+    def count(event, increment=1):
+        """
+
+        Args:
+            event(str): name of the event, e.g. 's3.retry'
+            increment(int):
+        """
+        if not Instrumentation.enabled:
+            return
+        with Instrumentation.lock:
+            Instrumentation.events[event] = Instrumentation.events.get(event, 0) + increment
+
+    @staticmethod
+    def get_summary():
+        """
+
+        Returns:
+            dict: the stages and events recorded so far, suitable for JSON
+        """
+        with Instrumentation.lock:
+            summary = {
+                'stages': {stage: stats.to_dict() for stage, stats in sorted(Instrumentation.stages.items())},
+                'events': dict(sorted(Instrumentation.events.items()))
+            }
+        if Instrumentation.start_time is not None:
+            summary['elapsed_seconds'] = time.time() - Instrumentation.start_time
+        return summary
+
+    @staticmethod
+    def get_prometheus_text():
+        """
+
+        Returns:
+            str: the stages and events in the Prometheus text exposition format
+        """
+        lines = ['# TYPE {p}_stage_seconds histogram'.format(p=PROMETHEUS_PREFIX)]
+        with Instrumentation.lock:
+            stages = sorted(Instrumentation.stages.items())
+            events = sorted(Instrumentation.events.items())
+            for stage, stats in stages:
+                for bound, cumulative in stats.histogram.get_cumulative_counts():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{p}_stage_seconds_bucket{{stage="{s}",le="{le}"}} {c}'
+                                 .format(p=PROMETHEUS_PREFIX, s=stage, le=le, c=cumulative))
+                lines.append('{p}_stage_seconds_sum{{stage="{s}"}} {v}'
+                             .format(p=PROMETHEUS_PREFIX, s=stage, v=repr(stats.histogram.sum)))
+                lines.append('{p}_stage_seconds_count{{stage="{s}"}} {v}'
+                             .format(p=PROMETHEUS_PREFIX, s=stage, v=stats.histogram.count))
+            for metric, attribute in [('stage_bytes_total', 'byte_count'), ('stage_errors_total', 'error_count')]:
+                lines.append('# TYPE {p}_{m} counter'.format(p=PROMETHEUS_PREFIX, m=metric))
+                for stage, stats in stages:
+                    lines.append('{p}_{m}{{stage="{s}"}} {v}'
+                                 .format(p=PROMETHEUS_PREFIX, m=metric, s=stage, v=getattr(stats, attribute)))
+            lines.append('# TYPE {p}_events_total counter'.format(p=PROMETHEUS_PREFIX))
+            for event, event_count in events:
+                lines.append('{p}_events_total{{event="{e}"}} {v}'.format(p=PROMETHEUS_PREFIX, e=event, v=event_count))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def write(metrics_file):
+        """
+        Write what was recorded, in the Prometheus text format if the file name ends with .prom (e.g. for the textfile
+        collector of the node exporter) and as a JSON summary otherwise.  The file is replaced atomically.
+
+        Args:
+            metrics_file(str):
+        """
+        if metrics_file.endswith('.prom'):
+            content = Instrumentation.get_prometheus_text()
+        else:
+            content = json.dumps(Instrumentation.get_summary(), indent=2, sort_keys=True) + '\n'
+        temp_file = '{f}.tmp.{pid}'.format(f=metrics_file, pid=os.getpid())
+        with open(temp_file, 'w') as temp_file_handle:
+            temp_file_handle.write(content)
+        os.replace(temp_file, metrics_file)
+        logging.debug('Metrics written to {f}'.format(f=metrics_file))
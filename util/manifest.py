@@ -1,10 +1,189 @@
-from util.s3_file import S3File
+from util.s3_file import S3File, parse_s3_path, get_s3_file_name
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Sequence
+import codecs
+import operator
+import logging
+import os
 import json
+import sys
 
+MANIFEST_READ_SIZE = 1024 * 1024
+JSON_WHITESPACE = ' \t\n\r'
+JSON_NUMBER_CHARACTERS = '0123456789.eE+-'
 
-class Manifest:
-    s3_files = []
 
+class ManifestJsonParser:
+    """
+    Parse manifest JSON from text chunks without holding the whole document, or all its parsed entries, in memory.
+    The top-level values are decoded one at a time with JSONDecoder.raw_decode and the elements of "entries" are
+    generated one by one.
+
+    Iterating yields tuples (key, value) for every top-level key, and ('entries', entry) for every entry.
+    """
+    def __init__(self, text_chunks):
+        self.chunks = iter(text_chunks)
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def read_more(self):
+        """
+
+        Returns:
+            bool: False at the end of the input
+        """
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self):
+        """
+
+        Returns:
+            str: the next character that is not whitespace, without consuming it, or '' at the end of the input
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in JSON_WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read_more():
+                return ''
+
+    def expect(self, characters):
+        character = self.peek()
+        if character == '' or character not in characters:
+            raise(ValueError('Invalid manifest JSON: expected one of {e} at {p} but got {g}'
+                             .format(e=characters, p=self.position, g=repr(character))))
+        self.position += 1
+        return character
+
+    def decode_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # A number that is cut off by the end of the buffer (e.g. 12 of 12.5) looks complete, in valid JSON a
+                # value is never followed by a character of a number
+                if self.eof or (end < len(self.buffer) and self.buffer[end] not in JSON_NUMBER_CHARACTERS):
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+    def __iter__(self):
+        self.expect('{')
+        if self.peek() == '}':
+            return
+        while True:
+            key = self.decode_value()
+            self.expect(':')
+            if key == 'entries' and self.peek() == '[':
+                self.expect('[')
+                if self.peek() == ']':
+                    self.position += 1
+                else:
+                    while True:
+                        yield key, self.decode_value()
+                        if self.expect(',]') == ']':
+                            break
+            else:
+                yield key, self.decode_value()
+            if self.expect(',}') == '}':
+                return
+
+
+def decode_chunks(binary_chunks):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in binary_chunks:
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+
+class ManifestEntry:
+    """
+    Compact record of a manifest entry.  Bucket names are interned since a manifest only has a few.  The S3File of an
+    entry, with its connection, metadata and encryption state, is only created when it is used (see
+    Manifest.get_s3_file), metadata that is known before that is kept in the entry.
+    """
+    __slots__ = ('bucket', 'key', 'content_length', 'record_count', 'etag', 'last_modified', 's3_file')
+
+    def __init__(self, bucket, key, content_length=None, record_count=None):
+        self.bucket = sys.intern(bucket)
+        self.key = key
+        self.content_length = content_length
+        self.record_count = record_count
+        self.etag = None
+        self.last_modified = None
+        self.s3_file = None
+
+    def get_bucket(self):
+        return self.bucket
+
+    def get_key(self):
+        return self.key
+
+    def get_s3_file_name(self, prefix=None):
+        return get_s3_file_name(self.bucket, self.key, prefix=prefix)
+
+    def has_size(self):
+        if self.s3_file is not None:
+            return self.s3_file.has_size()
+        return self.content_length is not None
+
+    def has_etag(self):
+        if self.s3_file is not None:
+            return self.s3_file.has_etag()
+        return self.etag is not None
+
+    def set_listing_meta(self, size, etag=None, last_modified=None):
+        if self.s3_file is not None:
+            self.s3_file.set_listing_meta(size, etag=etag, last_modified=last_modified)
+        else:
+            self.content_length = size
+            self.etag = etag
+            self.last_modified = last_modified
+
+    def __str__(self):
+        return 's3://{bucket}/{key}'.format(bucket=self.bucket, key=self.key)
+
+
+class ManifestFiles(Sequence):
+    """
+    The S3File objects of a manifest as a list, they are created when they are accessed.
+    """
+    def __init__(self, manifest):
+        self.manifest = manifest
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.manifest.get_s3_file(entry_index) for entry_index in range(len(self))[index]]
+        return self.manifest.get_s3_file(index)
+
+    def __len__(self):
+        return len(self.manifest.entries)
+
+    def append(self, s3file):
+        self.manifest.add_s3file(s3file)
+
+    def __contains__(self, item):
+        return item in self.manifest
+
+
+class Manifest:
+    """
+    The entries of a manifest are kept as ManifestEntry records, their S3File objects are only created for the entries
+    that are used (through s3_files or get_s3_file).  The manifest JSON is parsed as a stream so even manifests with
+    hundreds of thousands of entries take megabytes of memory.
+    """
     def __init__(self, *args, **kwargs):
         """
 
@@ -13,6 +192,9 @@ class Manifest:
             **kwargs:
               - manifest_path = path to manifest
               - manifest_json_string
+              - manifest_stream = readable binary stream of the manifest JSON (e.g. an S3 streaming body)
+              - region
+              - region_cache = BucketRegionCache shared by all S3File objects of the manifest
         """
         if len(args) == 1:
             # should be manifest_path
@@ -21,41 +203,180 @@ class Manifest:
         if 'manifest_path' in kwargs:
             self.manifest_path = kwargs['manifest_path']
 
-        manifest_json = {'entries': []}
+        self.region = kwargs.get('region', None)
+        self.region_cache = kwargs.get('region_cache', None)
+        # Manifests created with MANIFEST VERBOSE describe the columns of the unloaded data
+        self.schema = None
+        self.entries = []
+        # Index of the first entry by (bucket, key), built on the first lookup
+        self.entry_index = None
+        self.s3_files = ManifestFiles(self)
 
         if hasattr(self, 'manifest_path'):
             with open(self.manifest_path, 'r') as manifest_file:
-                manifest_json = json.load(manifest_file)
+                self.parse(iter(lambda: manifest_file.read(MANIFEST_READ_SIZE), ''))
+        elif 'manifest_stream' in kwargs:
+            manifest_stream = kwargs['manifest_stream']
+            self.parse(decode_chunks(iter(lambda: manifest_stream.read(MANIFEST_READ_SIZE), b'')))
         elif 'manifest_json_string' in kwargs:
-            manifest_json = json.loads(kwargs['manifest_json_string'])
+            self.parse([kwargs['manifest_json_string']])
 
-        self.region = kwargs.get('region', None)
+    def parse(self, text_chunks):
+        for key, value in ManifestJsonParser(text_chunks):
+            if key == 'entries':
+                bucket, s3_key = parse_s3_path(value['url'])
+                # Manifests created with MANIFEST VERBOSE contain the size and record count of every entry
+                entry_meta = value.get('meta', {})
+                self.add_entry(ManifestEntry(bucket, s3_key, content_length=entry_meta.get('content_length', None),
+                                             record_count=entry_meta.get('record_count', None)))
+            elif key == 'schema':
+                self.schema = value
+
+    def add_entry(self, entry):
+        if self.entry_index is not None:
+            self.entry_index.setdefault((entry.bucket, entry.key), len(self.entries))
+        self.entries.append(entry)
+
+    def get_entry_index(self, item):
+        """
 
-        self.s3_files = []
-        for entry in manifest_json['entries']:
-            self.s3_files.append(S3File(entry['url'], region=self.region))
+        Args:
+            item(S3File):
+
+        Returns:
+            int: index of the first entry with the bucket and key of item, None if the manifest does not have it
+        """
+        if self.entry_index is None:
+            entry_index = {}
+            for index, entry in enumerate(self.entries):
+                entry_index.setdefault((entry.bucket, entry.key), index)
+            self.entry_index = entry_index
+        return self.entry_index.get((item.get_bucket(), item.get_key()), None)
+
+    def get_s3_file(self, index):
+        """
+
+        Args:
+            index(int): index of the entry
+
+        Returns:
+            S3File: the S3File of the entry, created on first use
+        """
+        entry = self.entries[index]
+        if entry.s3_file is None:
+            entry.s3_file = S3File(entry.bucket, entry.key, region=self.region, region_cache=self.region_cache,
+                                   content_length=entry.content_length, record_count=entry.record_count,
+                                   etag=entry.etag, last_modified=entry.last_modified)
+        return entry.s3_file
+
+    def get_size(self, index):
+        """
+
+        Returns:
+            int: the size of the entry, with a HEAD request if it is not known yet
+        """
+        entry = self.entries[index]
+        if entry.s3_file is None and entry.content_length is not None:
+            return entry.content_length
+        return self.get_s3_file(index).get_size()
+
+    def get_columns(self):
+        """
+        E.g. given the schema {"elements": [{"name": "id", "type": {"base": "integer"}}]}
+
+        Returns:
+            list: tuples (name, base type) like [('id', 'integer')] or None if the manifest has no schema
+        """
+        if self.schema is None:
+            return None
+        return [(element['name'], element['type']['base']) for element in self.schema.get('elements', [])]
 
     def add_s3file(self, s3file):
         if isinstance(s3file, S3File):
-            self.s3_files.append(s3file)
+            entry = ManifestEntry(s3file.get_bucket(), s3file.get_key())
+            entry.s3_file = s3file
+            self.add_entry(entry)
         else:
             raise(TypeError('Cannot add {o} to manifest since not of type S3File.'.format(o=str(s3file))))
 
+    def prefetch_metadata(self, parallelism=1, require_etag=False):
+        """
+        Make sure the size of every entry is known without doing a HEAD request per entry.  Entries that share a key
+        prefix are looked up with ListObjectsV2 (up to 1000 keys per call).  Entries that could not be found that way
+        are looked up with concurrent HEAD requests.  Listed metadata is kept in the entries, S3File objects are only
+        created for the entries that need a HEAD request.
+
+        Args:
+            parallelism(int): number of concurrent HEAD requests
+            require_etag(bool): also look up entries of which the size is known (MANIFEST VERBOSE) but the ETag is not
+        """
+        def is_missing_metadata(index):
+            entry = self.entries[index]
+            return not entry.has_size() or (require_etag and not entry.has_etag())
+
+        groups = {}
+        for index, entry in enumerate(self.entries):
+            if is_missing_metadata(index):
+                directory = entry.get_key().rpartition('/')[0]
+                groups.setdefault((entry.get_bucket(), directory), []).append(index)
+
+        files_to_head = []
+        for (bucket, _), indices in groups.items():
+            if len(indices) > 1:
+                self.list_metadata(bucket, indices)
+            files_to_head.extend([self.get_s3_file(index) for index in indices if is_missing_metadata(index)])
+
+        if len(files_to_head) > 0:
+            logging.debug('Getting metadata of {n} files with HEAD requests'.format(n=len(files_to_head)))
+            with ThreadPoolExecutor(max_workers=max(1, int(parallelism))) as executor:
+                list(executor.map(lambda s3file: (s3file.get_size(), s3file.get_etag()), files_to_head))
+
+    def list_metadata(self, bucket, indices, retry_in_bucket_region=True):
+        """
+        Set the size, ETag and last modified timestamp of entries of one bucket using ListObjectsV2 on their common key
+        prefix.  Errors (e.g. no s3:ListBucket permission) are logged and leave the entries untouched.  If no region is
+        known a failed listing is retried once after the bucket region is determined with a HEAD request.
+
+        Args:
+            bucket(str):
+            indices(list): indices of the entries of the bucket
+            retry_in_bucket_region(bool):
+        """
+        entries_by_key = {}
+        for index in indices:
+            entries_by_key[self.entries[index].get_key()] = self.entries[index]
+        prefix = os.path.commonprefix(list(entries_by_key.keys()))
+        logging.debug('Listing s3://{b}/{p} for metadata of {n} files'.format(b=bucket, p=prefix, n=len(indices)))
+        # The S3File of the first entry provides the connection to the bucket region
+        first_s3file = self.get_s3_file(indices[0])
+        try:
+            paginator = first_s3file.get_s3_connection().get_paginator('list_objects_v2')
+            found = 0
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                for s3_object in page.get('Contents', []):
+                    entry = entries_by_key.get(s3_object['Key'], None)
+                    if entry is not None:
+                        entry.set_listing_meta(s3_object['Size'], etag=s3_object.get('ETag', None),
+                                               last_modified=s3_object.get('LastModified', None))
+                        found += 1
+                if found == len(entries_by_key):
+                    break
+        except Exception as e:
+            logging.debug('Could not list s3://{b}/{p}: {e}'.format(b=bucket, p=prefix, e=str(e)))
+            if retry_in_bucket_region and first_s3file.get_region() is None:
+                first_s3file.get_size()
+                remaining = [index for index in indices if not self.entries[index].has_size()]
+                for index in remaining:
+                    self.get_s3_file(index).set_region(first_s3file.get_region())
+                if len(remaining) > 1:
+                    self.list_metadata(bucket, remaining, retry_in_bucket_region=False)
+
     def set_region(self, region):
-        for s3file in self.s3_files:
-            s3file.set_region(region)
+        for entry in self.entries:
+            if entry.s3_file is not None:
+                entry.s3_file.set_region(region)
         self.region = region
 
-    @staticmethod
-    def _get_common_start_strings(str1, str2):
-        common_prefix = ''
-        for index in range(0, len(str1)):
-            if str1[index]==str2[index]:
-                common_prefix += str1[index]
-            else:
-                return common_prefix
-        return common_prefix
-
     def get_common_prefix(self):
         """
         If in the manifest there are multiple files get the part is common for all entries
@@ -67,13 +388,15 @@ class Manifest:
             str: this would return s3://bucket1/path/to/
 
         """
-        if len(self.s3_files) == 0:
+        if len(self.entries) == 0:
             return ''
-        else:
-            common_prefix = str(self.s3_files[0])
-            for file in self.s3_files[1:]:
-                common_prefix = Manifest._get_common_start_strings(common_prefix, str(file))
-        return common_prefix
+        buckets = set(map(operator.attrgetter('bucket'), self.entries))
+        if len(buckets) > 1:
+            # Bucket names have no slash so the common prefix ends before the first different bucket name
+            return os.path.commonprefix(['s3://{b}/'.format(b=bucket) for bucket in buckets])
+        # The common prefix of the smallest and the biggest key is the common prefix of all keys
+        keys = list(map(operator.attrgetter('key'), self.entries))
+        return 's3://{b}/{p}'.format(b=buckets.pop(), p=os.path.commonprefix([min(keys), max(keys)]))
 
     def get_common_path_prefix(self):
         common_prefix = self.get_common_prefix()
@@ -84,10 +407,7 @@ class Manifest:
             return common_prefix[0:index_last_slash+1]
 
     def __contains__(self, item):
-        for s3file in self.s3_files:
-            if s3file == item:
-                return True
-        return False
+        return self.get_entry_index(item) is not None
 
     def __len__(self):
-        return len(self.s3_files)
\ No newline at end of file
+        return len(self.entries)
\ No newline at end of file
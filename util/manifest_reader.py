@@ -0,0 +1,140 @@
+from util.bucket_region_cache import BucketRegionCache
+from util.s3_file_transfer import S3FileTransfer
+from util.s3_helper import S3Helper
+import io
+
+
+class ManifestPartReader(io.RawIOBase):
+    """
+    Readable stream of a single part of a ManifestReader.  It shares the read-ahead of the ManifestReader, therefore
+    parts need to be read in manifest order.  Content of a part that is not read before a later part is read is skipped.
+    """
+    def __init__(self, manifest_reader, part_index):
+        super(ManifestPartReader, self).__init__()
+        self.manifest_reader = manifest_reader
+        self.part_index = part_index
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self.manifest_reader.readinto_part(self.part_index, b)
+
+
+class ManifestReader(io.RawIOBase):
+    """
+    Readable stream of the concatenated content of the parts of a manifest, decrypted and decompressed in the same way
+    as cat-files does.  Fragments are fetched with ranged GETs that run ahead of the reader, possibly into the next
+    parts.  Every reader has its own state so several readers can be used at the same time (e.g. from different
+    threads).
+
+    Wrap it in io.BufferedReader for readline() and small reads, or use iter_parts() to read the parts one by one:
+
+        with ManifestReader(S3File('s3://bucket/unload/manifest'), parallelism=4) as reader:
+            for line in io.BufferedReader(reader):
+                ...
+    """
+    def __init__(self, s3file_manifest, **kwargs):
+        """
+
+        Args:
+            s3file_manifest(S3File): the manifest to read
+            **kwargs:
+              - symmetric_key=None: if provided then client-side encryption is assumed to decrypt the parts
+              - region=None: force the region of the manifest and its parts
+              - parallelism=1: number of ranged GETs in flight
+              - bytes_per_fetch=10000000: size of the ranged GETs
+              - max_buffered_bytes=None: cap on the fetched bytes that are not yet read
+              - decompress=True: decompress parts based on their suffix or magic bytes
+              - cpu_workers=1: number of worker processes that decrypt and decompress the parts, None sizes the pool
+                from the number of CPUs
+              - region_cache_file=None: JSON file in which the bucket regions are cached between runs
+              - prefetch_metadata=True: get the sizes of all parts up front with bulk listings
+        """
+        super(ManifestReader, self).__init__()
+        region_cache = BucketRegionCache(kwargs.get('region_cache_file', None))
+        self.manifest = S3Helper.load_manifest(s3file_manifest, region_cache, **kwargs)
+        region_cache.save()
+        self.s3_transfers = [S3FileTransfer(s3file, None) for s3file in self.manifest.s3_files]
+        self.fragments = S3Helper.iter_processed_fragments(self.s3_transfers, **kwargs)
+        self.buffer = memoryview(b'')
+        # Index of the part the buffer belongs to and whether the buffer holds the last output of that part
+        self.part_index = 0
+        self.part_done = False
+
+    def get_manifest(self):
+        return self.manifest
+
+    def readable(self):
+        return True
+
+    def next_fragment(self):
+        """
+        Load the next processed fragment into the buffer.
+
+        Returns:
+            bool: False if all parts have been read
+        """
+        if self.closed:
+            raise(ValueError('I/O operation on closed ManifestReader'))
+        fragment = next(self.fragments, None)
+        if fragment is None:
+            return False
+        _, output, is_last = fragment
+        if self.part_done:
+            self.part_index += 1
+        self.buffer = memoryview(output)
+        self.part_done = is_last
+        return True
+
+    def copy_buffer_into(self, b):
+        length = min(len(b), len(self.buffer))
+        b[:length] = self.buffer[:length]
+        self.buffer = self.buffer[length:]
+        return length
+
+    def readinto(self, b):
+        """
+        Read the next bytes of the concatenated content into a writable buffer.
+
+        Args:
+            b: writable bytes-like object
+
+        Returns:
+            int: number of bytes read, 0 at the end of the last part
+        """
+        while len(self.buffer) == 0:
+            if not self.next_fragment():
+                return 0
+        return self.copy_buffer_into(b)
+
+    def readinto_part(self, part_index, b):
+        """
+        Like readinto but it stops at the end of part part_index.  Unread content of earlier parts is skipped.
+        """
+        while True:
+            if self.part_index > part_index:
+                return 0
+            if self.part_index == part_index and len(self.buffer) > 0:
+                return self.copy_buffer_into(b)
+            if self.part_index == part_index and self.part_done:
+                return 0
+            if not self.next_fragment():
+                return 0
+
+    def iter_parts(self):
+        """
+        Generate the parts in manifest order.
+
+        Returns:
+            generator: tuples (S3File, ManifestPartReader)
+        """
+        for part_index, s3_transfer in enumerate(self.s3_transfers):
+            yield s3_transfer.get_s3_file(), ManifestPartReader(self, part_index)
+
+    def close(self):
+        if not self.closed:
+            # Stops the read-ahead of ranges that are not needed anymore
+            self.fragments.close()
+            self.buffer = memoryview(b'')
+        super(ManifestReader, self).close()
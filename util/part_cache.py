@@ -0,0 +1,265 @@
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import threading
+
+# ioctl that clones the extents of a file on filesystems with copy-on-write support (btrfs, xfs, ...)
+FICLONE = 0x40049409
+ENTRY_DIR_NAME = 'objects'
+EVICTION_LOCK_NAME = '.lock'
+
+
+class PartCacheWriter:
+    """
+    Writes an S3 object into the cache while it is streamed elsewhere.  The entry only becomes visible on commit().
+    """
+    def __init__(self, part_cache, s3_file):
+        self.part_cache = part_cache
+        self.s3_file = s3_file
+        self.temp_file = part_cache.get_temp_file(part_cache.get_entry_path(s3_file))
+        self.out_file = open(self.temp_file, 'wb')
+
+    def write(self, data):
+        self.out_file.write(data)
+
+    def commit(self):
+        self.out_file.close()
+        self.part_cache.add_entry(self.s3_file, self.temp_file)
+
+    def abort(self):
+        self.out_file.close()
+        if os.path.isfile(self.temp_file):
+            os.remove(self.temp_file)
+
+
+class PartCache:
+    """
+    Content-addressed on-disk cache of S3 objects that can be shared by several processes on the same host.  An object
+    is stored under the sha256 of its bucket, key and ETag so a changed object is never served from the cache.
+
+    Entries are written to a temporary file and renamed into place.  Local files are reflinked or copied from an entry,
+    never hard linked, so writing to a local file cannot modify the cache.  Every entry has a lock file: readers hold a
+    shared lock, the process that downloads a missing entry holds an exclusive lock such that other processes wait for
+    it instead of downloading the same object.  The mtime of the lock file is the last use of the entry, the entry
+    itself is never touched.  Eviction removes the least recently used entries until the cache fits in max_bytes,
+    skipping entries that are in use.
+    """
+    def __init__(self, cache_dir, max_bytes=None):
+        """
+
+        Args:
+            cache_dir(str): directory of the cache, created if it does not exist
+            max_bytes(int): size limit of the cache, None means unlimited
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(cache_dir, ENTRY_DIR_NAME), exist_ok=True)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_added_since_eviction = 0
+
+    @staticmethod
+    def get_cache_key(s3_file):
+        etag = s3_file.get_etag()
+        if etag is None:
+            raise(Exception('Cannot cache {f} because its ETag is unknown'.format(f=str(s3_file))))
+        cache_key = '{b}/{k}/{e}'.format(b=s3_file.get_bucket(), k=s3_file.get_key(), e=etag)
+        return hashlib.sha256(cache_key.encode('utf-8')).hexdigest()
+
+    def get_entry_path(self, s3_file):
+        cache_key = PartCache.get_cache_key(s3_file)
+        return os.path.join(self.cache_dir, ENTRY_DIR_NAME, cache_key[:2], cache_key)
+
+    @staticmethod
+    def mark_used(entry_path):
+        with open(entry_path + '.lock', 'a'):
+            os.utime(entry_path + '.lock')
+
+    @staticmethod
+    def get_last_use(entry_path, entry_stat):
+        try:
+            return os.stat(entry_path + '.lock').st_mtime
+        except FileNotFoundError:
+            return entry_stat.st_mtime
+
+    @staticmethod
+    def get_temp_file(entry_path):
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        return '{p}.{pid}.{tid}.tmp'.format(p=entry_path, pid=os.getpid(), tid=threading.get_ident())
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get_stats(self):
+        """
+
+        Returns:
+            dict: the hits and misses of this process
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    @contextlib.contextmanager
+    def get_cached_file(self, s3_file):
+        """
+        Context manager that yields the path of the cached copy of an S3 object, the object is downloaded into the
+        cache first if it is missing.  The entry is not evicted while the context is active.
+
+        Args:
+            s3_file(S3File):
+        """
+        entry_path = self.get_entry_path(s3_file)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        with open(entry_path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            if os.path.isfile(entry_path):
+                self.count(hit=True)
+                PartCache.mark_used(entry_path)
+            else:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # Another process can have added the entry while waiting for the exclusive lock
+                self.count(hit=os.path.isfile(entry_path))
+                if not os.path.isfile(entry_path):
+                    temp_file = PartCache.get_temp_file(entry_path)
+                    try:
+                        s3_file.download_file(temp_file)
+                        self.add_entry(s3_file, temp_file, locked=True)
+                    finally:
+                        if os.path.isfile(temp_file):
+                            os.remove(temp_file)
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+            yield entry_path
+        self.evict_if_needed()
+
+    def get_cached_file_if_present(self, s3_file):
+        """
+
+        Returns:
+            str: path of the cached copy of an S3 object or None if it is not in the cache
+        """
+        entry_path = self.get_entry_path(s3_file)
+        if not os.path.isfile(entry_path):
+            self.count(hit=False)
+            return None
+        self.count(hit=True)
+        PartCache.mark_used(entry_path)
+        return entry_path
+
+    def get_writer(self, s3_file):
+        """
+
+        Returns:
+            PartCacheWriter: to add an S3 object of which the content is streamed
+        """
+        return PartCacheWriter(self, s3_file)
+
+    def add_entry(self, s3_file, temp_file, locked=False):
+        """
+        Move a complete temporary file into the cache.
+
+        Args:
+            s3_file(S3File):
+            temp_file(str): file in the cache directory with the content of the S3 object
+            locked(bool): whether the caller holds the exclusive lock of the entry
+        """
+        entry_path = self.get_entry_path(s3_file)
+        if locked:
+            os.replace(temp_file, entry_path)
+        else:
+            with open(entry_path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                os.replace(temp_file, entry_path)
+        PartCache.mark_used(entry_path)
+        logging.debug('Added {f} to the part cache as {e}'.format(f=str(s3_file), e=entry_path))
+        with self.lock:
+            self.bytes_added_since_eviction += os.path.getsize(entry_path)
+
+    def evict_if_needed(self):
+        """
+        Evict when the bytes added since the previous eviction could have made the cache exceed its limit by more than
+        5%.  This avoids scanning the cache directory for every new entry.
+        """
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            if self.bytes_added_since_eviction <= self.max_bytes * 0.05:
+                return
+            self.bytes_added_since_eviction = 0
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.  Only one process evicts at a time and
+        entries that are in use by any process are skipped.
+
+        Returns:
+            int: the number of bytes that were removed
+        """
+        if self.max_bytes is None:
+            return 0
+        with open(os.path.join(self.cache_dir, EVICTION_LOCK_NAME), 'a') as eviction_lock:
+            fcntl.flock(eviction_lock, fcntl.LOCK_EX)
+            entries = []
+            entry_dir = os.path.join(self.cache_dir, ENTRY_DIR_NAME)
+            for sub_dir in os.scandir(entry_dir):
+                if not sub_dir.is_dir():
+                    continue
+                for entry in os.scandir(sub_dir.path):
+                    if entry.is_file() and '.' not in entry.name:
+                        entry_stat = entry.stat()
+                        entries.append((PartCache.get_last_use(entry.path, entry_stat), entry_stat.st_size, entry.path))
+            total_bytes = sum(entry[1] for entry in entries)
+            removed_bytes = 0
+            for _, size, entry_path in sorted(entries):
+                if total_bytes - removed_bytes <= self.max_bytes:
+                    break
+                with open(entry_path + '.lock', 'a') as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    os.remove(entry_path)
+                    os.remove(entry_path + '.lock')
+                removed_bytes += size
+            logging.debug('Evicted {r} of {t} bytes from the part cache'.format(r=removed_bytes, t=total_bytes))
+            return removed_bytes
+
+    @staticmethod
+    def reflink_or_copy(source, destination):
+        """
+        Make destination a copy of source, preferring a reflink (copy-on-write clone) over a full copy.  A hard link is
+        never used: the local file would share the inode, and so the content and mtime, of the cache entry.  An
+        existing destination is replaced.
+
+        Args:
+            source(str): a file in the cache
+            destination(str):
+
+        Returns:
+            str: 'reflink' or 'copy'
+        """
+        temp_file = '{d}.{pid}.{tid}.tmp'.format(d=destination, pid=os.getpid(), tid=threading.get_ident())
+        try:
+            with open(source, 'rb') as source_file, open(temp_file, 'wb') as temp_file_handle:
+                fcntl.ioctl(temp_file_handle.fileno(), FICLONE, source_file.fileno())
+            os.replace(temp_file, destination)
+            return 'reflink'
+        except OSError:
+            if os.path.isfile(temp_file):
+                os.remove(temp_file)
+        try:
+            shutil.copyfile(source, temp_file)
+            os.replace(temp_file, destination)
+        except Exception:
+            if os.path.isfile(temp_file):
+                os.remove(temp_file)
+            raise
+        return 'copy'
@@ -0,0 +1,38 @@
+import heapq
+
+
+def assign_longest_processing_time_first(weights, bin_count):
+    """
+    Assign items to bins such that the total weights of the bins stay balanced, using the longest processing time first
+    heuristic: items are taken from heavy to light and each goes to the bin with the lowest total so far.  The result
+    is deterministic (ties are broken by index) so independent processes that assign the same items get the same bins.
+
+    Args:
+        weights(list): weight (e.g. size in bytes) of every item
+        bin_count(int): number of bins
+
+    Returns:
+        list: for every bin the indices of its items in ascending order
+    """
+    if bin_count < 1:
+        raise(ValueError('At least 1 bin is needed, got {n}'.format(n=bin_count)))
+    bins = [[] for _ in range(bin_count)]
+    loads = [(0, bin_index) for bin_index in range(bin_count)]
+    for index in sorted(range(len(weights)), key=lambda item_index: (-weights[item_index], item_index)):
+        load, bin_index = heapq.heappop(loads)
+        bins[bin_index].append(index)
+        heapq.heappush(loads, (load + weights[index], bin_index))
+    return [sorted(indices) for indices in bins]
+
+
+def get_bin_weights(weights, bins):
+    """
+
+    Args:
+        weights(list): weight of every item
+        bins(list): for every bin the indices of its items
+
+    Returns:
+        list: the total weight of every bin
+    """
+    return [sum(weights[index] for index in indices) for indices in bins]
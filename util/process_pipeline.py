@@ -0,0 +1,250 @@
+from util.file_cryptor import StreamingDecryptor, get_worker_process_context
+from util.stream_decompressor import StreamDecompressor, get_stream_decompressor
+from util.stream_processor import StreamProcessor
+from util.instrumentation import Instrumentation
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from multiprocessing import shared_memory
+import concurrent.futures
+import logging
+import os
+import time
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Stream processors of the files that are being processed by this worker process, by file number
+worker_stream_processors = {}
+
+
+def get_default_cpu_workers():
+    """
+
+    Returns:
+        int: one worker per CPU, except the one that is left for the network I/O of the calling process
+    """
+    return max(1, (os.cpu_count() or 1) - 1)
+
+
+def create_stream_processor(key, decompress=True, data_key=None, iv=None):
+    """
+
+    Args:
+        key(str): key of the S3 object, its suffix picks the decompressor
+        decompress(bool): if False the (decrypted) content is passed on as is
+        data_key(bytes): the decrypted data key of a client-side encrypted object, None if it is not encrypted
+        iv(bytes): the initialization vector of a client-side encrypted object
+
+    Returns:
+        StreamProcessor:
+    """
+    decryptor = None
+    if data_key is not None:
+        decryptor = StreamingDecryptor(data_key, iv)
+    if decompress:
+        decompressor = get_stream_decompressor(key)
+    else:
+        decompressor = StreamDecompressor()
+    return StreamProcessor(decompressor, decryptor=decryptor)
+
+
+def start_worker():
+    """
+    Runs in a worker process to start it, which also imports this module in the worker before the first chunk.
+
+    Returns:
+        int: process id of the worker
+    """
+    return os.getpid()
+
+
+def process_shared_chunk(file_number, processor_arguments, input_name, length, is_last, output_name):
+    """
+    Runs in a worker process: process the next chunk of a file that the calling process put in shared memory.  All
+    chunks of a file go to the same worker in order, so the worker keeps the stream processor of the file in between.
+    The chunk is read in place and the output is written to the output slot; an output that does not fit goes to a new,
+    bigger block that replaces the slot.
+
+    Args:
+        file_number(int): position of the file in the pipeline
+        processor_arguments(tuple): arguments of create_stream_processor for the file
+        input_name(str): name of the shared memory block with the chunk
+        length(int): number of bytes of the chunk in the block
+        is_last(bool): whether this is the last chunk of the file
+        output_name(str): name of the shared memory block to which the output is written
+
+    Returns:
+        tuple: (output length, name of the new block with the output or None if it fit in the output slot,
+          seconds spent)
+    """
+    start = time.perf_counter()
+    if file_number not in worker_stream_processors:
+        worker_stream_processors[file_number] = create_stream_processor(*processor_arguments)
+    stream_processor = worker_stream_processors[file_number]
+    input_block = shared_memory.SharedMemory(name=input_name)
+    output_block = shared_memory.SharedMemory(name=output_name)
+    new_output_name = None
+    input_view = input_block.buf[:length]
+    try:
+        # The decompressor can hand back the input itself, so the output is written before the input is released
+        outputs = [stream_processor.process(input_view)]
+        if is_last:
+            outputs.append(stream_processor.finish())
+            del worker_stream_processors[file_number]
+        output_length = sum(len(output) for output in outputs)
+        if output_length > output_block.size:
+            output_block.close()
+            output_block = shared_memory.SharedMemory(create=True, size=output_length + output_length // 4)
+            new_output_name = output_block.name
+        offset = 0
+        for output in outputs:
+            output_block.buf[offset:offset + len(output)] = output
+            offset += len(output)
+        del outputs
+    finally:
+        input_view.release()
+        input_block.close()
+        output_block.close()
+    return output_length, new_output_name, time.perf_counter() - start
+
+
+def get_chunks(length, chunk_size):
+    """
+
+    Returns:
+        list: tuples (offset, length) that cover length bytes, an empty fragment gives a single empty chunk
+    """
+    if length == 0:
+        return [(0, 0)]
+    return [(offset, min(chunk_size, length - offset)) for offset in range(0, length, chunk_size)]
+
+
+def remove_shared_memory(block):
+    block.close()
+    block.unlink()
+
+
+class ProcessPipeline:
+    """
+    CPU stage of a cat: decryption and decompression run in a pool of worker processes while the calling process only
+    does the network I/O (e.g. an S3ReadAhead).  Fragments are cut in chunks that are passed to the workers through a
+    fixed set of shared memory input slots, and the output comes back in a set of shared memory output slots, so no
+    bytes are pickled and no shared memory is created per chunk.
+
+    Decryption and decompression of a file are sequential, so every file is processed by a single worker and the
+    workers run in parallel on different files.  An input slot is free again as soon as its chunk is processed, in any
+    order, while the output waits in its output slot until it is handed back in the order of the fragments.  That way
+    the pipeline reads ahead into the next files, for the other workers, while a worker is busy with a big file.  When
+    all output slots are in use the pipeline waits for the oldest chunk before it reads the next fragment, which bounds
+    the memory and pushes back on the I/O stage.
+    """
+    def __init__(self, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, chunks_in_flight=None, outputs_in_flight=None):
+        """
+
+        Args:
+            workers(int): number of worker processes, by default get_default_cpu_workers()
+            chunk_size(int): size of an input slot, bigger fragments are cut in chunks of this size
+            chunks_in_flight(int): number of input slots, by default 2 per worker so every worker has a chunk queued
+            outputs_in_flight(int): number of output slots, which bounds the chunks that are read ahead, by default
+              twice the number of input slots
+        """
+        self.workers = int(workers or get_default_cpu_workers())
+        self.chunk_size = int(chunk_size)
+        self.chunks_in_flight = int(chunks_in_flight or 2 * self.workers)
+        self.outputs_in_flight = int(outputs_in_flight or 2 * self.chunks_in_flight)
+
+    def process(self, fragments, get_processor_arguments):
+        """
+
+        Args:
+            fragments(iterable): tuples (s3_transfer, data, is_last) like S3ReadAhead yields them
+            get_processor_arguments(callable): gives the arguments of create_stream_processor for an S3FileTransfer
+
+        Returns:
+            generator: tuples (s3_transfer, output, is_last) in the order of the fragments
+        """
+        logging.debug('Processing fragments with {w} worker processes, {s} input slots of {c} bytes and {o} output '
+                      'slots'.format(w=self.workers, s=self.chunks_in_flight, c=self.chunk_size,
+                                     o=self.outputs_in_flight))
+        # The slots are created first so the resource tracker is running before the workers are started
+        input_slots = [shared_memory.SharedMemory(create=True, size=self.chunk_size)
+                       for _ in range(self.chunks_in_flight)]
+        output_slots = [shared_memory.SharedMemory(create=True, size=self.chunk_size)
+                        for _ in range(self.outputs_in_flight)]
+        free_input_slots = list(range(len(input_slots)))
+        free_output_slots = list(range(len(output_slots)))
+        # A worker per executor, then all chunks of a file are processed in order by the same process
+        executors = [ProcessPoolExecutor(max_workers=1, mp_context=get_worker_process_context())
+                     for _ in range(self.workers)]
+        pending_chunks = deque()
+        # Input slot of the chunks that are still processed, by future
+        processing = {}
+        pending_per_worker = [0] * self.workers
+
+        def release_input_slots(wait=False):
+            if wait:
+                concurrent.futures.wait(processing, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in [future for future in processing if future.done()]:
+                free_input_slots.append(processing.pop(future))
+                # Raise errors of workers right away rather than after the chunks before them
+                future.result()
+
+        def hand_back_oldest_chunk():
+            s3_transfer, future, output_slot, worker, length, is_last = pending_chunks[0]
+            output_length, new_output_name, seconds = future.result()
+            pending_chunks.popleft()
+            pending_per_worker[worker] -= 1
+            if future in processing:
+                free_input_slots.append(processing.pop(future))
+            if new_output_name is not None:
+                remove_shared_memory(output_slots[output_slot])
+                output_slots[output_slot] = shared_memory.SharedMemory(name=new_output_name)
+            output = bytes(output_slots[output_slot].buf[:output_length])
+            free_output_slots.append(output_slot)
+            Instrumentation.record('stream.process', seconds, byte_count=length)
+            return s3_transfer, output, is_last
+
+        try:
+            # Start the workers before the I/O stage starts its threads
+            for future in [executor.submit(start_worker) for executor in executors]:
+                future.result()
+            file_number = 0
+            worker = None
+            processor_arguments = None
+            for s3_transfer, data, is_last in fragments:
+                if worker is None:
+                    worker = pending_per_worker.index(min(pending_per_worker))
+                    processor_arguments = get_processor_arguments(s3_transfer)
+                data = memoryview(data)
+                for offset, length in get_chunks(len(data), self.chunk_size):
+                    release_input_slots()
+                    while len(pending_chunks) > 0 and pending_chunks[0][1].done():
+                        yield hand_back_oldest_chunk()
+                    while len(free_input_slots) == 0 or len(free_output_slots) == 0:
+                        if len(free_output_slots) == 0:
+                            yield hand_back_oldest_chunk()
+                        else:
+                            release_input_slots(wait=True)
+                    input_slot = free_input_slots.pop()
+                    output_slot = free_output_slots.pop()
+                    input_slots[input_slot].buf[:length] = data[offset:offset + length]
+                    is_last_chunk = is_last and offset + length == len(data)
+                    future = executors[worker].submit(process_shared_chunk, file_number, processor_arguments,
+                                                      input_slots[input_slot].name, length, is_last_chunk,
+                                                      output_slots[output_slot].name)
+                    processing[future] = input_slot
+                    pending_chunks.append((s3_transfer, future, output_slot, worker, length, is_last_chunk))
+                    pending_per_worker[worker] += 1
+                if is_last:
+                    file_number += 1
+                    worker = None
+            while len(pending_chunks) > 0:
+                yield hand_back_oldest_chunk()
+        finally:
+            for executor in executors:
+                executor.shutdown(wait=True, cancel_futures=True)
+            # Blocks of outputs that did not fit in their slot and were never handed back
+            for _, future, _, _, _, _ in pending_chunks:
+                if not future.cancelled() and future.exception() is None and future.result()[1] is not None:
+                    remove_shared_memory(shared_memory.SharedMemory(name=future.result()[1]))
+            for slot in input_slots + output_slots:
+                remove_shared_memory(slot)
@@ -0,0 +1,221 @@
+from util.manifest_reader import ManifestReader
+import logging
+
+DEFAULT_BATCH_BYTES = 16 * 1024 * 1024
+
+# Redshift base types by the NumPy dtype they are parsed into, other types are parsed as strings
+INTEGER_TYPES = {'smallint': 'int16', 'int2': 'int16', 'integer': 'int32', 'int': 'int32', 'int4': 'int32',
+                 'bigint': 'int64', 'int8': 'int64'}
+FLOAT_TYPES = {'real': 'float32', 'float4': 'float32', 'double precision': 'float64', 'float8': 'float64',
+               'float': 'float64', 'numeric': 'float64', 'decimal': 'float64'}
+DATETIME_TYPES = {'date': 'datetime64[D]', 'timestamp': 'datetime64[us]',
+                  'timestamp without time zone': 'datetime64[us]'}
+BOOLEAN_TYPES = ['boolean', 'bool']
+TRUE_VALUES = [b't', b'true', b'1']
+
+# With ESCAPE the escaped backslashes, delimiters and newlines are swapped for these placeholders before a batch is
+# split.  They start with a NUL byte, which cannot occur in Redshift text data.
+ESCAPED_BACKSLASH = b'\x00\x01'
+ESCAPED_DELIMITER = b'\x00\x02'
+ESCAPED_NEWLINE = b'\x00\x03'
+# Separates the values of a string column while the column is unescaped and decoded at once
+STRING_SEPARATOR = b'\x00\x04'
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError as e:
+        raise(Exception('The numpy package is required to read record batches (pip install numpy)')) from e
+    return numpy
+
+
+def is_parsed_type(column_type):
+    """
+
+    Returns:
+        bool: whether the Redshift base type is parsed into a number, date, timestamp or boolean instead of a string
+    """
+    column_type = column_type.lower()
+    return column_type in INTEGER_TYPES or column_type in FLOAT_TYPES or column_type in DATETIME_TYPES or \
+        column_type in BOOLEAN_TYPES
+
+
+class RecordBatch:
+    """
+    Columns of consecutive records as NumPy arrays.  String columns are object arrays of str, so a long value does
+    not widen the other values of its column.  Nulls are NaN in float columns and NaT in date and timestamp columns, in
+    other columns they are 0, False or an empty string; null_masks tells which values are null in every column.
+    """
+    def __init__(self, columns, null_masks, num_rows):
+        """
+
+        Args:
+            columns(dict): NumPy array by column name, in schema order
+            null_masks(dict): boolean NumPy array by column name
+            num_rows(int):
+        """
+        self.columns = columns
+        self.null_masks = null_masks
+        self.num_rows = num_rows
+
+    def get_column_names(self):
+        return list(self.columns.keys())
+
+    def __getitem__(self, column_name):
+        return self.columns[column_name]
+
+    def __len__(self):
+        return self.num_rows
+
+
+class RecordBatchReader:
+    """
+    Parse delimited UNLOAD text into RecordBatch objects.  The stream is read in chunks of batch_bytes that are cut at
+    the last record boundary.  Every batch is split into fields with a single bytes.split and every column is converted
+    with NumPy at once, so there is no Python work per record.  numeric and decimal columns are parsed as float64.
+    """
+    def __init__(self, stream, columns, delimiter='|', escape=False, null_as='', batch_bytes=DEFAULT_BATCH_BYTES):
+        """
+
+        Args:
+            stream: readable binary stream with the UNLOAD text (e.g. a ManifestReader)
+            columns(list): tuples (name, Redshift base type) like Manifest.get_columns() returns
+            delimiter(str): the DELIMITER of the UNLOAD
+            escape(bool): whether the UNLOAD used ESCAPE
+            null_as(str): the NULL AS string of the UNLOAD
+            batch_bytes(int): approximate size of the text of a batch
+        """
+        self.numpy = import_numpy()
+        if columns is None or len(columns) == 0:
+            raise(ValueError('Columns are required to read record batches, use MANIFEST VERBOSE or pass them'))
+        self.stream = stream
+        self.columns = columns
+        self.delimiter = delimiter.encode('utf-8')
+        if len(self.delimiter) != 1:
+            raise(ValueError('The delimiter must be a single byte, got {d}'.format(d=delimiter)))
+        self.escape = escape
+        self.null_as = null_as.encode('utf-8')
+        self.batch_bytes = int(batch_bytes)
+
+    @staticmethod
+    def from_manifest(s3file_manifest, columns=None, delimiter='|', escape=False, null_as='',
+                      batch_bytes=DEFAULT_BATCH_BYTES, **kwargs):
+        """
+        Read the record batches of all parts of a manifest.
+
+        Args:
+            s3file_manifest(S3File):
+            columns(list): by default the columns of the schema of a MANIFEST VERBOSE manifest
+            delimiter(str):
+            escape(bool):
+            null_as(str):
+            batch_bytes(int):
+            **kwargs: passed on to ManifestReader
+
+        Returns:
+            RecordBatchReader:
+        """
+        manifest_reader = ManifestReader(s3file_manifest, **kwargs)
+        if columns is None:
+            columns = manifest_reader.get_manifest().get_columns()
+        return RecordBatchReader(manifest_reader, columns, delimiter=delimiter, escape=escape, null_as=null_as,
+                                 batch_bytes=batch_bytes)
+
+    def find_record_end(self, data):
+        """
+
+        Returns:
+            int: position of the last newline that ends a record, -1 if there is none
+        """
+        position = data.rfind(b'\n')
+        while self.escape and position != -1:
+            backslashes = 0
+            while position - backslashes > 0 and data[position - backslashes - 1] == ord('\\'):
+                backslashes += 1
+            if backslashes % 2 == 0:
+                break
+            position = data.rfind(b'\n', 0, position)
+        return position
+
+    def __iter__(self):
+        remainder = b''
+        while True:
+            chunk = self.stream.read(self.batch_bytes)
+            if not chunk:
+                break
+            data = remainder + chunk
+            record_end = self.find_record_end(data)
+            if record_end == -1:
+                remainder = data
+                continue
+            remainder = data[record_end + 1:]
+            yield self.parse_batch(data[:record_end])
+        if len(remainder) > 0:
+            yield self.parse_batch(remainder)
+
+    def parse_batch(self, data):
+        """
+
+        Args:
+            data(bytes): complete records without the newline of the last record
+
+        Returns:
+            RecordBatch:
+        """
+        escaped = self.escape and b'\\' in data
+        if escaped:
+            data = data.replace(b'\\\\', ESCAPED_BACKSLASH).replace(b'\\' + self.delimiter, ESCAPED_DELIMITER) \
+                .replace(b'\\\n', ESCAPED_NEWLINE)
+        fields = data.replace(b'\n', self.delimiter).split(self.delimiter)
+        column_count = len(self.columns)
+        if len(fields) % column_count != 0:
+            raise(ValueError('Batch has {f} fields which is not a multiple of the {c} columns, check the delimiter and '
+                             'escape settings'.format(f=len(fields), c=column_count)))
+        num_rows = len(fields) // column_count
+        logging.debug('Parsing batch of {n} records'.format(n=num_rows))
+
+        columns = {}
+        null_masks = {}
+        for column_index, (name, column_type) in enumerate(self.columns):
+            # The width of fixed-size bytes is bounded for the parsed types, not for strings
+            dtype = bytes if is_parsed_type(column_type) else object
+            raw = self.numpy.array(fields[column_index::column_count], dtype=dtype)
+            null_masks[name] = raw == self.null_as
+            columns[name] = self.convert(raw, column_type, null_masks[name], escaped)
+        return RecordBatch(columns, null_masks, num_rows)
+
+    def convert(self, raw, column_type, null_mask, escaped):
+        """
+        Convert the raw fields of a column to the NumPy dtype of its Redshift type.
+
+        Args:
+            raw: NumPy array of bytes, an object array for string columns
+            column_type(str): Redshift base type
+            null_mask: NumPy array that is True for the null values
+            escaped(bool): whether the fields can contain escape placeholders
+
+        Returns:
+            NumPy array
+        """
+        numpy = self.numpy
+        column_type = column_type.lower()
+        if column_type in INTEGER_TYPES:
+            return numpy.where(null_mask, b'0', raw).astype(INTEGER_TYPES[column_type])
+        elif column_type in FLOAT_TYPES:
+            return numpy.where(null_mask, b'nan', raw).astype(FLOAT_TYPES[column_type])
+        elif column_type in DATETIME_TYPES:
+            return numpy.where(null_mask, b'NaT', raw).astype(str).astype(DATETIME_TYPES[column_type])
+        elif column_type in BOOLEAN_TYPES:
+            return numpy.isin(raw, TRUE_VALUES)
+        # All values of the column are unescaped and decoded at once and split again
+        data = STRING_SEPARATOR.join(numpy.where(null_mask, b'', raw).tolist())
+        if escaped:
+            # Quotes and carriage returns are unescaped before the backslash placeholder is restored
+            for escaped_value, value in [(b'\\\r', b'\r'), (b'\\"', b'"'), (b"\\'", b"'"),
+                                         (ESCAPED_DELIMITER, self.delimiter), (ESCAPED_NEWLINE, b'\n'),
+                                         (ESCAPED_BACKSLASH, b'\\')]:
+                data = data.replace(escaped_value, value)
+        values = numpy.empty(len(raw), dtype=object)
+        values[:] = data.decode('utf-8').split(STRING_SEPARATOR.decode('utf-8'))
+        return values
@@ -0,0 +1,431 @@
+from util.instrumentation import Instrumentation
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+import logging
+import os
+import random
+import threading
+import time
+
+
+class LatencyTracker:
+    """
+    Keeps the latencies of the most recent requests to compute percentiles.
+    """
+    def __init__(self, window=1000, min_samples=20):
+        """
+
+        Args:
+            window(int): number of most recent latencies that are kept
+            min_samples(int): number of latencies needed before a percentile is given
+        """
+        self.latencies = deque(maxlen=int(window))
+        self.min_samples = int(min_samples)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def get_percentile(self, percentile):
+        """
+
+        Args:
+            percentile(float): between 0 and 100
+
+        Returns:
+            float: the latency in seconds, None if there are not enough samples yet
+        """
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[index]
+
+
+class RetryBudget:
+    """
+    Token bucket that limits extra requests to a fraction of the successful requests.  When S3 is unhealthy the
+    earned tokens run out and retries slow down to the floor of min_retries_per_second (shared by all requests) instead
+    of every request retrying on its own.  The floor never saves up more than a second of tokens.
+    """
+    def __init__(self, ratio=0.1, initial_tokens=10, max_tokens=100, min_retries_per_second=10):
+        """
+
+        Args:
+            ratio(float): tokens earned per successful request
+            initial_tokens(float): tokens available at the start of the run
+            max_tokens(float): cap on the saved up tokens
+            min_retries_per_second(float): tokens that are added per second however few requests succeed, 0 means
+              that an empty budget makes requests fail
+        """
+        self.ratio = ratio
+        self.tokens = float(initial_tokens)
+        self.max_tokens = float(max_tokens)
+        self.min_retries_per_second = float(min_retries_per_second)
+        self.refilled_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        floor_tokens = min(self.max_tokens, self.min_retries_per_second)
+        if self.tokens < floor_tokens:
+            self.tokens = min(floor_tokens, self.tokens + (now - self.refilled_at) * self.min_retries_per_second)
+        self.refilled_at = now
+
+    def record_success(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self):
+        """
+
+        Returns:
+            bool: True if an extra request may be sent
+        """
+        with self.lock:
+            self.refill()
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def get_seconds_until_token(self):
+        """
+
+        Returns:
+            float: seconds until the floor adds a token, 0 if there is one, None if there is no floor
+        """
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                return 0
+            if self.min_retries_per_second <= 0:
+                return None
+            return (1 - self.tokens) / self.min_retries_per_second
+
+
+def get_backoff(attempt, base=0.05, cap=5.0):
+    """
+    Exponential back-off with full jitter, so retries of requests that failed together do not arrive together.
+
+    Args:
+        attempt(int): number of failed attempts so far (starting at 1)
+        base(float): back-off in seconds after the first failure
+        cap(float): maximum back-off in seconds
+
+    Returns:
+        float: seconds to wait before the next attempt
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class RetryPolicy:
+    """
+    Process-wide policy to run S3 requests with hedging and retries.  Every attempt runs in a shared pool of threads
+    while the caller waits on all its attempts at once:
+      - if an attempt got no response within the hedge_percentile of the measured latencies since it started running, a
+        duplicate request is sent and the first response wins (the other response is discarded when it arrives)
+      - a failed attempt is retried after a jittered back-off, but the caller keeps waiting on the attempts in flight
+        so a response that arrives during the back-off is used right away
+    Retries are paid from a RetryBudget that is shared by all requests, when it is empty a retry waits for the floor of
+    the budget.  Hedges are paid from a budget of their own and are skipped when it is empty.
+    """
+    lock = threading.Lock()
+    pid = os.getpid()
+    executor = None
+    # Above the requests in flight of a retrieval, so attempts are not queued behind each other
+    max_workers = 256
+    max_attempts = 10
+    hedge_percentile = 95
+    min_hedge_delay = 0.05
+    latency_tracker = LatencyTracker()
+    retry_budget = RetryBudget()
+    hedge_budget = RetryBudget(ratio=0.05, min_retries_per_second=0)
+
+    @staticmethod
+    def configure(max_attempts=None, hedge_percentile=None, min_hedge_delay=None, retry_budget=None,
+                  hedge_budget=None, max_workers=None):
+        """
+
+        Args:
+            max_attempts(int): maximum number of attempts of a single request
+            hedge_percentile(float): latency percentile after which a request is hedged, None keeps the current one
+            min_hedge_delay(float): requests are not hedged before this many seconds
+            retry_budget(RetryBudget): budget shared by the retries of all requests
+            hedge_budget(RetryBudget): budget shared by the hedges of all requests
+            max_workers(int): size of the pool that runs the attempts, the current pool is replaced
+        """
+        with RetryPolicy.lock:
+            if max_attempts is not None:
+                RetryPolicy.max_attempts = int(max_attempts)
+            if hedge_percentile is not None:
+                RetryPolicy.hedge_percentile = hedge_percentile
+            if min_hedge_delay is not None:
+                RetryPolicy.min_hedge_delay = min_hedge_delay
+            if retry_budget is not None:
+                RetryPolicy.retry_budget = retry_budget
+            if hedge_budget is not None:
+                RetryPolicy.hedge_budget = hedge_budget
+            if max_workers is not None and int(max_workers) != RetryPolicy.max_workers:
+                RetryPolicy.max_workers = int(max_workers)
+                if RetryPolicy.executor is not None:
+                    RetryPolicy.executor.shutdown(wait=False)
+                    RetryPolicy.executor = None
+
+    @staticmethod
+    def reset():
+        """
+        Restore the default configuration and forget the measured latencies.
+        """
+        with RetryPolicy.lock:
+            RetryPolicy.max_attempts = 10
+            RetryPolicy.hedge_percentile = 95
+            RetryPolicy.min_hedge_delay = 0.05
+            RetryPolicy.latency_tracker = LatencyTracker()
+            RetryPolicy.retry_budget = RetryBudget()
+            RetryPolicy.hedge_budget = RetryBudget(ratio=0.05, min_retries_per_second=0)
+        RetryPolicy.configure(max_workers=256)
+
+    @staticmethod
+    def get_executor():
+        with RetryPolicy.lock:
+            if RetryPolicy.executor is None or RetryPolicy.pid != os.getpid():
+                RetryPolicy.executor = ThreadPoolExecutor(max_workers=RetryPolicy.max_workers,
+                                                          thread_name_prefix='s3-request')
+                RetryPolicy.pid = os.getpid()
+            return RetryPolicy.executor
+
+    @staticmethod
+    def get_hedge_delay(latency_tracker=None):
+        """
+
+        Args:
+            latency_tracker(LatencyTracker): by default the latencies of the threaded requests
+
+        Returns:
+            float: seconds after which a request is hedged, None if there is no percentile measured yet
+        """
+        if latency_tracker is None:
+            latency_tracker = RetryPolicy.latency_tracker
+        latency = latency_tracker.get_percentile(RetryPolicy.hedge_percentile)
+        if latency is None:
+            return None
+        return max(RetryPolicy.min_hedge_delay, latency)
+
+    @staticmethod
+    def timed(request, latency_tracker, started):
+        """
+        Runs in the pool.  The attempt is timed from when it starts running, not from when it was queued.
+
+        Args:
+            request(callable):
+            latency_tracker(LatencyTracker):
+            started(list): the start time is appended to it
+        """
+        start = time.monotonic()
+        started.append(start)
+        result = request()
+        latency_tracker.record(time.monotonic() - start)
+        return result
+
+    @staticmethod
+    def get_retry_delay(retry_budget, last_exception):
+        """
+        Called when a retry is due but the budget is empty.
+
+        Returns:
+            float: seconds to wait for the floor of the budget, jittered so waiting requests do not retry together
+        """
+        Instrumentation.count('s3.retry_budget_exhausted')
+        seconds_until_token = retry_budget.get_seconds_until_token()
+        if seconds_until_token is None:
+            raise(Exception('Request failed and the retry budget is exhausted')) from last_exception
+        return seconds_until_token * random.uniform(1, 2)
+
+    @staticmethod
+    def call(request, is_fatal=lambda e: False, discard=lambda result: None):
+        """
+        Run a request with hedging and retries.
+
+        Args:
+            request(callable): sends the request and returns its response, it must be safe to run several times
+            is_fatal(callable): tells whether an exception must not be retried
+            discard(callable): releases a response that lost the race (e.g. closes its body)
+
+        Returns:
+            the first successful response
+        """
+        executor = RetryPolicy.get_executor()
+        latency_tracker = RetryPolicy.latency_tracker
+        retry_budget = RetryPolicy.retry_budget
+        hedge_budget = RetryPolicy.hedge_budget
+        hedge_delay = RetryPolicy.get_hedge_delay()
+        attempts = set()
+        attempt_count = 0
+        failure_count = 0
+        last_exception = None
+        retry_at = None
+        hedge_at = None
+        last_started = []
+
+        def start_attempt():
+            nonlocal attempt_count, hedge_at, last_started
+            last_started = []
+            attempts.add(executor.submit(RetryPolicy.timed, request, latency_tracker, last_started))
+            attempt_count += 1
+            hedge_at = None if hedge_delay is None else time.monotonic() + hedge_delay
+
+        def discard_late_result(future):
+            if not future.cancelled() and future.exception() is None:
+                discard(future.result())
+
+        start_attempt()
+        while True:
+            deadlines = [deadline for deadline in [retry_at, hedge_at] if deadline is not None]
+            timeout = None if len(deadlines) == 0 else max(0, min(deadlines) - time.monotonic())
+            done, _ = wait(attempts, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                attempts.remove(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if is_fatal(e):
+                        for attempt in attempts:
+                            attempt.add_done_callback(discard_late_result)
+                        raise e
+                    logging.debug('Attempt {n} failed: {e}'.format(n=attempt_count, e=str(e)))
+                    failure_count += 1
+                    last_exception = e
+                    continue
+                for attempt in attempts:
+                    attempt.add_done_callback(discard_late_result)
+                retry_budget.record_success()
+                hedge_budget.record_success()
+                return result
+
+            now = time.monotonic()
+            if len(attempts) == 0 and retry_at is None:
+                if attempt_count >= RetryPolicy.max_attempts:
+                    raise(Exception('Request failed after {n} attempts'.format(n=attempt_count))) from last_exception
+                retry_at = now + get_backoff(failure_count)
+                hedge_at = None
+                logging.debug('Retrying in {s:.3f} seconds'.format(s=retry_at - now))
+            if retry_at is not None and now >= retry_at:
+                if retry_budget.try_spend():
+                    retry_at = None
+                    Instrumentation.count('s3.retry')
+                    start_attempt()
+                else:
+                    retry_at = now + RetryPolicy.get_retry_delay(retry_budget, last_exception)
+                    logging.debug('Retry budget is empty, retrying in {s:.3f} seconds'.format(s=retry_at - now))
+            elif hedge_at is not None and now >= hedge_at:
+                if len(last_started) == 0 or now < last_started[0] + hedge_delay:
+                    # The attempt was queued in the pool, it is hedged once it ran for the hedge delay
+                    hedge_at = (now if len(last_started) == 0 else last_started[0]) + hedge_delay
+                    continue
+                hedge_at = None
+                if attempt_count < RetryPolicy.max_attempts and hedge_budget.try_spend():
+                    logging.debug('No response after {s:.3f} seconds, sending a hedged request'.format(s=hedge_delay))
+                    Instrumentation.count('s3.hedge')
+                    start_attempt()
+
+    @staticmethod
+    async def timed_async(request, latency_tracker):
+        start = time.monotonic()
+        result = await request()
+        latency_tracker.record(time.monotonic() - start)
+        return result
+
+    @staticmethod
+    async def call_async(request, is_fatal=lambda e: False, discard=lambda result: None, latency_tracker=None):
+        """
+        Coroutine version of call for asyncio clients.  The attempts are tasks on the running event loop instead of
+        threads, so an attempt that lost the race is cancelled instead of waited for.
+
+        Args:
+            request(callable): returns a new coroutine that sends the request, it must be safe to run several times
+            is_fatal(callable): tells whether an exception must not be retried
+            discard(callable): releases a response that arrived together with the winning response
+            latency_tracker(LatencyTracker): latencies from which the hedge delay is taken, by default the ones of the
+              threaded requests
+
+        Returns:
+            the first successful response
+        """
+        # asyncio is slow to import and only used by the asyncio clients, not by the CLI startup
+        import asyncio
+        if latency_tracker is None:
+            latency_tracker = RetryPolicy.latency_tracker
+        retry_budget = RetryPolicy.retry_budget
+        hedge_budget = RetryPolicy.hedge_budget
+        hedge_delay = RetryPolicy.get_hedge_delay(latency_tracker)
+        attempts = set()
+        attempt_count = 0
+        failure_count = 0
+        last_exception = None
+        retry_at = None
+        hedge_at = None
+
+        def start_attempt():
+            nonlocal attempt_count, hedge_at
+            attempts.add(asyncio.ensure_future(RetryPolicy.timed_async(request, latency_tracker)))
+            attempt_count += 1
+            hedge_at = None if hedge_delay is None else time.monotonic() + hedge_delay
+
+        start_attempt()
+        try:
+            while True:
+                deadlines = [deadline for deadline in [retry_at, hedge_at] if deadline is not None]
+                timeout = None if len(deadlines) == 0 else max(0, min(deadlines) - time.monotonic())
+                done = set()
+                if len(attempts) > 0:
+                    done, _ = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    await asyncio.sleep(timeout)
+                for attempt in done:
+                    attempts.remove(attempt)
+                    try:
+                        result = attempt.result()
+                    except Exception as e:
+                        if is_fatal(e):
+                            raise e
+                        logging.debug('Attempt {n} failed: {e}'.format(n=attempt_count, e=str(e)))
+                        failure_count += 1
+                        last_exception = e
+                        continue
+                    retry_budget.record_success()
+                    hedge_budget.record_success()
+                    return result
+
+                now = time.monotonic()
+                if len(attempts) == 0 and retry_at is None:
+                    if attempt_count >= RetryPolicy.max_attempts:
+                        msg = 'Request failed after {n} attempts'.format(n=attempt_count)
+                        raise(Exception(msg)) from last_exception
+                    retry_at = now + get_backoff(failure_count)
+                    hedge_at = None
+                    logging.debug('Retrying in {s:.3f} seconds'.format(s=retry_at - now))
+                if retry_at is not None and now >= retry_at:
+                    if retry_budget.try_spend():
+                        retry_at = None
+                        Instrumentation.count('s3.retry')
+                        start_attempt()
+                    else:
+                        retry_at = now + RetryPolicy.get_retry_delay(retry_budget, last_exception)
+                        logging.debug('Retry budget is empty, retrying in {s:.3f} seconds'.format(s=retry_at - now))
+                elif hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    if attempt_count < RetryPolicy.max_attempts and hedge_budget.try_spend():
+                        logging.debug('No response after {s:.3f} seconds, sending a hedged request'
+                                      .format(s=hedge_delay))
+                        Instrumentation.count('s3.hedge')
+                        start_attempt()
+        finally:
+            # Also when the caller is cancelled, no attempt is left running
+            for attempt in attempts:
+                if not attempt.done():
+                    attempt.cancel()
+                elif not attempt.cancelled() and attempt.exception() is None:
+                    discard(attempt.result())
@@ -1,8 +1,8 @@
 class S3ByteRange:
-    def __init__(self, size=10000000):
+    def __init__(self, size=10000000, lower_bound=0):
         self.size = size
-        self.lower_bound = 0
-        self.upper_bound = size - 1
+        self.lower_bound = lower_bound
+        self.upper_bound = lower_bound + size - 1
 
     def __str__(self):
         return 'bytes={lb}-{ub}'.format(lb=str(self.lower_bound), ub=str(self.upper_bound))
@@ -0,0 +1,125 @@
+import logging
+import os
+import threading
+
+
+class S3ClientRegistry:
+    """
+    Process-wide registry of boto3 S3 clients keyed by region and endpoint.  boto3 clients are thread-safe so every
+    S3File of a region shares the same client, its credentials and its connection pool.  Clients are created from a
+    single boto3 session, which is not thread-safe, so creation happens under a lock.
+
+    Clients (and their connection pools) must not be shared across a fork so the registry starts over in a child
+    process.
+    """
+    lock = threading.Lock()
+    clients = {}
+    session = None
+    pid = os.getpid()
+    max_pool_connections = 10
+    tcp_keepalive = False
+    endpoint_url = None
+
+    @staticmethod
+    def configure(max_pool_connections=None, tcp_keepalive=None, endpoint_url=None):
+        """
+        Configure the clients that are created from now on.  Previously created clients are dropped.
+
+        Args:
+            max_pool_connections(int): size of the connection pool of a client
+            tcp_keepalive(bool): whether TCP keep-alive is enabled on the connections
+            endpoint_url(str): endpoint to use instead of the AWS S3 endpoint (e.g. an S3 compatible server)
+        """
+        with S3ClientRegistry.lock:
+            if max_pool_connections is not None:
+                S3ClientRegistry.max_pool_connections = int(max_pool_connections)
+            if tcp_keepalive is not None:
+                S3ClientRegistry.tcp_keepalive = tcp_keepalive
+            if endpoint_url is not None:
+                S3ClientRegistry.endpoint_url = endpoint_url
+            S3ClientRegistry.clients = {}
+
+    @staticmethod
+    def reset():
+        """
+        Drop all clients and restore the default configuration.
+        """
+        with S3ClientRegistry.lock:
+            S3ClientRegistry.max_pool_connections = 10
+            S3ClientRegistry.tcp_keepalive = False
+            S3ClientRegistry.endpoint_url = None
+            S3ClientRegistry.clients = {}
+            S3ClientRegistry.session = None
+
+    @staticmethod
+    def get_settings():
+        """
+
+        Returns:
+            dict: keyword arguments of configure() that give the current configuration, e.g. to configure the registry
+              of a worker process that is not forked
+        """
+        with S3ClientRegistry.lock:
+            return {
+                'max_pool_connections': S3ClientRegistry.max_pool_connections,
+                'tcp_keepalive': S3ClientRegistry.tcp_keepalive,
+                'endpoint_url': S3ClientRegistry.endpoint_url
+            }
+
+    @staticmethod
+    def get_config_kwargs(endpoint_url, max_pool_connections=None):
+        """
+
+        Args:
+            endpoint_url(str):
+            max_pool_connections(int): None means the size configured in the registry
+
+        Returns:
+            dict: keyword arguments of a botocore Config (or an aiobotocore AioConfig) for the registry settings
+        """
+        if max_pool_connections is None:
+            max_pool_connections = S3ClientRegistry.max_pool_connections
+        config_kwargs = {'max_pool_connections': max_pool_connections}
+        if S3ClientRegistry.tcp_keepalive:
+            config_kwargs['tcp_keepalive'] = True
+        if endpoint_url is not None:
+            config_kwargs['s3'] = {'addressing_style': 'path'}
+        return config_kwargs
+
+    @staticmethod
+    def get_config(endpoint_url):
+        import botocore.config
+        return botocore.config.Config(**S3ClientRegistry.get_config_kwargs(endpoint_url))
+
+    @staticmethod
+    def get_client(region=None, endpoint_url=None):
+        """
+
+        Args:
+            region(str): None means the default region of the environment
+            endpoint_url(str): None means the endpoint configured in the registry
+
+        Returns:
+            The shared boto3 S3 client
+        """
+        if endpoint_url is None:
+            endpoint_url = S3ClientRegistry.endpoint_url
+        client_key = (region, endpoint_url)
+        with S3ClientRegistry.lock:
+            if S3ClientRegistry.pid != os.getpid():
+                S3ClientRegistry.clients = {}
+                S3ClientRegistry.session = None
+                S3ClientRegistry.pid = os.getpid()
+            if S3ClientRegistry.session is None:
+                # boto3 is imported on the first client so that actions without S3 access start fast
+                import boto3
+                S3ClientRegistry.session = boto3.session.Session()
+            if client_key not in S3ClientRegistry.clients:
+                logging.debug('Creating S3 client for region={r} endpoint={e}'.format(r=region, e=endpoint_url))
+                client_kwargs = {'config': S3ClientRegistry.get_config(endpoint_url)}
+                if region is not None:
+                    client_kwargs['region_name'] = region
+                if endpoint_url is not None:
+                    client_kwargs['endpoint_url'] = endpoint_url
+                S3ClientRegistry.clients[client_key] = S3ClientRegistry.session.client('s3', **client_kwargs)
+            return S3ClientRegistry.clients[client_key]
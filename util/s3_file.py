@@ -1,9 +1,14 @@
 import re
-import boto3
-import click
 import logging
-import time
 from util.s3_file_fragment import S3FileFragment
+from util.s3_client_registry import S3ClientRegistry
+from util.retry_policy import RetryPolicy
+from util.instrumentation import Instrumentation
+import os
+
+# Objects up to this size are downloaded with a single GET if their size is known, like the boto3 multipart threshold
+SINGLE_GET_THRESHOLD = 8 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
 
 class InvalidS3PathException(Exception):
@@ -11,6 +16,55 @@ class InvalidS3PathException(Exception):
         super(InvalidS3PathException, self).__init__(message)
 
 
+# Bucket restrictions according to AWS doc
+# 3-63 characters long
+# One or more labels separated by a .
+# lowercase, numbers hyphens (must start with number or lowercase
+# North virginia region can have Upper cases as wel
+S3_PATH_PATTERN = re.compile('(?P<prefix>s3://)(?P<bucket>[a-zA-Z0-9.-]*)(?P<separator>/)(?P<key>.*)')
+
+
+def parse_s3_path(s3path):
+    """
+
+    Args:
+        s3path(str): like s3://bucketname/pathname
+
+    Returns:
+        tuple: (bucket, key)
+    """
+    if not s3path.startswith('s3://'):
+        raise InvalidS3PathException(
+            message='S3 path did not start with \'s3://\': {path}'.format(path=s3path)
+        )
+    match_result = S3_PATH_PATTERN.match(s3path)
+    if match_result is None:
+        raise InvalidS3PathException(
+            'Could not parse S3 path. Is a valid s3 path given? {path}'.format(path=s3path)
+        )
+    return match_result.group('bucket'), match_result.group('key')
+
+
+def get_s3_file_name(bucket, key, prefix=None):
+    """
+    Only return the part after the latest forward slash (/) or the part after the given prefix
+
+    Args:
+        bucket(str):
+        key(str):
+        prefix(str): prefix of the s3 path (s3://bucket/key)
+
+    Returns:
+        str:
+    """
+    if prefix is None:
+        return key.split('/')[-1]
+    s3path = 's3://{bucket}/{key}'.format(bucket=bucket, key=key)
+    if not s3path.startswith(prefix):
+        raise(ValueError('S3 file {f} does not start with prefix {p}.'.format(f=s3path, p=prefix)))
+    return s3path[len(prefix):]
+
+
 class S3File:
     """
     This class will do all the S3 interactions
@@ -25,11 +79,13 @@ class S3File:
     def __init__(self, *args, **kwargs):
         self.s3 = None
         self.region = kwargs.get('region', None)
-        self.reset_transfer_attempts()
+        self.region_cache = kwargs.get('region_cache', None)
+        self.content_length = kwargs.get('content_length', None)
+        self.record_count = kwargs.get('record_count', None)
+        self.etag = kwargs.get('etag', None)
+        self.last_modified = kwargs.get('last_modified', None)
         self.has_meta = False
         self.head_object = None
-        self.retries = 0   # default value in reset_transfer_attempts
-        self.back_off = 2  # default value in reset_transfer_attempts
         self.x_amz_key = None
         self.x_amz_iv = None
         self.x_amz_matdesc = None
@@ -52,61 +108,7 @@ class S3File:
             raise Exception('Unsupported initialization of S3File')
 
         if s3path is not None:
-            if not s3path.startswith('s3://'):
-                raise InvalidS3PathException(
-                    message='S3 path did not start with \'s3://\': {path}'.format(path=s3path)
-                )
-            # Bucket restrictions according to AWS doc
-            # 3-63 characters long
-            # One or more labels separated by a .
-            # lowercase, numbers hyphens (must start with number or lowercase
-            # North virginia region can have Upper cases as wel
-            s3path_structure = [
-                {
-                    'name': 'prefix',
-                    'pattern': 's3://'
-                },
-                {
-                    'name': 'bucket',
-                    'pattern': '[a-zA-Z0-9.-]*'
-                },
-                {
-                    'name': 'separator',
-                    'pattern': '/'
-                },
-                {
-                    'name': 'key',
-                    'pattern': '.*'
-                }
-            ]
-            pattern = ''
-            for element in s3path_structure:
-                if 'name' in element.keys():
-                    pattern += '(?P<' + element['name'] + '>'
-                pattern += element['pattern']
-                if 'name' in element.keys():
-                    pattern += ')'
-            regex_s3_path = re.compile(pattern)
-            match_result = regex_s3_path.match(s3path)
-            if match_result is None:
-                raise InvalidS3PathException(
-                    'Could not parse S3 path. Is a valid s3 path given? {path}'.format(path=s3path)
-                )
-            self.bucket_name = match_result.groupdict().pop('bucket')
-            self.key = match_result.groupdict().pop('key')
-
-    def reset_transfer_attempts(self):
-        self.retries = 0
-        self.back_off = 2
-
-    def failed_transfer_attempt(self):
-        logging.debug('Failed transfer, awaiting for backoff {b} before retrying'.format(b=str(self.back_off)))
-        time.sleep(self.back_off)
-        self.retries += 1
-        self.back_off *= 2
-
-    def has_too_many_retries(self):
-        return self.retries >= 10
+            self.bucket_name, self.key = parse_s3_path(s3path)
 
     def get_key(self):
         return self.key
@@ -124,28 +126,27 @@ class S3File:
         Returns:
             str:
         """
-        if prefix is None:
-            s3_file_name_parts = self.key.split('/')
-            return s3_file_name_parts[-1]
-        else:
-            if not str(self).startswith(prefix):
-                raise(ValueError('S3 file {f} does not start with prefix {p}.'.format(f=str(self), p=prefix)))
-            else:
-                prefix_length = len(prefix)
-                return str(self)[prefix_length:]
+        return get_s3_file_name(self.bucket_name, self.key, prefix=prefix)
 
     def __eq__(self, other):
+        if not isinstance(other, S3File):
+            return NotImplemented
         return self.key == other.key and self.bucket_name == other.bucket_name
 
+    def __hash__(self):
+        return hash((self.bucket_name, self.key))
+
     def __str__(self):
         return 's3://{bucket}/{key}'.format(bucket=self.bucket_name, key=self.key)
 
     def get_s3_connection(self, force=False):
         if self.s3 is None or force:
+            if self.region is None and self.region_cache is not None:
+                self.region = self.region_cache.get_cached_region(self.bucket_name)
             if self.region is not None and self.region != 'unknown':
-                self.s3 = boto3.client('s3', region_name=self.region)
+                self.s3 = S3ClientRegistry.get_client(self.region)
             else:
-                self.s3 = boto3.client('s3')
+                self.s3 = S3ClientRegistry.get_client()
 
         return self.s3
 
@@ -162,7 +163,9 @@ class S3File:
         """
         if not self.has_meta:
             try:
-                self.head_object = self.get_s3_connection().head_object(Bucket=self.get_bucket(), Key=self.get_key())
+                with Instrumentation.measure('s3.head'):
+                    self.head_object = self.get_s3_connection().head_object(Bucket=self.get_bucket(),
+                                                                            Key=self.get_key())
                 self.has_meta = True
             except Exception as e:
                 if self.region is None:
@@ -176,71 +179,192 @@ class S3File:
                     raise Exception(region_set_no_metadata.format(r=str(self.region))) from e
         return self.head_object
 
+    def set_meta(self, head_object):
+        """
+        Use the result of a head_object call that was done elsewhere (e.g. by an asyncio client)
+
+        Args:
+            head_object(dict):
+        """
+        self.head_object = head_object
+        self.has_meta = True
+        if self.content_length is None:
+            self.content_length = head_object.get('ContentLength', None)
+        if self.etag is None:
+            self.etag = head_object.get('ETag', None)
+
     # noinspection PyUnresolvedReferences
+    def request_range(self, s3_byte_range):
+        with Instrumentation.measure('s3.get_range') as measurement:
+            response = self.get_s3_connection().get_object(
+                Bucket=self.get_bucket(),
+                Key=self.get_key(),
+                Range=str(s3_byte_range)
+            )
+            measurement.add_bytes(response['ContentLength'])
+        return S3FileFragment(response['Body'], response['ContentLength'], s3_byte_range)
+
+    @staticmethod
+    def is_invalid_range(e):
+        return hasattr(e, 'response') and 'Error' in e.response and 'Code' in e.response['Error'] \
+            and e.response['Error']['Code'] == 'InvalidRange'
+
     def get_range(self, s3_byte_range):
-        while not self.has_too_many_retries():
-            try:
-                response = self.get_s3_connection().get_object(
-                    Bucket=self.get_bucket(),
-                    Key=self.get_key(),
-                    Range=str(s3_byte_range)
-                )
-                length = response['ContentLength']
-                self.reset_transfer_attempts()
-                return S3FileFragment(response['Body'], length, s3_byte_range)
-            except Exception as e:
-                logging.debug('Exception when getting byte range.')
-                if hasattr(e, 'response') and 'Error' in e.response and 'Code' in e.response['Error'] \
-                        and e.response['Error']['Code'] == 'InvalidRange':
-                    logging.fatal('Requesting range that is not satisfiable.  Filesize = {fs}, byterange ={r}'
-                                  'This should not happen.'.format(fs=str(self.get_size()), r=str(s3_byte_range)))
-                    raise e
-                else:
-                    logging.debug('Exception encountered while retrieving byte range: {e}'.format(e=str(e)))
-                    self.failed_transfer_attempt()
-        raise(Exception("Too many S3 contact attempts to get byte range."))
+        """
+        Get a byte range, the request is hedged and retried according to the RetryPolicy.
+
+        Args:
+            s3_byte_range(S3ByteRange):
+
+        Returns:
+            S3FileFragment:
+        """
+        try:
+            return RetryPolicy.call(lambda: self.request_range(s3_byte_range), is_fatal=S3File.is_invalid_range,
+                                    discard=lambda fragment: fragment.get_streaming_body().close())
+        except Exception as e:
+            if S3File.is_invalid_range(e):
+                logging.fatal('Requesting range that is not satisfiable.  Filesize = {fs}, byterange ={r}'
+                              'This should not happen.'.format(fs=str(self.get_size()), r=str(s3_byte_range)))
+            raise e
 
     def get_file_content(self):
+        return self.get_content_stream().read()
+
+    def get_content_stream(self):
+        """
+
+        Returns:
+            readable binary stream of the whole object
+        """
         s3_byte_range = self.get_size()
         s3_file_fragment = self.get_range(s3_byte_range)
-        return s3_file_fragment.get_streaming_body().read()
+        return s3_file_fragment.get_streaming_body()
 
     # noinspection PyUnresolvedReferences
-    def download_file(self, destination_path):
-        transfer = boto3.s3.transfer.S3Transfer(self.get_s3_connection())
-        return transfer.download_file(self.get_bucket(), self.get_key(), destination_path)
+    def download_file(self, destination_path, transfer_config=None):
+        """
+        Download the S3 object to a local file.  If the size is already known (from the manifest or a listing) and the
+        object is small, a single GET is done that is hedged and retried according to the RetryPolicy.  Otherwise the
+        boto3 transfer logic is used which does a HEAD request and a multipart download for big objects.
+
+        Args:
+            destination_path(str):
+            transfer_config(TransferConfig): range size and concurrency of the multipart download, by default the
+              boto3 defaults are used
+        """
+        with Instrumentation.measure('s3.download') as measurement:
+            self.download_file_uninstrumented(destination_path, transfer_config=transfer_config)
+            measurement.add_bytes(os.path.getsize(destination_path))
+
+    # noinspection PyUnresolvedReferences
+    def download_file_uninstrumented(self, destination_path, transfer_config=None):
+        single_get_size = SINGLE_GET_THRESHOLD if transfer_config is None else transfer_config.range_size
+        if self.content_length is not None and self.content_length <= single_get_size:
+            # Hedged and retried like the ranged GETs
+            response = RetryPolicy.call(lambda: self.get_s3_connection().get_object(Bucket=self.get_bucket(),
+                                                                                      Key=self.get_key()),
+                                        discard=lambda late_response: late_response['Body'].close())
+            body = response['Body']
+            received_bytes = 0
+            with open(destination_path, 'wb') as destination_file:
+                for chunk in iter(lambda: body.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    destination_file.write(chunk)
+                    received_bytes += len(chunk)
+            if received_bytes != response['ContentLength']:
+                raise(IOError('Expected {e} bytes of {f} but received {r}'.format(e=response['ContentLength'],
+                                                                                  f=str(self), r=received_bytes)))
+            return
+        # boto3 its transfer module is heavy to import and only needed for big downloads
+        import boto3.s3.transfer
+        config = None
+        if transfer_config is not None:
+            config = boto3.s3.transfer.TransferConfig(multipart_threshold=transfer_config.range_size,
+                                                      multipart_chunksize=transfer_config.range_size,
+                                                      max_concurrency=transfer_config.concurrency)
+        transfer = boto3.s3.transfer.S3Transfer(self.get_s3_connection(), config=config)
+        transfer.download_file(self.get_bucket(), self.get_key(), destination_path)
 
     def get_size(self):
         """
-        :return: The file size of the S3File
+        :return: The file size of the S3File, without a HEAD request if it is known from the manifest or a listing
         """
+        if self.content_length is not None:
+            return self.content_length
         self.get_meta()
         if 'ContentLength' in self.head_object:
-            return self.head_object['ContentLength']
+            self.content_length = self.head_object['ContentLength']
+            return self.content_length
         else:
             msg = 'ContentLength was not available in head_object; response={r}'
             raise(Exception(msg.format(r=str(self.head_object))))
 
+    def has_size(self):
+        return self.content_length is not None
+
+    def set_listing_meta(self, size, etag=None, last_modified=None):
+        """
+        Set the metadata that is returned by a ListObjectsV2 call such that no HEAD request is needed
+
+        Args:
+            size(int):
+            etag(str):
+            last_modified(datetime):
+        """
+        self.content_length = size
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def has_etag(self):
+        return self.etag is not None
+
+    def get_etag(self):
+        if self.etag is None:
+            self.etag = self.get_meta().get('ETag', None)
+        return self.etag
+
+    def get_last_modified(self):
+        if self.last_modified is None:
+            self.last_modified = self.get_meta().get('LastModified', None)
+        return self.last_modified
+
+    def get_record_count(self):
+        return self.record_count
+
     def set_region(self, region):
         self.region = region
 
     def get_region(self):
         return self.region
 
-    def connect_to_bucket_region(self):
+    def lookup_bucket_region(self):
         """
         This method will determine the bucket region using the api.
-        :return: 
+        :return: the region of the bucket
         """
-        bucket = self.get_s3_connection().get_bucket_location(Bucket=self.bucket_name)
+        with Instrumentation.measure('s3.get_bucket_location'):
+            bucket = self.get_s3_connection().get_bucket_location(Bucket=self.bucket_name)
         bucket_location = bucket.get('LocationConstraint', None)
         if bucket_location is not None:
-            self.region = bucket_location
-            self.get_s3_connection(force=True)
-            return self.region
+            return bucket_location
         else:
             raise(Exception('Could not get region for bucket {b}. Does region exist?'.format(b=self.bucket_name)))
 
+    def connect_to_bucket_region(self):
+        """
+        This method will determine the bucket region, using the region cache if one is set, and reconnect.
+        :return: 
+        """
+        if self.region_cache is not None:
+            self.region = self.region_cache.get_region(self.bucket_name, self.lookup_bucket_region)
+        else:
+            self.region = self.lookup_bucket_region()
+        self.get_s3_connection(force=True)
+        return self.region
+
+    def set_region_cache(self, region_cache):
+        self.region_cache = region_cache
+
     def get_encryption_metadata(self):
         """
         Encrypted objects have the following metadata:
@@ -281,12 +405,3 @@ class S3File:
             self.get_encryption_metadata()
             return self.x_amz_key
 
-
-class S3PathParamType(click.ParamType):
-    name = 's3-path'
-
-    def convert(self, value, param, ctx):
-        try:
-            return S3File(value)
-        except InvalidS3PathException as e:
-            self.fail('{val} is not a valid S3 path: {err}'.format(val=value, err=str(e)), param, ctx)
@@ -1,8 +1,15 @@
+from util.s3_read_ahead import S3ReadAhead
+from util.instrumentation import Instrumentation
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import logging
 import hashlib
 import datetime
+import itertools
 import os
 
+# A resumable download syncs the local file and records its finished ranges in the journal once per this many bytes
+JOURNAL_SYNC_BYTES = 64 * 1024 * 1024
+
 
 class S3FileTransfer:
     def __init__(self, s3_file, local_file):
@@ -11,6 +18,7 @@ class S3FileTransfer:
         self.temp_file = None
         self.has_temp_file = False
         self.is_downloaded = False
+        self.cached_file = None
 
     def get_s3_file(self):
         return self.s3_file
@@ -60,16 +68,119 @@ class S3FileTransfer:
         elif not os.path.isdir(parent_dir):
             os.makedirs(parent_dir)
 
-    def download(self):
+    def download(self, transfer_config=None):
         if not self.is_downloaded:
             self.make_sure_local_parent_dir_exists()
-            self.s3_file.download_file(self.local_file)
+            self.s3_file.download_file(self.local_file, transfer_config=transfer_config)
             self.is_downloaded = True
             msg = 'Downloaded file {src} to {dest}'
         else:
             msg = 'File {src} has previously been dowloaded to {dest}, skipping download command.'
         logging.debug(msg.format(src=str(self.s3_file), dest=self.local_file))
 
+    def sync_local_file(self):
+        """
+        Make sure the content of the local file is on disk before it is recorded as complete in a journal.
+        """
+        with Instrumentation.measure('disk.fsync'), open(self.local_file, 'rb') as local_file:
+            os.fsync(local_file.fileno())
+
+    def download_resumable(self, journal, bytes_per_fetch=10000000, requests_in_flight=1):
+        """
+        Download the S3 file in ranges that are written in place and recorded in the journal, such that an interrupted
+        download only needs to fetch the ranges that are missing.  Ranges of an earlier version of the S3 object (other
+        ETag or size) are never reused.  The local file is synced and its ranges are recorded once per
+        JOURNAL_SYNC_BYTES rather than per range, ranges are only recorded after they are synced.
+
+        Args:
+            journal(TransferJournal): journal of the destination directory
+            bytes_per_fetch(int): size of the ranged GETs
+            requests_in_flight(int): number of ranged GETs that are fetched at the same time
+
+        Returns:
+
+        """
+        etag = self.s3_file.get_etag()
+        size = self.get_size()
+        if journal.is_file_complete(self.local_file, etag, size) and os.path.getsize(self.local_file) == size:
+            logging.debug('Journal has {dest} as complete, skipping download'.format(dest=self.local_file))
+            self.is_downloaded = True
+            return
+        self.make_sure_local_parent_dir_exists()
+        journal.record_file_started(self.local_file, etag, size)
+        completed_ranges = journal.get_completed_ranges(self.local_file, etag, size)
+        if not os.path.isfile(self.local_file) or os.path.getsize(self.local_file) != size:
+            completed_ranges = set()
+            with open(self.local_file, 'wb') as local_file:
+                local_file.truncate(size)
+        logging.debug('Resuming {src} to {dest}, {n} ranges already present'
+                      .format(src=str(self.s3_file), dest=self.local_file, n=len(completed_ranges)))
+
+        read_ahead = S3ReadAhead([self], bytes_per_fetch=bytes_per_fetch)
+        missing_ranges = iter([(s3_byte_range, length) for _, s3_byte_range, length, _ in read_ahead.get_ranges()
+                               if s3_byte_range is not None and (s3_byte_range.lower_bound,
+                                                                 s3_byte_range.lower_bound + length - 1)
+                               not in completed_ranges])
+        requests_in_flight = max(1, int(requests_in_flight))
+        unsynced_ranges = []
+        with open(self.local_file, 'r+b') as local_file, \
+                ThreadPoolExecutor(max_workers=requests_in_flight) as executor:
+
+            def sync_ranges():
+                if len(unsynced_ranges) > 0:
+                    with Instrumentation.measure('disk.sync'):
+                        os.fsync(local_file.fileno())
+                    journal.record_ranges_complete(self.local_file, etag, size, unsynced_ranges)
+                    del unsynced_ranges[:]
+
+            pending = set()
+            unsynced_bytes = 0
+            try:
+                while True:
+                    for s3_byte_range, length in itertools.islice(missing_ranges, requests_in_flight - len(pending)):
+                        pending.add(executor.submit(self.write_range, local_file.fileno(), s3_byte_range, length))
+                    if len(pending) == 0:
+                        break
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for lower_bound, upper_bound in [future.result() for future in done if future.exception() is None]:
+                        unsynced_ranges.append((lower_bound, upper_bound))
+                        unsynced_bytes += upper_bound - lower_bound + 1
+                    for future in done:
+                        # Raise the error of a failed range after the ranges that are written have been added
+                        future.result()
+                    if unsynced_bytes >= JOURNAL_SYNC_BYTES:
+                        sync_ranges()
+                        unsynced_bytes = 0
+            finally:
+                for future in pending:
+                    future.cancel()
+                # Ranges that are written are not fetched again, also when another range failed
+                for future in wait(pending).done:
+                    if not future.cancelled() and future.exception() is None:
+                        unsynced_ranges.append(future.result())
+                sync_ranges()
+        journal.record_file_complete(self.local_file, etag, size)
+        self.is_downloaded = True
+
+    def write_range(self, file_descriptor, s3_byte_range, length):
+        """
+        Fetch a range and write it in place in the local file.
+
+        Returns:
+            tuple: (lower_bound, upper_bound) of the bytes that are written
+        """
+        data = S3ReadAhead.fetch(self, s3_byte_range)
+        if len(data) != length:
+            raise(Exception('Expected {e} bytes for range {r} of {f} but got {g}'
+                            .format(e=length, r=str(s3_byte_range), f=str(self.s3_file), g=len(data))))
+        with Instrumentation.measure('disk.write') as measurement:
+            written = os.pwrite(file_descriptor, data, s3_byte_range.lower_bound)
+            measurement.add_bytes(written)
+        if written != length:
+            raise(IOError('Wrote {w} of {n} bytes of range {r} to {f}'.format(w=written, n=length, r=str(s3_byte_range),
+                                                                             f=self.local_file)))
+        return s3_byte_range.lower_bound, s3_byte_range.lower_bound + length - 1
+
     def cleanup_temp_file(self):
         logging.debug('Cleanup temp file {tf}.'.format(tf=self.temp_file))
         os.remove(self.temp_file)
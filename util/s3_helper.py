@@ -1,13 +1,27 @@
-import boto3
+from util.s3_client_registry import S3ClientRegistry
+from util.bucket_region_cache import BucketRegionCache
 from util.s3_file import S3File
 from util.manifest import Manifest
-from util.s3_byte_range import S3ByteRange
+from util.s3_read_ahead import S3ReadAhead
 from util.s3_file_transfer import S3FileTransfer
-from util.file_cryptor import S3EnvelopeFileCryptor
+from util.transfer_journal import TransferJournal
+from util.sync_state import SyncState
+from util.part_cache import PartCache
+from util.transfer_scheduler import TransferScheduler
+from util.instrumentation import Instrumentation
+from util.process_pipeline import ProcessPipeline, create_stream_processor
+from util.async_transfer_engine import AsyncTransferEngine, DEFAULT_REQUESTS_IN_FLIGHT, DEFAULT_ASYNC_BYTES_PER_FETCH
+from util.partitioning import assign_longest_processing_time_first, get_bin_weights
+from util.file_cryptor import S3EnvelopeFileCryptor, SegmentWorkers, DEFAULT_SEGMENT_SIZE
 from util.exceptions import DuplicateLocalFileException, LocalFileExistsAndConflictsWithTargetFileAndNoOverWrite
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextlib
+import functools
 import logging
 import os
 import sys
+import time
 import gzip
 
 s3helper_out_handle = None
@@ -25,10 +39,7 @@ class S3Helper:
     def make_s3_connection(region=None):
         global s3
         if s3 is None:
-            if region is not None:
-                s3 = boto3.client('s3', region_name=region)
-            else:
-                s3 = boto3.client('s3')
+            s3 = S3ClientRegistry.get_client(region)
 
         return s3
 
@@ -50,17 +61,47 @@ class S3Helper:
         """
         if not isinstance(s3file_manifest, S3File):
             raise(Exception('retrieve_manifest can only be called with S3File parameter '+str(type(s3file_manifest))))
-        manifest_as_string = s3file_manifest.get_file_content()
+        # The manifest is parsed while it is read so its JSON is never held in memory as a whole
+        manifest_stream = s3file_manifest.get_content_stream()
+        try:
+            manifest = Manifest(manifest_stream=manifest_stream, region=s3file_manifest.get_region(),
+                                region_cache=s3file_manifest.region_cache)
+        finally:
+            manifest_stream.close()
 
-        if isinstance(manifest_as_string, bytes):
-            manifest_as_string = manifest_as_string.decode('utf-8')
+        return manifest
 
-        if isinstance(manifest_as_string, str):
-            manifest = Manifest(manifest_json_string=manifest_as_string, region=s3file_manifest.get_region())
-        else:
-            raise (Exception('Invalid type for manifest string {t}'.format(t=type(manifest_as_string))))
+    @staticmethod
+    def load_manifest(s3file_manifest, region_cache, **kwargs):
+        """
+        Retrieve a manifest and prepare its entries for retrieval.
 
-        return manifest
+        Args:
+            s3file_manifest(S3File):
+            region_cache(BucketRegionCache): shared by the manifest and all its entries
+            **kwargs:
+              - region=None: force the region of the manifest and its entries
+              - parallelism=1: number of concurrent HEAD requests when prefetching metadata
+              - prefetch_metadata=True: get the sizes of all entries up front with bulk listings
+              - require_etag=False: also prefetch the ETags of entries of which the size is known
+
+        Returns:
+            Manifest:
+        """
+        region = kwargs.get('region', None)
+        if region is not None:
+            s3file_manifest.set_region(region)
+        s3file_manifest.set_region_cache(region_cache)
+
+        logging.debug('Retrieve manifest file from S3 location={s3loc}.'.format(s3loc=str(s3file_manifest)))
+        with Instrumentation.measure('manifest.get'):
+            s3manifest = S3Helper.retrieve_manifest(s3file_manifest)
+
+        if kwargs.get('prefetch_metadata', True):
+            with Instrumentation.measure('manifest.prefetch_metadata'):
+                s3manifest.prefetch_metadata(parallelism=int(kwargs.get('parallelism', 1)),
+                                             require_etag=kwargs.get('require_etag', False))
+        return s3manifest
 
     @staticmethod
     def return_data_as_is(data):
@@ -70,6 +111,227 @@ class S3Helper:
     def return_data_decompressed(data):
         return gzip.decompress(data)
 
+    @staticmethod
+    def write_to_stdout(data):
+        global s3helper_out_handle
+        try:
+            with Instrumentation.measure('sink.write') as measurement:
+                if s3helper_out_handle is None:
+                    sys.stdout.buffer.write(data)
+                else:
+                    s3helper_out_handle.write(data)
+                measurement.add_bytes(len(data))
+        except Exception as e:
+            logging.fatal('Something went wrong writing data back.')
+            logging.fatal(str(e))
+            raise e
+
+    @staticmethod
+    def get_stream_processor(s3_transfer, symmetric_key=None, decompress=True):
+        """
+        Determine how the fragments of a file need to be processed before they are sent to stdout.  If a symmetric key
+        is given the fragments are decrypted as they arrive.  Afterwards they are decompressed, the codec is detected
+        from the key suffix (.gz, .bz2, .zst) or otherwise from the magic bytes at the start of the file.
+
+        Args:
+            s3_transfer(S3FileTransfer):
+            symmetric_key(SymmetricKey): if provided then client-side encryption is assumed
+            decompress(bool): if False the (decrypted) content is passed on as is
+
+        Returns:
+            StreamProcessor:
+        """
+        processor_arguments = S3Helper.get_stream_processor_arguments(s3_transfer, symmetric_key=symmetric_key,
+                                                                      decompress=decompress)
+        return create_stream_processor(*processor_arguments)
+
+    @staticmethod
+    def get_stream_processor_arguments(s3_transfer, symmetric_key=None, decompress=True):
+        """
+        The data key is decrypted up front so the arguments can be sent to a worker process (see ProcessPipeline).
+
+        Args:
+            s3_transfer(S3FileTransfer):
+            symmetric_key(SymmetricKey): if provided then client-side encryption is assumed
+            decompress(bool): if False the (decrypted) content is passed on as is
+
+        Returns:
+            tuple: the arguments of create_stream_processor
+        """
+        data_key = None
+        iv = None
+        if symmetric_key is not None:
+            cryptor = S3EnvelopeFileCryptor(symmetric_key=symmetric_key, s3_transfer=s3_transfer)
+            data_key = cryptor.get_decrypted_data_key()
+            iv = cryptor.iv
+        return s3_transfer.get_s3_file().get_key(), decompress, data_key, iv
+
+    @staticmethod
+    def cat_files(s3_transfers, **kwargs):
+        """
+        Send the content of the files to stdout in order.
+
+        Args:
+            s3_transfers(list): S3FileTransfer objects to output
+            **kwargs: see iter_processed_fragments
+
+        Returns:
+
+        """
+        for _, output, _ in S3Helper.iter_processed_fragments(s3_transfers, **kwargs):
+            if len(output) > 0:
+                S3Helper.write_to_stdout(output)
+
+    @staticmethod
+    def open_sink(sink):
+        """
+
+        Args:
+            sink(str): 'fd:<n>' for an open file descriptor (e.g. a pipe set up by the caller), otherwise the path of a
+              file or FIFO that is opened for writing
+
+        Returns:
+            A binary file object that closes the sink when it is closed
+        """
+        if sink.startswith('fd:'):
+            return os.fdopen(int(sink[len('fd:'):]), 'wb')
+        return open(sink, 'wb')
+
+    @staticmethod
+    def cat_files_sharded(s3_transfers, sinks, **kwargs):
+        """
+        Spread the content of the files over several sinks so that several consumers can load it in parallel.  Whole
+        files are assigned to the sinks, largest first to the sink with the fewest bytes so far, so every sink gets
+        complete records and about the same number of bytes.  Every sink is written by its own thread and gets its
+        files in manifest order.
+
+        Args:
+            s3_transfers(list): S3FileTransfer objects to output
+            sinks(list): see open_sink
+            **kwargs: see iter_processed_fragments, parallelism is the number of ranged GETs in flight per sink
+
+        Returns:
+
+        """
+        sizes = [s3_transfer.get_size() for s3_transfer in s3_transfers]
+        assignments = assign_longest_processing_time_first(sizes, len(sinks))
+        logging.debug('Bytes per sink: {b}'.format(b=get_bin_weights(sizes, assignments)))
+        with ThreadPoolExecutor(max_workers=len(sinks)) as executor:
+            futures = [executor.submit(S3Helper.write_files_to_sink, [s3_transfers[index] for index in indices], sink,
+                                       **kwargs)
+                       for sink, indices in zip(sinks, assignments)]
+            for future in futures:
+                future.result()
+
+    @staticmethod
+    def write_files_to_sink(s3_transfers, sink, **kwargs):
+        with S3Helper.open_sink(sink) as sink_file:
+            for _, output, _ in S3Helper.iter_processed_fragments(s3_transfers, **kwargs):
+                if len(output) > 0:
+                    with Instrumentation.measure('sink.write') as measurement:
+                        sink_file.write(output)
+                        measurement.add_bytes(len(output))
+
+    @staticmethod
+    def iter_processed_fragments(s3_transfers, **kwargs):
+        """
+        Generate the content of the files in order, decrypted and decompressed.
+
+        Args:
+            s3_transfers(list): S3FileTransfer objects to read
+            **kwargs:
+              - bytes_per_fetch=10000000: size of the ranged GETs
+              - parallelism=1: number of ranged GETs in flight, these can span multiple files
+              - max_buffered_bytes=None: cap on the fetched bytes that are not yet consumed
+              - symmetric_key=None: if provided then client-side encryption is assumed to decrypt the files
+              - part_cache=None: PartCache from which cached files are read, other files are added to it as they are
+                streamed
+              - decompress=True: decompress files based on their suffix or magic bytes
+              - transfer_scheduler=None: TransferScheduler that picks the range size of every file
+              - cpu_workers=1: number of worker processes that decrypt and decompress the files (see ProcessPipeline),
+                1 processes them in the calling process and None sizes the pool from the number of CPUs
+
+        Returns:
+            generator: tuples (s3_transfer, output, is_last); output can be empty and is_last marks the last output of
+              a file
+        """
+        symmetric_key = kwargs.get('symmetric_key', None)
+        part_cache = kwargs.get('part_cache', None)
+        decompress = kwargs.get('decompress', True)
+        cpu_workers = kwargs.get('cpu_workers', 1)
+        if part_cache is not None:
+            for s3_transfer in s3_transfers:
+                s3_transfer.cached_file = part_cache.get_cached_file_if_present(s3_transfer.get_s3_file())
+        bytes_per_fetch = int(kwargs.get('bytes_per_fetch', 10000000))
+        read_ahead = S3ReadAhead(s3_transfers, bytes_per_fetch=bytes_per_fetch,
+                                 requests_in_flight=int(kwargs.get('parallelism', 1)),
+                                 max_buffered_bytes=kwargs.get('max_buffered_bytes', None),
+                                 transfer_scheduler=kwargs.get('transfer_scheduler', None))
+        fragments = S3Helper.iter_fragments_through_cache(read_ahead, part_cache)
+        try:
+            if cpu_workers == 1:
+                stream_processor = None
+                for s3_transfer, data, is_last in fragments:
+                    if stream_processor is None:
+                        logging.debug('Processing S3 file {file}'.format(file=str(s3_transfer.get_s3_file())))
+                        stream_processor = S3Helper.get_stream_processor(s3_transfer, symmetric_key=symmetric_key,
+                                                                         decompress=decompress)
+                    with Instrumentation.measure('stream.process') as measurement:
+                        output = stream_processor.process(data)
+                        if is_last:
+                            output += stream_processor.finish()
+                        measurement.add_bytes(len(data))
+                    if is_last:
+                        stream_processor = None
+                    yield s3_transfer, output, is_last
+            else:
+                pipeline = ProcessPipeline(workers=cpu_workers)
+                yield from pipeline.process(fragments, functools.partial(S3Helper.get_stream_processor_arguments,
+                                                                         symmetric_key=symmetric_key,
+                                                                         decompress=decompress))
+        finally:
+            fragments.close()
+        if part_cache is not None:
+            part_cache.evict_if_needed()
+
+    @staticmethod
+    def iter_fragments_through_cache(fragments, part_cache=None):
+        """
+        Pass the fragments on and add the files that are not in the part cache yet to it along the way.
+
+        Args:
+            fragments(iterable): tuples (s3_transfer, data, is_last) like S3ReadAhead yields them
+            part_cache(PartCache): None if there is no part cache
+
+        Returns:
+            generator: the same tuples
+        """
+        is_first = True
+        cache_writer = None
+        try:
+            for s3_transfer, data, is_last in fragments:
+                if is_first and part_cache is not None and s3_transfer.cached_file is None:
+                    cache_writer = part_cache.get_writer(s3_transfer.get_s3_file())
+                if cache_writer is not None:
+                    cache_writer.write(data)
+                    if is_last:
+                        cache_writer.commit()
+                        cache_writer = None
+                is_first = is_last
+                yield s3_transfer, data, is_last
+        finally:
+            if cache_writer is not None:
+                cache_writer.abort()
+
+    @staticmethod
+    def retrieve_file_measured(s3_transfer, **kwargs):
+        """
+        retrieve_file recorded as the 'file.retrieve' stage of the instrumentation.
+        """
+        with Instrumentation.measure('file.retrieve') as measurement:
+            S3Helper.retrieve_file(s3_transfer, **kwargs)
+            measurement.add_bytes(s3_transfer.get_size())
+
     @staticmethod
     def retrieve_file(s3_transfer, **kwargs):
         """
@@ -78,59 +340,120 @@ class S3Helper:
         :param kwargs: 
           - symmetric_key=None: if provided then client-side encryption is assumed to decrypt the files
           - target_file_name=None: name of target file. If None than send content to stdout
+          - bytes_per_fetch=10000000: size of the ranged GETs when sending content to stdout or decrypting
+          - parallelism=1: number of ranged GETs in flight when sending content to stdout
+          - decrypt_workers=1: if bigger than 1, encrypted files bigger than decrypt_segment_size are cut in segments
+            that are fetched and decrypted by a pool of this many worker processes
+          - decrypt_segment_size=DEFAULT_SEGMENT_SIZE: size of the segments for parallel decryption
+          - journal=None: TransferJournal, if provided then finished work is recorded and skipped on a next run.
+            Plain files are resumed per range, encrypted files per file.
+          - sync_state=None: SyncState in which the local file is recorded once it is retrieved
+          - part_cache=None: PartCache through which the file is retrieved, it takes precedence over the journal
+          - transfer_scheduler=None: TransferScheduler that picks the range size and concurrency of the file instead
+            of bytes_per_fetch
         :return: 
         """
         symmetric_key = kwargs.get('symmetric_key', None)
-        s3_byte_range = S3ByteRange(int(kwargs.get('bytes_per_fetch', 10000000)))
+        journal = kwargs.get('journal', None)
+        sync_state = kwargs.get('sync_state', None)
+        part_cache = kwargs.get('part_cache', None)
+        transfer_scheduler = kwargs.get('transfer_scheduler', None)
+        transfer_config = None
+        if transfer_scheduler is not None and s3_transfer.get_local_file() is not None:
+            transfer_config = transfer_scheduler.get_transfer_config(s3_transfer.get_size())
 
         if s3_transfer.get_local_file() is None:
             # No destination file means the file content should be sent to stdout
-            global s3helper_out_handle
-
-            file_size = s3_transfer.get_size()
-
-            if s3_transfer.get_s3_file().get_key().endswith('.gz'):
-                if file_size > s3_byte_range.size:
-                    raise RuntimeError(
-                        'Gzipped file is bigger than fetch file, not supported to stream {f}'.format(
-                            f=str(s3_transfer.get_s3_file())
-                        )
-                    )
+            S3Helper.cat_files([s3_transfer], **kwargs)
+
+        elif part_cache is not None:
+            S3Helper.retrieve_file_through_cache(s3_transfer, **kwargs)
+
+        elif journal is not None and symmetric_key is None:
+            # The range size stays bytes_per_fetch so the ranges match the journal of a previous run
+            s3_transfer.download_resumable(journal, bytes_per_fetch=int(kwargs.get('bytes_per_fetch', 10000000)),
+                                           requests_in_flight=1 if transfer_config is None else
+                                           transfer_config.concurrency)
+
+        elif journal is not None:
+            s3_file = s3_transfer.get_s3_file()
+            etag, size = s3_file.get_etag(), s3_transfer.get_size()
+            if journal.is_file_complete(s3_transfer.get_local_file(), etag, size):
+                logging.debug('Journal has {f} as complete, skipping'.format(f=s3_transfer.get_local_file()))
+                return
+            journal.record_file_started(s3_transfer.get_local_file(), etag, size)
+            retrieve_kwargs = dict(kwargs)
+            del retrieve_kwargs['journal']
+            retrieve_kwargs.pop('sync_state', None)
+            S3Helper.retrieve_file(s3_transfer, **retrieve_kwargs)
+            s3_transfer.sync_local_file()
+            journal.record_file_complete(s3_transfer.get_local_file(), etag, size)
+
+        elif symmetric_key is not None:
+            logging.debug('Decryption is requested')
+            cryptor = S3EnvelopeFileCryptor(symmetric_key=symmetric_key, s3_transfer=s3_transfer)
+            decrypt_workers = int(kwargs.get('decrypt_workers', 1))
+            segment_size = int(kwargs.get('decrypt_segment_size', DEFAULT_SEGMENT_SIZE))
+            try:
+                if decrypt_workers > 1 and s3_transfer.get_size() > segment_size:
+                    cryptor.decrypt_parallel(s3_transfer, workers=decrypt_workers, segment_size=segment_size)
+                elif transfer_config is not None:
+                    cryptor.decrypt(s3_transfer, bytes_per_fetch=transfer_config.range_size,
+                                    requests_in_flight=transfer_config.concurrency)
                 else:
-                    f_process = S3Helper.return_data_decompressed
-            else:
-                f_process = S3Helper.return_data_as_is
-
-            received_bytes = 0
-            while received_bytes < file_size:
-                logging.debug('Retrieving range {r}'.format(r=str(s3_byte_range)))
+                    cryptor.decrypt(s3_transfer, bytes_per_fetch=int(kwargs.get('bytes_per_fetch', 10000000)))
+            except Exception as e:
+                # Never fall back to storing the encrypted object, the partial local file is removed by the cryptor
+                logging.error('Exception {e} encountered when decrypting transfer.'.format(e=str(e)))
+                raise e
+        else:
+            start = time.perf_counter()
+            s3_transfer.download(transfer_config=transfer_config)
+            if transfer_config is not None:
+                # The throughput of a single connection is fed back to the scheduler
+                transfer_scheduler.record_request(s3_transfer.get_size() // transfer_config.concurrency,
+                                                  time.perf_counter() - start)
 
-                s3_file_fragment = s3_transfer.s3_file.get_range(s3_byte_range)
-                received_bytes += s3_file_fragment.get_size()
+        if sync_state is not None and s3_transfer.get_local_file() is not None:
+            sync_state.record(s3_transfer)
 
-                try:
-                    if s3helper_out_handle is None:
-                        sys.stdout.buffer.write(f_process(s3_file_fragment.get_streaming_body().read()))
-                    else:
-                        s3helper_out_handle.write(f_process(s3_file_fragment.get_streaming_body().read()))
-                except Exception as e:
-                    logging.fatal('Something went wrong writing data back.')
-                    logging.fatal(str(e))
-                    raise e
+    @staticmethod
+    def retrieve_file_through_cache(s3_transfer, **kwargs):
+        """
+        Make sure the S3 object is in the part cache and create the local file from the cached copy.  Plain files are
+        reflinked or copied, encrypted files are decrypted from the cached copy.
 
-                s3_byte_range.next()
+        Args:
+            s3_transfer(S3FileTransfer): transfer with a local file as destination
+            **kwargs: see retrieve_file, part_cache is required
 
-        else:
-            s3_transfer.download()
+        Returns:
 
+        """
+        part_cache = kwargs['part_cache']
+        symmetric_key = kwargs.get('symmetric_key', None)
+        local_file = s3_transfer.get_local_file()
+        with part_cache.get_cached_file(s3_transfer.get_s3_file()) as cached_file:
+            s3_transfer.make_sure_local_parent_dir_exists()
             if symmetric_key is not None:
-                logging.debug('Decryption is requested')
                 cryptor = S3EnvelopeFileCryptor(symmetric_key=symmetric_key, s3_transfer=s3_transfer)
+                decrypt_workers = int(kwargs.get('decrypt_workers', 1))
+                segment_size = int(kwargs.get('decrypt_segment_size', DEFAULT_SEGMENT_SIZE))
+                # Decrypted into a temporary file such that a failure never leaves a partial local file behind
+                temp_file = S3FileTransfer.get_unique_temp_name(local_file)
                 try:
-                    cryptor.decrypt(s3_transfer)
+                    cryptor.decrypt_local_file(cached_file, temp_file, workers=decrypt_workers,
+                                               segment_size=segment_size)
+                    os.replace(temp_file, local_file)
                 except Exception as e:
-                    logging.WARN('Exception {e} encountered when decrypting transfer.'.format(e=str(e)))
-                    logging.WARN('No decryption performed.')
+                    logging.error('Exception {e} encountered when decrypting transfer.'.format(e=str(e)))
+                    raise e
+                finally:
+                    if os.path.isfile(temp_file):
+                        os.remove(temp_file)
+                return
+            method = PartCache.reflink_or_copy(cached_file, local_file)
+            logging.debug('Created {f} from the part cache with a {m}'.format(f=local_file, m=method))
 
     @staticmethod
     def retrieve_files_from_manifest_file(s3file_manifest, target_path, **kwargs):
@@ -145,48 +468,322 @@ class S3Helper:
               - region
               - flatten_paths = False: if paths in manifest have different paths only use part after latest forwards
                 slash (/) as filename
+              - parallelism=1: number of manifest parts that are retrieved concurrently when storing files locally or
+                the number of ranged GETs in flight when sending content to stdout
+              - bytes_per_fetch=None: fixed size of the ranged GETs.  By default a TransferScheduler picks the range
+                size and concurrency of every file from its size and the measured throughput.
+              - max_buffered_bytes=None: cap on the fetched bytes that are not yet written to stdout
+              - decrypt_workers=1: number of worker processes that decrypt segments of a single big encrypted file
+              - decrypt_segment_size=DEFAULT_SEGMENT_SIZE: size of the segments for parallel decryption
+              - region_cache_file=None: JSON file in which the bucket regions are cached between runs
+              - prefetch_metadata=True: get the sizes of all entries up front with bulk listings instead of a HEAD
+                request per entry (sizes from a MANIFEST VERBOSE manifest are used as is)
+              - resume=False: keep a journal in target_path of the finished files and byte ranges such that a next run
+                only retrieves what is missing.  Local files that are known in the journal do not count as conflicts.
+              - sync=False: only retrieve the entries that are new or changed compared to the state of target_path (see
+                SyncState), changed local files are replaced
+              - delete=False: when syncing, delete local files of a previous sync that are no longer in the manifest
+              - cache_dir=None: directory of a PartCache (shared by processes on the same host) to retrieve files
+                through
+              - cache_max_bytes=None: size limit of the part cache, least recently used parts are evicted
+              - shard_count=1: number of nodes that share the retrieval, each node only retrieves its shard of the
+                entries.  Entries are spread by size (see get_shard) so every node gets about the same number of bytes.
+              - shard_index=0: the shard of this node, from 0 up to shard_count - 1
+              - shard_outputs=None: when target_path is None, list of sinks (see open_sink) over which the parts are
+                spread instead of sending everything to stdout
+              - cpu_workers=1: when target_path is None, number of worker processes that decrypt and decompress the
+                parts, None sizes the pool from the number of CPUs (see iter_processed_fragments)
 
         Returns:
 
+        """
+        with S3Helper.prepare_manifest_retrieval(s3file_manifest, target_path, **kwargs) as (s3_transfers,
+                                                                                             retrieve_kwargs):
+            S3Helper.retrieve_transfers(s3_transfers, target_path, retrieve_kwargs, **kwargs)
+
+    @staticmethod
+    async def retrieve_files_from_manifest_file_async(s3file_manifest, target_path, **kwargs):
+        """
+        Coroutine version of retrieve_files_from_manifest_file that retrieves the files with an AsyncTransferEngine, so
+        the requests of all files share a single event loop.  Loading the manifest and saving the state of the
+        retrieval are blocking and run in the default executor of the loop.  Retrievals that the engine does not support
+        (see AsyncTransferEngine.can_retrieve) fall back to the threaded retrieval in the executor.
+
+        Args:
+            s3file_manifest(S3File):
+            target_path:
+            **kwargs: see retrieve_files_from_manifest_file and
+              - requests_in_flight=DEFAULT_REQUESTS_IN_FLIGHT: maximum number of ranged GETs in flight over all files
+              - async_engine=None: AsyncTransferEngine to use instead of one on aiobotocore clients
+
+        Returns:
+
+        """
+        async_engine = kwargs.get('async_engine', None)
+        if async_engine is None:
+            async_engine = AsyncTransferEngine(
+                max_requests_in_flight=int(kwargs.get('requests_in_flight', DEFAULT_REQUESTS_IN_FLIGHT)),
+                bytes_per_fetch=int(kwargs.get('bytes_per_fetch', None) or DEFAULT_ASYNC_BYTES_PER_FETCH))
+        loop = asyncio.get_running_loop()
+        retrieval = S3Helper.prepare_manifest_retrieval(s3file_manifest, target_path, **kwargs)
+        s3_transfers, retrieve_kwargs = await loop.run_in_executor(None, retrieval.__enter__)
+        try:
+            if AsyncTransferEngine.can_retrieve(target_path, retrieve_kwargs):
+                await async_engine.retrieve_files(s3_transfers, **retrieve_kwargs)
+            else:
+                logging.debug('The asyncio transfer engine does not support this retrieval, using threads')
+                await loop.run_in_executor(None, functools.partial(S3Helper.retrieve_transfers, s3_transfers,
+                                                                   target_path, retrieve_kwargs, **kwargs))
+        except BaseException:
+            await loop.run_in_executor(None, retrieval.__exit__, *sys.exc_info())
+            raise
+        await loop.run_in_executor(None, retrieval.__exit__, None, None, None)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def prepare_manifest_retrieval(s3file_manifest, target_path, **kwargs):
+        """
+        Load the manifest, check the local files and set up the journal, sync state and part cache of a retrieval.
+        Their state is saved when the block ends and a sync deletes the untracked local files if the block succeeded.
+
+        Args:
+            s3file_manifest(S3File):
+            target_path:
+            **kwargs: see retrieve_files_from_manifest_file
+
+        Returns:
+            a context manager that gives a tuple (list of S3FileTransfer objects to retrieve, kwargs for retrieve_file)
         """
         symmetric_key = kwargs.get('symmetric_key', None)
         overwrite = kwargs.get('overwrite', False)
         region = kwargs.get('region', None)
         flatten_paths = kwargs.get('flatten_paths', False)
+        parallelism = int(kwargs.get('parallelism', 1))
+        retrieve_kwargs = {
+            'symmetric_key': symmetric_key,
+            'overwrite': overwrite,
+            'bytes_per_fetch': int(kwargs.get('bytes_per_fetch', None) or 10000000),
+            'decrypt_workers': int(kwargs.get('decrypt_workers', 1)),
+            'decrypt_segment_size': int(kwargs.get('decrypt_segment_size', DEFAULT_SEGMENT_SIZE))
+        }
+
+        resume = kwargs.get('resume', False) and target_path is not None
+        sync = kwargs.get('sync', False) and target_path is not None
+
+        transfer_scheduler = None
+        if kwargs.get('bytes_per_fetch', None) is None:
+            if target_path is None:
+                # A cat has parallelism ranged GETs in flight over all files, a big file is cut in at least that many
+                max_concurrency = parallelism
+            else:
+                # Several files are in flight at the same time so they share the connection pool
+                max_concurrency = S3ClientRegistry.max_pool_connections // parallelism
+            transfer_scheduler = TransferScheduler(max_concurrency=max_concurrency)
+            retrieve_kwargs['transfer_scheduler'] = transfer_scheduler
 
-        if region is not None:
-            s3file_manifest.set_region(region)
+        part_cache = None
+        if kwargs.get('cache_dir', None) is not None:
+            part_cache = PartCache(kwargs['cache_dir'], max_bytes=kwargs.get('cache_max_bytes', None))
+            retrieve_kwargs['part_cache'] = part_cache
 
-        logging.debug('Retrieve manifest file from S3 location={s3loc}.'.format(s3loc=str(s3file_manifest)))
-        s3manifest = S3Helper.retrieve_manifest(s3file_manifest)
+        region_cache = BucketRegionCache(kwargs.get('region_cache_file', None))
+        s3manifest = S3Helper.load_manifest(s3file_manifest, region_cache, region=region, parallelism=parallelism,
+                                            prefetch_metadata=kwargs.get('prefetch_metadata', True),
+                                            require_etag=sync or resume or part_cache is not None)
 
         if flatten_paths:
             prefix = None
         else:
             prefix = s3manifest.get_common_path_prefix()
 
-        s3_transfers = []
         local_files = []
-
-        for s3file in s3manifest.s3_files:
-            if target_path is not None:
-                file_path = os.path.join(target_path, s3file.get_s3_file_name(prefix=prefix))
-                local_files.append(file_path)
-            else:
-                file_path = None
-
-            s3_transfers.append(S3FileTransfer(s3file, file_path))
+        if target_path is not None:
+            local_files = [os.path.join(target_path, entry.get_s3_file_name(prefix=prefix))
+                           for entry in s3manifest.entries]
 
         if not overwrite:
-            if len(local_files) != len(set(local_files)):
+            duplicate_local_files = S3Helper.get_duplicates(local_files)
+            if len(duplicate_local_files) > 0:
                 raise(DuplicateLocalFileException('There is a duplicate collision in local_files {lf}'
-                                                  .format(lf=str(local_files))))
+                                                  .format(lf=str(duplicate_local_files))))
+
+        # Local paths are based on the common prefix of the whole manifest so every shard uses the same paths
+        manifest_local_files = local_files
+        indices = range(len(s3manifest))
+        shard_count = int(kwargs.get('shard_count', 1))
+        if shard_count > 1:
+            sizes = [s3manifest.get_size(index) for index in indices]
+            indices = S3Helper.get_shard(sizes, int(kwargs.get('shard_index', 0)), shard_count)
+            local_files = [local_files[index] for index in indices if target_path is not None]
+
+        # S3File objects are only created for the entries that this node transfers
+        s3_transfers = [S3FileTransfer(s3manifest.get_s3_file(index),
+                                       manifest_local_files[index] if target_path is not None else None)
+                        for index in indices]
+
+        journal = None
+        if resume:
+            os.makedirs(target_path, exist_ok=True)
+            journal = TransferJournal(target_path)
+            retrieve_kwargs['journal'] = journal
+
+        sync_state = None
+        if sync:
+            os.makedirs(target_path, exist_ok=True)
+            sync_state = SyncState(target_path)
+            retrieve_kwargs['sync_state'] = sync_state
+            s3_transfers = S3Helper.get_out_of_sync_transfers(s3_transfers, sync_state)
 
+        if not overwrite:
             for local_file in local_files:
+                if sync or (journal is not None and journal.knows(local_file)):
+                    # A sync replaces the files that changed, a resume continues the files of the journal
+                    continue
                 if os.path.exists(local_file):
                     msg = 'Overwrite is disabled and local file {f} already exists.'.format(f=local_file)
                     raise(LocalFileExistsAndConflictsWithTargetFileAndNoOverWrite(msg))
 
+        try:
+            yield s3_transfers, retrieve_kwargs
+            if sync and kwargs.get('delete', False):
+                sync_state.delete_untracked(manifest_local_files)
+        finally:
+            SegmentWorkers.shutdown()
+            region_cache.save()
+            if journal is not None:
+                journal.close()
+            if sync_state is not None:
+                sync_state.save()
+            if part_cache is not None:
+                part_cache.evict()
+                logging.info('Part cache hits={hits} misses={misses}'.format(**part_cache.get_stats()))
+
+    @staticmethod
+    def retrieve_transfers(s3_transfers, target_path, retrieve_kwargs, **kwargs):
+        """
+        Retrieve the transfers of a manifest to stdout, to shard outputs or to local files.
+
+        Args:
+            s3_transfers(list): S3FileTransfer objects
+            target_path:
+            retrieve_kwargs(dict): kwargs for retrieve_file
+            **kwargs: see retrieve_files_from_manifest_file
+
+        Returns:
+
+        """
+        symmetric_key = retrieve_kwargs['symmetric_key']
+        part_cache = retrieve_kwargs.get('part_cache', None)
+        transfer_scheduler = retrieve_kwargs.get('transfer_scheduler', None)
+        parallelism = int(kwargs.get('parallelism', 1))
+        if target_path is None and kwargs.get('shard_outputs', None):
+            S3Helper.cat_files_sharded(s3_transfers, kwargs['shard_outputs'], symmetric_key=symmetric_key,
+                                       parallelism=parallelism,
+                                       bytes_per_fetch=retrieve_kwargs['bytes_per_fetch'],
+                                       max_buffered_bytes=kwargs.get('max_buffered_bytes', None),
+                                       part_cache=part_cache, transfer_scheduler=transfer_scheduler,
+                                       cpu_workers=kwargs.get('cpu_workers', 1))
+        elif target_path is None:
+            S3Helper.cat_files(s3_transfers, symmetric_key=symmetric_key, parallelism=parallelism,
+                               bytes_per_fetch=retrieve_kwargs['bytes_per_fetch'],
+                               max_buffered_bytes=kwargs.get('max_buffered_bytes', None), part_cache=part_cache,
+                               transfer_scheduler=transfer_scheduler, cpu_workers=kwargs.get('cpu_workers', 1))
+        elif parallelism > 1:
+            S3Helper.retrieve_files_concurrently(s3_transfers, parallelism, **retrieve_kwargs)
+        else:
+            for s3_transfer in s3_transfers:
+                logging.debug('Processing S3 file {file}'.format(file=str(s3_transfer.get_s3_file())))
+                S3Helper.retrieve_file_measured(s3_transfer, **retrieve_kwargs)
+
+    @staticmethod
+    def get_duplicates(items):
+        """
+
+        Args:
+            items(list): hashable items
+
+        Returns:
+            list: the items that occur more than once, in order of their second occurrence
+        """
+        seen = set()
+        duplicates = []
+        for item in items:
+            if item in seen:
+                duplicates.append(item)
+            else:
+                seen.add(item)
+        return duplicates
+
+    @staticmethod
+    def get_shard(sizes, shard_index, shard_count):
+        """
+        Split the entries of a manifest over shard_count shards using the longest processing time first heuristic on
+        their sizes.  The split only depends on the manifest (and object sizes) so nodes that each compute their own
+        shard together cover every entry exactly once.
+
+        Args:
+            sizes(list): sizes of the entries of the whole manifest
+            shard_index(int): from 0 up to shard_count - 1
+            shard_count(int):
+
+        Returns:
+            list: the indices of the entries of the shard in manifest order
+        """
+        if not 0 <= shard_index < shard_count:
+            raise(ValueError('Shard index {i} is not in [0, {n})'.format(i=shard_index, n=shard_count)))
+        shards = assign_longest_processing_time_first(sizes, shard_count)
+        logging.debug('Shard {i} of {n} has {f} files and {b} of {t} bytes'.format(
+            i=shard_index, n=shard_count, f=len(shards[shard_index]), b=get_bin_weights(sizes, shards)[shard_index],
+            t=sum(sizes)))
+        return shards[shard_index]
+
+    @staticmethod
+    def get_out_of_sync_transfers(s3_transfers, sync_state):
+        """
+        Filter the transfers of which the local file is up to date.  Up to date local files that were not tracked yet
+        are added to the sync state.
+
+        Args:
+            s3_transfers(list): S3FileTransfer objects that all have a local file as destination
+            sync_state(SyncState):
+
+        Returns:
+            list: the S3FileTransfer objects that need to be retrieved
+        """
+        out_of_sync = []
         for s3_transfer in s3_transfers:
-            logging.debug('Processing S3 file {file}'.format(file=str(s3_transfer.get_s3_file())))
-            S3Helper.retrieve_file(s3_transfer, symmetric_key=symmetric_key, overwrite=overwrite)
+            if not sync_state.is_up_to_date(s3_transfer):
+                out_of_sync.append(s3_transfer)
+            elif not sync_state.is_tracked(s3_transfer.get_local_file()):
+                sync_state.record(s3_transfer)
+        logging.debug('{n} of {t} files are new or changed'.format(n=len(out_of_sync), t=len(s3_transfers)))
+        return out_of_sync
+
+    @staticmethod
+    def retrieve_files_concurrently(s3_transfers, parallelism, **kwargs):
+        """
+        Retrieve files using a bounded pool of worker threads.  Each worker does the download, decryption and cleanup
+        of a single part.  The biggest parts are started first so no big part is left to run alone at the end.  The
+        first exception (in submission order) is raised after the parts that have not been started yet are cancelled.
+
+        Args:
+            s3_transfers(list): S3FileTransfer objects that all have a local file as destination
+            parallelism(int): maximum number of parts that are processed at the same time
+            **kwargs: passed on to retrieve_file
+
+        Returns:
+
+        """
+        logging.debug('Retrieving {n} files with parallelism {p}'.format(n=len(s3_transfers), p=parallelism))
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            futures = []
+            for s3_transfer in TransferScheduler.order_largest_first(s3_transfers):
+                logging.debug('Submitting S3 file {file}'.format(file=str(s3_transfer.get_s3_file())))
+                futures.append(executor.submit(S3Helper.retrieve_file_measured, s3_transfer, **kwargs))
+            try:
+                for future in futures:
+                    future.result()
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
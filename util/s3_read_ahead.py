@@ -0,0 +1,127 @@
+from util.s3_byte_range import S3ByteRange
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from util.instrumentation import Instrumentation
+import logging
+import os
+import time
+
+
+class S3ReadAhead:
+    """
+    Read the content of a list of S3FileTransfer objects as a sequence of ranged GETs.  Up to requests_in_flight
+    ranges are fetched at the same time, also crossing into the next files of the list, but fragments are always handed
+    back in order.  The bytes that are fetched but not yet consumed are capped by max_buffered_bytes.
+
+    Iterating yields tuples (s3_transfer, data, is_last) where is_last marks the final fragment of a file.  Files
+    without content yield a single empty fragment so consumers always see the end of every file.
+    """
+
+    def __init__(self, s3_transfers, bytes_per_fetch=10000000, requests_in_flight=1, max_buffered_bytes=None,
+                 transfer_scheduler=None):
+        """
+
+        Args:
+            s3_transfers(list): S3FileTransfer objects of which the content should be read
+            bytes_per_fetch(int): size of a single ranged GET
+            requests_in_flight(int): maximum number of ranged GETs that are running at the same time
+            max_buffered_bytes(int): maximum number of bytes that are requested but not yet consumed.  By default only
+              requests_in_flight bounds the buffer, to requests_in_flight ranges of the (scheduled) range size.  At
+              least 1 range is always requested.
+            transfer_scheduler(TransferScheduler): if provided it picks the range size of every file (instead of
+              bytes_per_fetch) and the duration of the GETs is fed back to it.  With a max_buffered_bytes the range
+              size is capped such that requests_in_flight ranges fit in the buffer.
+        """
+        self.s3_transfers = s3_transfers
+        self.bytes_per_fetch = int(bytes_per_fetch)
+        self.requests_in_flight = max(1, int(requests_in_flight))
+        self.max_buffered_bytes = None if max_buffered_bytes is None else int(max_buffered_bytes)
+        self.transfer_scheduler = transfer_scheduler
+
+    def get_ranges(self):
+        """
+        Generate all ranges that need to be fetched in order.
+
+        Returns:
+            generator: tuples (s3_transfer, s3_byte_range, length, is_last); s3_byte_range is None for empty files
+        """
+        for s3_transfer in self.s3_transfers:
+            file_size = s3_transfer.get_size()
+            if file_size == 0:
+                yield s3_transfer, None, 0, True
+                continue
+            range_size = self.bytes_per_fetch
+            if self.transfer_scheduler is not None:
+                range_size = self.transfer_scheduler.get_transfer_config(file_size).range_size
+                if self.max_buffered_bytes is not None:
+                    # A range bigger than its share of the buffer would leave a single request in flight
+                    range_size = max(1, min(range_size, self.max_buffered_bytes // self.requests_in_flight))
+            lower_bound = 0
+            while lower_bound < file_size:
+                length = min(range_size, file_size - lower_bound)
+                byte_range = S3ByteRange(range_size, lower_bound=lower_bound)
+                lower_bound += range_size
+                yield s3_transfer, byte_range, length, lower_bound >= file_size
+
+    @staticmethod
+    def fetch(s3_transfer, s3_byte_range):
+        if s3_byte_range is None:
+            return b''
+        if s3_transfer.cached_file is not None:
+            try:
+                with Instrumentation.measure('cache.read') as measurement, \
+                        open(s3_transfer.cached_file, 'rb') as cached_file:
+                    data = os.pread(cached_file.fileno(), s3_byte_range.size, s3_byte_range.lower_bound)
+                    measurement.add_bytes(len(data))
+                    return data
+            except FileNotFoundError:
+                logging.debug('{f} got evicted from the part cache'.format(f=s3_transfer.cached_file))
+                s3_transfer.cached_file = None
+        logging.debug('Retrieving range {r} of {f}'.format(r=str(s3_byte_range), f=str(s3_transfer.get_s3_file())))
+        with Instrumentation.measure('s3.fetch_range') as measurement:
+            s3_file_fragment = s3_transfer.get_s3_file().get_range(s3_byte_range)
+            data = s3_file_fragment.get_streaming_body().read()
+            measurement.add_bytes(len(data))
+        return data
+
+    def fetch_and_measure(self, s3_transfer, s3_byte_range):
+        start = time.perf_counter()
+        data = S3ReadAhead.fetch(s3_transfer, s3_byte_range)
+        if self.transfer_scheduler is not None and s3_transfer.cached_file is None:
+            self.transfer_scheduler.record_request(len(data), time.perf_counter() - start)
+        return data
+
+    def __iter__(self):
+        if self.requests_in_flight == 1:
+            for s3_transfer, s3_byte_range, _, is_last in self.get_ranges():
+                yield s3_transfer, self.fetch_and_measure(s3_transfer, s3_byte_range), is_last
+        else:
+            for fragment in self._iter_read_ahead():
+                yield fragment
+
+    def _iter_read_ahead(self):
+        ranges = self.get_ranges()
+        pending = deque()
+        buffered_bytes = 0
+        next_range = next(ranges, None)
+
+        executor = ThreadPoolExecutor(max_workers=self.requests_in_flight)
+        try:
+            while next_range is not None or len(pending) > 0:
+                while next_range is not None and len(pending) < self.requests_in_flight and \
+                        (len(pending) == 0 or self.max_buffered_bytes is None or
+                         buffered_bytes + next_range[2] <= self.max_buffered_bytes):
+                    s3_transfer, s3_byte_range, length, is_last = next_range
+                    future = executor.submit(self.fetch_and_measure, s3_transfer, s3_byte_range)
+                    pending.append((s3_transfer, future, length, is_last))
+                    buffered_bytes += length
+                    next_range = next(ranges, None)
+
+                s3_transfer, future, length, is_last = pending.popleft()
+                data = future.result()
+                buffered_bytes -= length
+                yield s3_transfer, data, is_last
+        finally:
+            for _, future, _, _ in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
@@ -0,0 +1,170 @@
+import bz2
+import logging
+import zlib
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+BZIP2_MAGIC = b'BZh'
+BZIP2_BLOCK_MAGICS = [b'\x31\x41\x59\x26\x53\x59', b'\x17\x72\x45\x38\x50\x90']
+BYTES_NEEDED_FOR_DETECTION = 10
+
+
+class StreamDecompressor(object):
+    """
+    Incremental decompression of a file that arrives in fragments.  The decoder state is carried from one fragment to
+    the next so memory usage does not depend on the size of the file.  This base class passes data as is.
+    """
+    codec = None
+
+    def decompress(self, data):
+        """
+
+        Args:
+            data(bytes): next fragment of the compressed file
+
+        Returns:
+            bytes: the data that could be decompressed so far
+        """
+        return data
+
+    def flush(self):
+        """
+        Called after the last fragment of the file.
+
+        Returns:
+            bytes: remaining decompressed data
+        """
+        return b''
+
+
+class MultiMemberStreamDecompressor(StreamDecompressor):
+    """
+    Compressed files can consist of multiple members (streams or frames) that are concatenated.  When a member ends
+    a new decoder is started on the unused data.
+    """
+
+    def __init__(self):
+        self.decoder = self.new_decoder()
+        self.received_data = False
+
+    def new_decoder(self):
+        raise NotImplementedError()
+
+    def flush(self):
+        if self.received_data and not self.decoder.eof:
+            raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+        return b''
+
+    def decompress(self, data):
+        self.received_data = self.received_data or len(data) > 0
+        output = []
+        while len(data) > 0:
+            if self.decoder.eof:
+                self.decoder = self.new_decoder()
+            output.append(self.decoder.decompress(data))
+            data = self.decoder.unused_data if self.decoder.eof else b''
+        return b''.join(output)
+
+
+class GzipStreamDecompressor(MultiMemberStreamDecompressor):
+    codec = 'gzip'
+
+    def new_decoder(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def flush(self):
+        data = self.decoder.flush()
+        return data + super(GzipStreamDecompressor, self).flush()
+
+
+class Bzip2StreamDecompressor(MultiMemberStreamDecompressor):
+    codec = 'bzip2'
+
+    def new_decoder(self):
+        return bz2.BZ2Decompressor()
+
+
+class ZstdStreamDecompressor(MultiMemberStreamDecompressor):
+    codec = 'zstd'
+
+    def new_decoder(self):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise(Exception('The zstandard package is required to decompress zstd files (pip install zstandard)')) \
+                from e
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+class AutoDetectStreamDecompressor(StreamDecompressor):
+    """
+    Determine the codec from the first bytes of the file.  Data is held back until enough bytes are available to
+    recognize the magic bytes.
+    """
+
+    def __init__(self):
+        self.buffer = b''
+        self.decompressor = None
+
+    def detect(self):
+        self.decompressor = get_stream_decompressor_for_magic_bytes(self.buffer)
+        logging.debug('Detected codec {c} from magic bytes'.format(c=self.decompressor.codec))
+        data, self.buffer = self.buffer, b''
+        return self.decompressor.decompress(data)
+
+    def decompress(self, data):
+        if self.decompressor is not None:
+            return self.decompressor.decompress(data)
+        self.buffer += data
+        if len(self.buffer) < BYTES_NEEDED_FOR_DETECTION:
+            return b''
+        return self.detect()
+
+    def flush(self):
+        data = b''
+        if self.decompressor is None:
+            data = self.detect()
+        return data + self.decompressor.flush()
+
+
+decompressors_by_suffix = {
+    '.gz': GzipStreamDecompressor,
+    '.bz2': Bzip2StreamDecompressor,
+    '.zst': ZstdStreamDecompressor
+}
+
+
+def get_stream_decompressor_for_magic_bytes(first_bytes):
+    """
+
+    Args:
+        first_bytes(bytes): the start of the file, at least BYTES_NEEDED_FOR_DETECTION bytes unless the file is smaller
+
+    Returns:
+        StreamDecompressor: decompressor for the detected codec, data is passed as is if no codec is recognized
+    """
+    if first_bytes.startswith(GZIP_MAGIC):
+        return GzipStreamDecompressor()
+    if first_bytes.startswith(ZSTD_MAGIC):
+        return ZstdStreamDecompressor()
+    if first_bytes.startswith(BZIP2_MAGIC) and first_bytes[3:4].isdigit() and first_bytes[3:4] != b'0' \
+            and first_bytes[4:BYTES_NEEDED_FOR_DETECTION] in BZIP2_BLOCK_MAGICS:
+        return Bzip2StreamDecompressor()
+    return StreamDecompressor()
+
+
+def get_stream_decompressor(key):
+    """
+    Get a decompressor based on the suffix of the S3 key.  If the suffix is not a known codec the magic bytes at the
+    start of the file decide.
+
+    Args:
+        key(str): S3 key of the file
+
+    Returns:
+        StreamDecompressor:
+    """
+    for suffix, decompressor_class in decompressors_by_suffix.items():
+        if key.endswith(suffix):
+            return decompressor_class()
+    return AutoDetectStreamDecompressor()
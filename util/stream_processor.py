@@ -0,0 +1,39 @@
+class StreamProcessor(object):
+    """
+    Turns the fragments of an S3 object into output bytes: first client-side decryption (if the object is encrypted)
+    and then decompression.
+    """
+    def __init__(self, decompressor, decryptor=None):
+        """
+
+        Args:
+            decompressor(StreamDecompressor):
+            decryptor(StreamingDecryptor): None if the object is not client-side encrypted
+        """
+        self.decompressor = decompressor
+        self.decryptor = decryptor
+
+    def process(self, data):
+        """
+
+        Args:
+            data(bytes): the next fragment of the S3 object
+
+        Returns:
+            bytes: output that is ready
+        """
+        if self.decryptor is not None:
+            data = self.decryptor.update(data)
+        return self.decompressor.decompress(data)
+
+    def finish(self):
+        """
+        Called after the last fragment of the S3 object
+
+        Returns:
+            bytes: remaining output
+        """
+        output = b''
+        if self.decryptor is not None:
+            output = self.decompressor.decompress(self.decryptor.finalize())
+        return output + self.decompressor.flush()
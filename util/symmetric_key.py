@@ -1,5 +1,4 @@
 import base64
-import click
 
 
 class SymmetricKey:
@@ -12,14 +11,3 @@ class SymmetricKey:
     def get_key_data(self):
         return self.key_data
 
-
-class SymmetricKeyParamType(click.ParamType):
-    name = 'symmetric-key'
-
-    def convert(self, value, param, ctx):
-        try:
-            return SymmetricKey(value)
-        except Exception as e:
-            self.fail('{val} is not a valid base 64 encoded symmetric key: {err}'.format(val=value, err=str(e)),
-                      param,
-                      ctx)
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+SYNC_STATE_FILE_NAME = '.redshift-manifest-tools.sync'
+MD5_READ_SIZE = 1024 * 1024
+
+
+def has_content_of_etag(local_file, etag):
+    """
+    Compare the content of a local file with the ETag of an S3 object.  Only the ETag of an object that was uploaded in
+    a single part is the MD5 of its content, a multipart ETag cannot be checked without the part size.
+
+    Args:
+        local_file(str):
+        etag(str): the ETag of the S3 object, with or without quotes
+
+    Returns:
+        bool: True if the MD5 of the local file is the ETag
+    """
+    if etag is None or '-' in etag:
+        return False
+    md5 = hashlib.md5()
+    with open(local_file, 'rb') as input_file:
+        for data in iter(lambda: input_file.read(MD5_READ_SIZE), b''):
+            md5.update(data)
+    return md5.hexdigest() == etag.strip('"')
+
+
+class SyncState:
+    """
+    State of a destination directory that is kept in sync with a manifest.  For every local file (relative to the
+    directory) it stores the S3 object it was retrieved from (URL, ETag and size) and the size and mtime of the local
+    file right after retrieval.  A manifest entry only needs to be retrieved again if the S3 object or the local file
+    changed since.  The state is persisted as JSON in the destination directory.
+    """
+    def __init__(self, directory):
+        """
+
+        Args:
+            directory(str): the destination directory of the sync
+        """
+        self.directory = directory
+        self.path = os.path.join(directory, SYNC_STATE_FILE_NAME)
+        self.files = {}
+        self.lock = threading.Lock()
+        if os.path.isfile(self.path):
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as input_file:
+                self.files.update(json.load(input_file))
+            logging.debug('Loaded sync state of {n} files from {f}'.format(n=len(self.files), f=self.path))
+        except ValueError:
+            logging.warning('Ignoring invalid sync state file {f}, all files will be compared by their ETag'
+                            .format(f=self.path))
+
+    def save(self):
+        """
+        Write the state atomically to the destination directory.
+        """
+        temp_file = '{f}.{pid}.tmp'.format(f=self.path, pid=os.getpid())
+        with self.lock:
+            with open(temp_file, 'w') as output_file:
+                json.dump(self.files, output_file, sort_keys=True)
+        os.replace(temp_file, self.path)
+
+    def get_relative_path(self, local_file):
+        return os.path.relpath(local_file, self.directory)
+
+    def is_up_to_date(self, s3_transfer):
+        """
+        Decide whether the local file of a transfer still holds the current content of its S3 object.  If the file is
+        tracked in the state the ETag and size of the S3 object and the size and mtime of the local file must be
+        unchanged.  The size and mtime of an untracked local file say nothing about its content (e.g. a partial or
+        zero-filled file of an interrupted retrieval), so it is only up to date if its MD5 is the ETag of the S3
+        object.  This allows to start syncing into a directory that was filled by retrieve-files (without decryption).
+
+        Args:
+            s3_transfer(S3FileTransfer):
+
+        Returns:
+            bool:
+        """
+        local_file = s3_transfer.get_local_file()
+        if not os.path.isfile(local_file):
+            return False
+        s3_file = s3_transfer.get_s3_file()
+        local_stat = os.stat(local_file)
+        state = self.files.get(self.get_relative_path(local_file), None)
+        if state is not None:
+            return state['s3_url'] == str(s3_file) and state['etag'] == s3_file.get_etag() \
+                and state['size'] == s3_file.get_size() and state['local_size'] == local_stat.st_size \
+                and state['local_mtime_ns'] == local_stat.st_mtime_ns
+        return local_stat.st_size == s3_file.get_size() and has_content_of_etag(local_file, s3_file.get_etag())
+
+    def record(self, s3_transfer):
+        """
+        Store the state of a transfer right after its local file has been retrieved.
+
+        Args:
+            s3_transfer(S3FileTransfer):
+        """
+        local_file = s3_transfer.get_local_file()
+        s3_file = s3_transfer.get_s3_file()
+        local_stat = os.stat(local_file)
+        with self.lock:
+            self.files[self.get_relative_path(local_file)] = {
+                's3_url': str(s3_file),
+                'etag': s3_file.get_etag(),
+                'size': s3_file.get_size(),
+                'local_size': local_stat.st_size,
+                'local_mtime_ns': local_stat.st_mtime_ns
+            }
+
+    def is_tracked(self, local_file):
+        return self.get_relative_path(local_file) in self.files
+
+    def delete_untracked(self, local_files):
+        """
+        Delete the local files that are tracked in the state but are not in local_files (no longer in the manifest).
+        Files that were not retrieved by a sync are never deleted.
+
+        Args:
+            local_files(list): the local files of the current manifest
+
+        Returns:
+            list: the deleted local files
+        """
+        wanted = set(self.get_relative_path(local_file) for local_file in local_files)
+        deleted = []
+        with self.lock:
+            for relative_path in sorted(set(self.files.keys()) - wanted):
+                local_file = os.path.join(self.directory, relative_path)
+                if os.path.isfile(local_file):
+                    logging.debug('Deleting {f}, it is no longer in the manifest'.format(f=local_file))
+                    os.remove(local_file)
+                    deleted.append(local_file)
+                del self.files[relative_path]
+        return deleted
+
+    def __len__(self):
+        return len(self.files)
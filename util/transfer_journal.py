@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import threading
+
+JOURNAL_FILE_NAME = '.redshift-manifest-tools.journal'
+
+
+class TransferJournal:
+    """
+    Append-only journal (one JSON record per line) in the destination directory that records which files and which
+    byte ranges of files have been retrieved completely.  Records are only written after the data they describe has
+    been synced to disk so a run that is interrupted can be resumed without fetching that data again.
+
+    Files are identified by their path relative to the destination directory together with the ETag and size of the
+    S3 object, so a changed S3 object is never mixed with data of a previous version.
+    """
+    def __init__(self, directory):
+        """
+
+        Args:
+            directory(str): the destination directory of the retrieval
+        """
+        self.directory = directory
+        self.path = os.path.join(directory, JOURNAL_FILE_NAME)
+        self.lock = threading.Lock()
+        self.started_files = set()
+        self.completed_files = {}
+        self.completed_ranges = {}
+        self.load()
+        self.journal_file = open(self.path, 'a')
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'r') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last record can be incomplete if the previous run was interrupted while writing it
+                    logging.debug('Ignoring incomplete journal record {r}'.format(r=line.strip()))
+                    continue
+                self.apply(record)
+        logging.debug('Loaded journal {j}: {n} completed files'.format(j=self.path, n=len(self.completed_files)))
+
+    def apply(self, record):
+        version = (record['file'], record['etag'], record['size'])
+        self.started_files.add(record['file'])
+        if record['type'] == 'file':
+            self.completed_files[record['file']] = version
+        elif record['type'] == 'range':
+            self.completed_ranges.setdefault(version, set()).add((record['lower_bound'], record['upper_bound']))
+
+    def get_relative_path(self, local_file):
+        return os.path.relpath(local_file, self.directory)
+
+    def write(self, record):
+        self.write_records([record])
+
+    def write_records(self, records):
+        """
+        Append records to the journal and sync them to disk at once.
+
+        Args:
+            records(list): dicts that are written as one JSON line each
+        """
+        with self.lock:
+            self.journal_file.write(''.join(json.dumps(record, sort_keys=True) + '\n' for record in records))
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+            for record in records:
+                self.apply(record)
+
+    def knows(self, local_file):
+        """
+
+        Returns:
+            bool: whether the local file has been (partially) written by a run that used this journal
+        """
+        return self.get_relative_path(local_file) in self.started_files
+
+    def record_file_started(self, local_file, etag, size):
+        """
+        Record that local_file is being written by this tool, so a partial file of an interrupted run is known.
+        """
+        if self.get_relative_path(local_file) not in self.started_files:
+            self.write({'type': 'start', 'file': self.get_relative_path(local_file), 'etag': etag, 'size': size})
+
+    def is_file_complete(self, local_file, etag, size):
+        """
+
+        Args:
+            local_file(str):
+            etag(str): ETag of the S3 object
+            size(int): size of the S3 object
+
+        Returns:
+            bool: whether this version of the S3 object has been retrieved completely to local_file
+        """
+        version = (self.get_relative_path(local_file), etag, size)
+        return self.completed_files.get(version[0], None) == version and os.path.isfile(local_file)
+
+    def record_file_complete(self, local_file, etag, size):
+        self.write({'type': 'file', 'file': self.get_relative_path(local_file), 'etag': etag, 'size': size})
+
+    def get_completed_ranges(self, local_file, etag, size):
+        """
+
+        Returns:
+            set: tuples (lower_bound, upper_bound) that are present in the local file for this version of the object
+        """
+        return set(self.completed_ranges.get((self.get_relative_path(local_file), etag, size), set()))
+
+    def record_ranges_complete(self, local_file, etag, size, ranges):
+        """
+        Record byte ranges of which the data has been synced to local_file, with a single sync of the journal.
+
+        Args:
+            ranges(list): tuples (lower_bound, upper_bound)
+        """
+        relative_path = self.get_relative_path(local_file)
+        self.write_records([{'type': 'range', 'file': relative_path, 'etag': etag, 'size': size,
+                             'lower_bound': lower_bound, 'upper_bound': upper_bound}
+                            for lower_bound, upper_bound in ranges])
+
+    def close(self):
+        with self.lock:
+            self.journal_file.close()
@@ -0,0 +1,106 @@
+import logging
+import math
+import threading
+
+SINGLE_REQUEST_SIZE = 8 * 1024 * 1024
+MIN_RANGE_SIZE = 1024 * 1024
+DEFAULT_RANGE_SIZE = 8 * 1024 * 1024
+MAX_RANGE_SIZE = 64 * 1024 * 1024
+# Requests smaller than this are dominated by latency and say little about the throughput of a connection
+MIN_MEASURED_REQUEST_SIZE = 256 * 1024
+
+
+class TransferConfig:
+    """
+    How a single file is fetched: in ranges of range_size bytes with up to concurrency ranges in flight.
+    """
+    def __init__(self, range_size, concurrency):
+        self.range_size = int(range_size)
+        self.concurrency = int(concurrency)
+
+    def __str__(self):
+        return 'TransferConfig(range_size={r}, concurrency={c})'.format(r=self.range_size, c=self.concurrency)
+
+
+class TransferScheduler:
+    """
+    Decides the order in which files are transferred and how every file is fetched.
+
+    Files are started largest first, so a giant part cannot be started last and stretch the run.  Small files are
+    fetched with a single request.  Bigger files are cut in ranges whose size is chosen such that a range takes about
+    target_request_seconds at the throughput per request that is measured during the run.  Every big file is cut in at
+    least max_concurrency ranges so huge files are spread over all connections.
+    """
+    def __init__(self, max_concurrency=10, initial_range_size=DEFAULT_RANGE_SIZE, min_range_size=MIN_RANGE_SIZE,
+                 max_range_size=MAX_RANGE_SIZE, target_request_seconds=1.0):
+        """
+
+        Args:
+            max_concurrency(int): maximum number of ranges of a single file in flight
+            initial_range_size(int): range size used until a throughput has been measured
+            min_range_size(int):
+            max_range_size(int):
+            target_request_seconds(float): desired duration of a single ranged GET
+        """
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.initial_range_size = int(initial_range_size)
+        self.min_range_size = int(min_range_size)
+        self.max_range_size = int(max_range_size)
+        self.target_request_seconds = target_request_seconds
+        self.bytes_per_second = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def order_largest_first(s3_transfers):
+        """
+
+        Args:
+            s3_transfers(list): S3FileTransfer objects
+
+        Returns:
+            list: the S3FileTransfer objects from big to small, files of the same size keep their order
+        """
+        return sorted(s3_transfers, key=lambda s3_transfer: -s3_transfer.get_size())
+
+    def record_request(self, byte_count, seconds):
+        """
+        Feed the measured throughput of a finished request (exponentially weighted moving average).
+
+        Args:
+            byte_count(int): bytes of the request
+            seconds(float): duration of the request
+        """
+        if byte_count < MIN_MEASURED_REQUEST_SIZE or seconds <= 0:
+            return
+        with self.lock:
+            if self.bytes_per_second is None:
+                self.bytes_per_second = byte_count / seconds
+            else:
+                self.bytes_per_second = 0.8 * self.bytes_per_second + 0.2 * byte_count / seconds
+
+    def get_range_size(self):
+        """
+
+        Returns:
+            int: the range size for the measured throughput, within [min_range_size, max_range_size]
+        """
+        if self.bytes_per_second is None:
+            return self.initial_range_size
+        range_size = int(self.bytes_per_second * self.target_request_seconds)
+        return max(self.min_range_size, min(self.max_range_size, range_size))
+
+    def get_transfer_config(self, size):
+        """
+
+        Args:
+            size(int): size of the file
+
+        Returns:
+            TransferConfig:
+        """
+        if size <= SINGLE_REQUEST_SIZE:
+            return TransferConfig(max(size, 1), 1)
+        range_size = max(self.min_range_size, min(self.get_range_size(), math.ceil(size / self.max_concurrency)))
+        transfer_config = TransferConfig(range_size, min(self.max_concurrency, math.ceil(size / range_size)))
+        logging.debug('{c} for a file of {s} bytes'.format(c=str(transfer_config), s=size))
+        return transfer_config